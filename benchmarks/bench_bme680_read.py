@@ -0,0 +1,96 @@
+# coding=utf-8
+"""
+Compare the read modes of the BME680 (Temperature Error Fix) Input against a
+simulated BME680 on a simulated I2C bus.
+
+Both modes run the Input's get_measurement() --reads times. Time is
+simulated (bus transfers at --bus-frequency and the sensor's measurement
+duration), so the reads/sec and latency are those of the bus and sensor, not
+of this machine. A read counts as measured when it returned a temperature,
+and measured/sec only counts those.
+
+The bme680 library polls for new data 10 times, 10 ms apart, so in library
+mode no measurement is read when the measurement (mostly the heater
+duration) takes longer than about 100 ms, which the default 150 ms heater
+does. --heater-duration 50 compares the modes at a duration both measure.
+
+Usage: python benchmarks/bench_bme680_read.py [--reads 100] [--heater-duration 150]
+"""
+import argparse
+import sys
+import types
+
+import mycodo_stubs
+import simulated_i2c
+
+import bme680
+
+INPUT = 'custom_inputs/bme680 temperature error fix/mycodo_cutom_input_bme680_temperature_error_fix.py'
+OVERSAMPLES = ('OS_NONE', 'OS_1X', 'OS_2X', 'OS_4X', 'OS_8X', 'OS_16X')
+
+
+def run(module, read_mode, args):
+    clock = simulated_i2c.SimulatedClock()
+    bus = simulated_i2c.SimulatedSMBus(clock, frequency=args.bus_frequency)
+    bus.add_device(simulated_i2c.SimulatedBME680(clock))
+    clock.patch(module, bme680)
+    sys.modules['smbus2'] = types.SimpleNamespace(SMBus=lambda i2c_bus: bus)
+
+    input_dev = mycodo_stubs.InputDevice(
+        custom_options={
+            'read_mode': read_mode,
+            'temperature_oversample': args.temperature_oversample,
+            'pressure_oversample': args.pressure_oversample,
+            'humidity_oversample': args.humidity_oversample,
+            'gas_heater_duration': args.heater_duration,
+        },
+        channels=tuple(range(7)))
+    sensor = module.InputModule(input_dev, testing=True)
+    sensor.initialize_input()
+
+    transactions = bus.transactions
+    transferred = bus.bytes
+    start = clock.now
+    measured = 0
+    for _ in range(args.reads):
+        values = sensor.get_measurement()
+        if values and values[0].get('value') is not None:
+            measured += 1
+    seconds = clock.now - start
+    sensor.stop_input()
+
+    return {
+        'measured': measured,
+        'seconds': seconds,
+        'transactions': (bus.transactions - transactions) / args.reads,
+        'bytes': (bus.bytes - transferred) / args.reads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reads', type=int, default=100)
+    parser.add_argument('--heater-duration', type=int, default=150, help='gas heater duration (ms)')
+    parser.add_argument('--temperature-oversample', choices=OVERSAMPLES, default='OS_8X')
+    parser.add_argument('--pressure-oversample', choices=OVERSAMPLES, default='OS_4X')
+    parser.add_argument('--humidity-oversample', choices=OVERSAMPLES, default='OS_2X')
+    parser.add_argument('--bus-frequency', type=int, default=100000, help='I2C clock (Hz)')
+    args = parser.parse_args()
+
+    module = mycodo_stubs.load_input(INPUT)
+    print("Heater duration {} ms, {} reads".format(args.heater_duration, args.reads))
+    print("{:<10}{:>10}{:>14}{:>12}{:>16}{:>12}".format(
+        "mode", "measured", "measured/sec", "ms/read", "transactions", "bytes"))
+    for read_mode in ('library', 'burst'):
+        result = run(module, read_mode, args)
+        print("{:<10}{:>10}{:>14.1f}{:>12.1f}{:>16.1f}{:>12.1f}".format(
+            read_mode,
+            "{}/{}".format(result['measured'], args.reads),
+            result['measured'] / result['seconds'],
+            result['seconds'] / args.reads * 1000,
+            result['transactions'],
+            result['bytes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# coding=utf-8
+"""
+Read several BME680 (Temperature Error Fix) Inputs on one simulated I2C bus,
+each in its own thread and every --period seconds as Mycodo runs them, and
+report the latency of their Burst Reads.
+
+Handles:
+    separate  every Input opens its own SMBus handle, as before the Inputs
+              shared one (each Input measures on its own)
+    shared    the Inputs share one SMBus handle and batch their measurements
+
+Schedules:
+    aligned    the reads of all Inputs are due at the same time
+    staggered  the reads of the Inputs are due --stagger seconds apart, less
+               than the measurement duration, so their measurements overlap
+    mixed      aligned, but only the first Input uses Burst Read; the others
+               use Library read mode without the gas measurement, so they
+               don't batch and their reads aren't counted
+
+The simulated devices take real time (bus transfers at --bus-frequency and
+the BME680 measurement duration), so a run takes --reads times --period.
+The simulated bus doesn't model contention or bus errors, so transfers of
+separate handles overlap and no read fails from sharing the bus; only the
+latency of the reads is compared.
+
+Usage: python benchmarks/bench_i2c_bus_scheduler.py [--sensors 4] [--reads 10] [--period 1]
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+import types
+
+import mycodo_stubs
+import simulated_i2c
+
+INPUT = 'custom_inputs/bme680 temperature error fix/mycodo_cutom_input_bme680_temperature_error_fix.py'
+
+
+def run(module, handles, schedule, args):
+    clock = simulated_i2c.WallClock()
+    bus = simulated_i2c.SimulatedSMBus(clock, frequency=args.bus_frequency)
+    opened = []
+
+    def open_bus(i2c_bus):
+        opened.append(i2c_bus)
+        return bus
+
+    sys.modules['smbus2'] = types.SimpleNamespace(SMBus=open_bus)
+
+    sensors = []
+    for i in range(args.sensors):
+        address = 0x76 + i
+        bus.add_device(simulated_i2c.SimulatedBME680(clock, address=address, seed=i))
+        custom_options = {
+            'temperature_oversample': 'OS_8X',
+            'pressure_oversample': 'OS_4X',
+            'humidity_oversample': 'OS_2X',
+            'gas_heater_duration': args.heater_duration,
+        }
+        channels = tuple(range(7))
+        if schedule == 'mixed' and i:
+            custom_options['read_mode'] = 'library'
+            channels = (0, 1, 2)
+        input_dev = mycodo_stubs.InputDevice(
+            custom_options=custom_options,
+            channels=channels,
+            period=args.period,
+            i2c_location=hex(address),
+            unique_id='sensor{}'.format(i))
+        sensor = module.InputModule(input_dev, testing=True)
+        if handles == 'separate':
+            # A new registry for each Input, so none of them share a handle
+            sys.modules.pop(module.I2C_BUS_REGISTRY, None)
+        sensor.initialize_input()
+        sensors.append(sensor)
+
+    latencies = []
+    failed = []
+    first_read = time.monotonic() + 0.1
+
+    def read(index, sensor):
+        offset = index * args.stagger if schedule == 'staggered' else 0
+        for number in range(args.reads):
+            time.sleep(max(first_read + offset + number * args.period - time.monotonic(), 0))
+            start = time.perf_counter()
+            values = sensor.get_measurement()
+            if sensor.read_mode == 'burst':
+                latencies.append(time.perf_counter() - start)
+            if not values or values[0].get('value') is None:
+                failed.append(sensor)
+
+    threads = [threading.Thread(target=read, args=(index, sensor)) for index, sensor in enumerate(sensors)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for sensor in sensors:
+        sensor.stop_input()
+    sys.modules.pop(module.I2C_BUS_REGISTRY, None)
+
+    latencies.sort()
+    return {
+        'handles': len(opened),
+        'mean': statistics.mean(latencies),
+        'median': statistics.median(latencies),
+        'max': latencies[-1],
+        'failed': len(failed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=4)
+    parser.add_argument('--reads', type=int, default=10, help='reads per sensor')
+    parser.add_argument('--period', type=float, default=1, help='seconds between the reads of an Input')
+    parser.add_argument('--stagger', type=float, default=0.05,
+                        help='seconds between the reads of the Inputs in the staggered schedule')
+    parser.add_argument('--heater-duration', type=int, default=150, help='gas heater duration (ms)')
+    parser.add_argument('--bus-frequency', type=int, default=100000, help='I2C clock (Hz)')
+    args = parser.parse_args()
+
+    module = mycodo_stubs.load_input(INPUT)
+    mycodo_stubs.logging.getLogger(module.__name__).setLevel(mycodo_stubs.logging.WARNING)
+    # OS_8X temperature, OS_4X pressure, OS_2X humidity
+    print("{} sensors, {} reads each, measurement duration {:.0f} ms".format(
+        args.sensors, args.reads, module.calculate_measurement_duration(4, 3, 2, args.heater_duration) * 1000))
+    print("{:<10}{:<11}{:>9}{:>16}{:>18}{:>15}{:>10}".format(
+        "handles", "schedule", "opened", "mean read ms", "median read ms", "max read ms", "failed"))
+    for schedule in ('aligned', 'staggered', 'mixed'):
+        for handles in ('separate', 'shared'):
+            result = run(module, handles, schedule, args)
+            print("{:<10}{:<11}{:>9}{:>16.1f}{:>18.1f}{:>15.1f}{:>10}".format(
+                handles, schedule, result['handles'], result['mean'] * 1000, result['median'] * 1000,
+                result['max'] * 1000, result['failed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# coding=utf-8
+"""
+Run the BME680 (Temperature Error Fix) and BME280 Inputs against simulated
+sensors (simulated_i2c.py), first healthy, then with faults injected, and
+report reads/sec and how the Inputs recover.
+
+Faults:
+    lockup  the BME680 temperature reads 34.54 C from read --fault-at on
+    stale   the sensor's data registers stop updating from read --fault-at on
+    nack    the sensor NACKs --nack-rate of the bus transactions
+
+A read has new data when the sensor finished a measurement since the read
+before it; the BME280 measures in normal mode, so reads faster than its
+standby time return the previous measurement again. The fault runs read
+once every --period, as Mycodo would. After a fault, a read is recovered
+when the Input stores a good value from a new measurement; faulty values
+stored before that are counted as bad. Time is simulated, so reads/sec
+and recovery time are those of the bus and sensors, not of this machine.
+
+Usage: python benchmarks/bench_i2c_sensor_faults.py [--reads 100] [--fault-at 20] [--nack-rate 0.01]
+"""
+import argparse
+import sys
+import types
+
+import mycodo_stubs
+import simulated_i2c
+
+import bme680
+
+INPUTS = {
+    'bme680': 'custom_inputs/bme680 temperature error fix/mycodo_cutom_input_bme680_temperature_error_fix.py',
+    'bme280': 'custom_inputs/bme280 serial to ttn/mycodo_custom_input_bme280_ttn.py',
+}
+
+
+def setup(name, module, args, **options):
+    """
+    Initialize the Input against a simulated sensor on its own simulated bus
+    :return: (Input, simulated sensor, clock)
+    """
+    clock = simulated_i2c.SimulatedClock()
+    bus = simulated_i2c.SimulatedSMBus(clock, frequency=args.bus_frequency)
+    sys.modules['smbus2'] = types.SimpleNamespace(SMBus=lambda i2c_bus: bus)
+    if name == 'bme680':
+        device = bus.add_device(simulated_i2c.SimulatedBME680(clock))
+        clock.patch(module, bme680)
+        custom_options = {
+            'gas_heater_duration': args.heater_duration,
+            'temperature_oversample': 'OS_8X',
+            'pressure_oversample': 'OS_4X',
+            'humidity_oversample': 'OS_2X',
+        }
+        channels = tuple(range(7))
+    else:
+        from Adafruit_BME280 import BME280
+        device = bus.add_device(simulated_i2c.SimulatedBME280(clock))
+        clock.patch(module, sys.modules[BME280.__module__])
+        # No serial device is configured, so nothing is written to one
+        sys.modules.setdefault('serial', types.SimpleNamespace(Serial=None))
+        custom_options = {'serial_device': ''}
+        channels = tuple(range(6))
+    custom_options.update(options)
+
+    sensor = module.InputModule(
+        mycodo_stubs.InputDevice(custom_options=custom_options, channels=channels), testing=True)
+    sensor.initialize_input()
+    return sensor, device, clock
+
+
+def measure(sensor, clock):
+    """
+    Read the Input once
+    :return: (temperature or None, seconds the read took)
+    """
+    start = clock.now
+    try:
+        values = sensor.get_measurement()
+    except OSError:
+        values = None
+    temperature = values[0].get('value') if values else None
+    return temperature, clock.now - start
+
+
+def run_throughput(name, module, args):
+    sensor, device, clock = setup(name, module, args)
+    measured = 0
+    new_data = 0
+    seconds = 0.0
+    for _ in range(args.reads):
+        measurements = device.measurements
+        temperature, read_seconds = measure(sensor, clock)
+        seconds += read_seconds
+        if temperature is not None:
+            measured += 1
+            new_data += device.measurements > measurements
+    sensor.stop_input()
+    return {'measured': measured, 'new_data': new_data, 'seconds': seconds}
+
+
+def run_fault(name, module, fault, args):
+    sensor, device, clock = setup(name, module, args)
+    result = {'bad': 0, 'recovered_at': None, 'recovery_seconds': None}
+    last = None
+    for read in range(args.reads):
+        if read == args.fault_at:
+            setattr(device, fault, True)
+            resets = device.resets
+        clock.sleep(args.period)
+        measurements = device.measurements
+        temperature, read_seconds = measure(sensor, clock)
+        if read < args.fault_at or temperature is None:
+            last = temperature
+            continue
+        if fault == 'lockup':
+            bad = temperature == simulated_i2c.LOCKUP_TEMPERATURE
+        else:
+            bad = temperature == last
+        if not bad and device.measurements > measurements:
+            result['recovered_at'] = read - args.fault_at
+            result['recovery_seconds'] = read_seconds
+            result['resets'] = device.resets - resets
+            break
+        result['bad'] += bad
+        last = temperature
+    sensor.stop_input()
+    return result
+
+
+def run_nack(name, module, args):
+    sensor, device, clock = setup(name, module, args)
+    device.nack_rate = args.nack_rate
+    failed = 0
+    seconds = 0.0
+    for _ in range(args.reads):
+        temperature, read_seconds = measure(sensor, clock)
+        seconds += read_seconds
+        failed += temperature is None
+    sensor.stop_input()
+    return {'failed': failed, 'seconds': seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reads', type=int, default=100)
+    parser.add_argument('--fault-at', type=int, default=20, help='read the lockup and stale faults start at')
+    parser.add_argument('--nack-rate', type=float, default=0.01, help='fraction of transactions NACKed')
+    parser.add_argument('--period', type=float, default=10, help='seconds between reads in the fault runs')
+    parser.add_argument('--heater-duration', type=int, default=150, help='BME680 gas heater duration (ms)')
+    parser.add_argument('--bus-frequency', type=int, default=100000, help='I2C clock (Hz)')
+    args = parser.parse_args()
+
+    modules = {}
+    for name, path in INPUTS.items():
+        modules[name] = mycodo_stubs.load_input(path)
+        mycodo_stubs.logging.getLogger(modules[name].__name__).setLevel(mycodo_stubs.logging.WARNING)
+
+    print("Healthy sensors, {} reads".format(args.reads))
+    print("{:<10}{:>10}{:>10}{:>12}{:>12}".format("input", "measured", "new data", "reads/sec", "ms/read"))
+    for name, module in modules.items():
+        result = run_throughput(name, module, args)
+        print("{:<10}{:>10}{:>10}{:>12.1f}{:>12.1f}".format(
+            name, "{}/{}".format(result['measured'], args.reads), result['new_data'],
+            args.reads / result['seconds'], result['seconds'] / args.reads * 1000))
+
+    print()
+    print("Faults from read {}".format(args.fault_at))
+    print("{:<10}{:<8}{:>12}{:>16}{:>20}{:>8}".format(
+        "input", "fault", "bad stored", "recovered after", "recovery read ms", "resets"))
+    for name, fault in (('bme680', 'lockup'), ('bme680', 'stale'), ('bme280', 'stale')):
+        result = run_fault(name, modules[name], fault, args)
+        if result['recovered_at'] is None:
+            print("{:<10}{:<8}{:>12}{:>16}{:>20}{:>8}".format(name, fault, result['bad'], "never", "-", "-"))
+        else:
+            print("{:<10}{:<8}{:>12}{:>16}{:>20.1f}{:>8}".format(
+                name, fault, result['bad'], "{} reads".format(result['recovered_at']),
+                result['recovery_seconds'] * 1000, result['resets']))
+
+    print()
+    print("NACKs on {:.1%} of transactions, {} reads".format(args.nack_rate, args.reads))
+    print("{:<10}{:>10}{:>12}".format("input", "failed", "reads/sec"))
+    for name, module in modules.items():
+        result = run_nack(name, module, args)
+        print("{:<10}{:>10}{:>12.1f}".format(
+            name, "{}/{}".format(result['failed'], args.reads), args.reads / result['seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# coding=utf-8
+"""
+Exercise the TTN cluster selection of the TTN v3 Geiger Input against local
+stand-in clusters that add latency and fail on demand.
+
+Each --cluster is LATENCY_MS[:FAILURE_RATE[:DOWN_FROM-DOWN_TO]], e.g.
+"200:0.1:20-40" is a cluster that answers after 200 ms, fails 10% of requests
+with 503, and refuses every request from poll 20 up to poll 40. The Input polls
+--polls times, one --period apart as far as the cluster selection is concerned,
+and the requests each cluster received, the failovers, and the poll latency are
+reported.
+
+Usage:
+    python benchmarks/bench_ttn_cluster_failover.py --cluster 150 --cluster 20:0:30-60 --cluster 80:0.2
+"""
+import argparse
+import datetime
+import random
+import statistics
+import sys
+import threading
+import time
+
+import mycodo_stubs
+import bench_ttn_geiger_ingest as ingest
+
+
+class FaultyTTNStandIn(ingest.TTNStandIn):
+    """ TTN stand-in that adds latency and fails requests """
+    def __init__(self, uplinks, now, latency, failure_rate, down, seed):
+        super(FaultyTTNStandIn, self).__init__(uplinks, now)
+        self.RequestHandlerClass = FaultyTTNRequestHandler
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.down = down  # (from poll, to poll) or None
+        self.poll = 0
+        self.rng = random.Random(seed)
+        self.failures = 0
+
+
+class FaultyTTNRequestHandler(ingest.TTNRequestHandler):
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        if ((server.down and server.down[0] <= server.poll < server.down[1]) or
+                server.rng.random() < server.failure_rate):
+            server.requests += 1
+            server.failures += 1
+            self.send_error(503)
+            return
+        super(FaultyTTNRequestHandler, self).do_GET()
+
+
+def parse_cluster(value):
+    parts = value.split(':')
+    down = None
+    if len(parts) > 2 and parts[2]:
+        down = tuple(int(poll) for poll in parts[2].split('-'))
+    return float(parts[0]) / 1000, float(parts[1]) if len(parts) > 1 and parts[1] else 0.0, down
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cluster', action='append', type=parse_cluster,
+                        help='LATENCY_MS[:FAILURE_RATE[:DOWN_FROM-DOWN_TO]], in the configured order')
+    parser.add_argument('--polls', type=int, default=100)
+    parser.add_argument('--period', type=float, default=60, help='period of the Input, which sets the poll deadline')
+    args = parser.parse_args()
+    clusters = args.cluster or [parse_cluster('150'), parse_cluster('20:0:30-60'), parse_cluster('80:0.2')]
+
+    now = datetime.datetime.utcnow()
+    uplinks = [(timestamp, ingest.format_v3(timestamp, cpm, usv_h))
+               for timestamp, cpm, usv_h in ingest.synthetic_uplinks(0.1, 60, now)]
+
+    servers = []
+    for i, (latency, failure_rate, down) in enumerate(clusters):
+        server = FaultyTTNStandIn(uplinks, now, latency, failure_rate, down, seed=i)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    urls = ['http://127.0.0.1:{}'.format(server.server_address[1]) for server in servers]
+
+    sys.modules['SafecastPy'] = ingest.SafecastStandIn(0)
+    module = mycodo_stubs.load_input(ingest.INPUTS['v3'])
+    mycodo_stubs.logging.getLogger(module.__name__).setLevel(mycodo_stubs.logging.WARNING)
+    input_dev = mycodo_stubs.InputDevice(
+        custom_options={
+            'application_id': 'benchmark',
+            'app_api_key': 'benchmark',
+            'device_id': ingest.DEVICE_ID,
+            'ttn_clusters': ','.join(urls),
+            'payload_decoding': 'ttn',
+        },
+        channels=(0, 1),
+        period=args.period,
+        datetime=None)
+    geiger = module.InputModule(input_dev, testing=True)
+    geiger.initialize_input()
+
+    # Polls run back to back, but the clusters see them one period apart
+    clock = {'now': 0.0}
+    geiger.cluster_selector.clock = lambda: clock['now']
+
+    poll_seconds = []
+    failed_polls = 0
+    for poll in range(args.polls):
+        for server in servers:
+            server.poll = poll
+        start = time.perf_counter()
+        geiger.deadline.begin(args.period * module.POLL_DEADLINE_FRACTION)
+        try:
+            response = geiger.request_uplinks({'last': '3600s'})
+            if response.status_code != 200:
+                failed_polls += 1
+        except module.requests.exceptions.RequestException:
+            failed_polls += 1
+        finally:
+            geiger.deadline.end()
+        poll_seconds.append(time.perf_counter() - start)
+        clock['now'] += args.period
+
+    geiger.stop_input()
+    for server in servers:
+        server.shutdown()
+
+    print("{:<28}{:>10}{:>10}{:>10}{:>12}".format("cluster", "latency", "failure", "requests", "failures"))
+    for url, server in zip(urls, servers):
+        print("{:<28}{:>8.0f}ms{:>9.0f}%{:>10}{:>12}".format(
+            url, server.latency * 1000, server.failure_rate * 100, server.requests, server.failures))
+    poll_seconds.sort()
+    print()
+    print("Polls:             {} ({} failed on every cluster)".format(args.polls, failed_polls))
+    print("Failovers:         {}".format(geiger.metrics.counters.get('cluster failovers', 0)))
+    print("Poll latency:      mean {:.0f} ms, median {:.0f} ms, p95 {:.0f} ms, max {:.0f} ms".format(
+        statistics.mean(poll_seconds) * 1000,
+        statistics.median(poll_seconds) * 1000,
+        poll_seconds[int(len(poll_seconds) * 0.95) - 1] * 1000,
+        poll_seconds[-1] * 1000))
+    print()
+    print("Cluster selection after the last poll:")
+    print(geiger.cluster_selector.summary())
+
+
+if __name__ == '__main__':
+    main()
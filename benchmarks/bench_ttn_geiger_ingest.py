@@ -0,0 +1,312 @@
+# coding=utf-8
+"""
+Replay TTN uplinks through the Geiger counter Inputs without TTN credentials.
+
+A local HTTP server stands in for the TTN Data Storage Integration (v2 JSON or
+v3 NDJSON), Safecast, and GMC Map, and InfluxDB is replaced with a counting
+sink. The Input's first-run download is timed and the number of uplinks per
+second, peak RSS, and time spent in each stage are reported.
+
+Usage:
+    python benchmarks/bench_ttn_geiger_ingest.py --version v3 --days 7
+    python benchmarks/bench_ttn_geiger_ingest.py --version v2 --recording uplinks.json
+
+Uplinks are synthetic (one per --interval seconds over --days) unless a
+recording is given: an NDJSON file of Data Storage results for v3, or a JSON
+list of v2 query results for v2. Timestamps in a recording are served as is,
+so only uplinks from the past 7 days are requested by the Input.
+"""
+import argparse
+import base64
+import datetime
+import functools
+import http.server
+import json
+import math
+import random
+import resource
+import struct
+import sys
+import threading
+import time
+import types
+import urllib.parse
+
+import requests
+
+import mycodo_stubs
+
+INPUTS = {
+    'v2': 'custom_inputs/geiger counter/mycodo_custom_input_ttn_data_storage_geiger_counter_ttn_v2.py',
+    'v3': 'custom_inputs/geiger counter/mycodo_custom_input_ttn_data_storage_geiger_counter_ttn_v3.py',
+}
+
+DEVICE_ID = 'geiger-benchmark'
+
+
+def synthetic_uplinks(days, interval, end):
+    """
+    Generate uplinks with Poisson-like counts
+    :return: list of (datetime, cpm, usv_h), oldest first
+    """
+    rng = random.Random(0)
+    uplinks = []
+    timestamp = end - datetime.timedelta(days=days)
+    step = datetime.timedelta(seconds=interval)
+    while timestamp < end:
+        cpm = max(0, int(rng.gauss(20, 4.5)))
+        uplinks.append((timestamp, cpm, round(cpm * 0.0057, 4)))
+        timestamp += step
+    return uplinks
+
+
+def float_to_sflt16(value):
+    """ Encode a float in (-1.0, 1.0) as an LMIC SFloat16, like LMIC_f2sflt16() """
+    sign = 0x8000 if value < 0 else 0
+    mantissa, exponent = math.frexp(abs(value))
+    if not mantissa or exponent < -15:
+        return sign
+    mantissa = min(int(mantissa * 2048 + 0.5), 0x7FF)
+    return sign | ((exponent + 15) << 11) | mantissa
+
+
+def frm_payload(cpm, usv_h):
+    """ Payload the Arduino sketch sends, in mode 1 """
+    raw = struct.pack('<HHH', cpm, float_to_sflt16(usv_h / 10), 1)
+    return base64.b64encode(raw).decode()
+
+
+def format_v3(timestamp, cpm, usv_h):
+    return json.dumps({'result': {
+        'end_device_ids': {'device_id': DEVICE_ID, 'application_ids': {'application_id': 'benchmark'}},
+        'received_at': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f') + '123Z',
+        'uplink_message': {
+            'frm_payload': frm_payload(cpm, usv_h),
+            'decoded_payload': {'cpm': cpm, 'usv_h': usv_h}
+        }
+    }}).encode()
+
+
+def format_v2(timestamp, cpm, usv_h):
+    return {'device_id': DEVICE_ID, 'time': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f') + '123Z', 'cpm': cpm, 'usv_h': usv_h}
+
+
+class TTNStandIn(http.server.ThreadingHTTPServer):
+    """ Serves recorded or synthetic uplinks, filtered by the query parameters TTN accepts """
+    daemon_threads = True
+
+    def __init__(self, uplinks, now):
+        super(TTNStandIn, self).__init__(('127.0.0.1', 0), TTNRequestHandler)
+        self.uplinks = uplinks  # list of (datetime, bytes or dict)
+        self.now = now
+        self.requests = 0
+        self.gmcmap_requests = 0
+
+    def select(self, query):
+        start = datetime.datetime.min
+        end = datetime.datetime.max
+        if 'last' in query:
+            start = self.now - datetime.timedelta(seconds=float(query['last'][0].rstrip('s')))
+        if 'after' in query:
+            start = parse_time(query['after'][0])
+        if 'before' in query:
+            end = parse_time(query['before'][0])
+        return [each for timestamp, each in self.uplinks if start < timestamp <= end]
+
+
+def parse_time(value):
+    value = value.rstrip('Z')
+    if '.' in value:
+        value = value[:value.index('.') + 7]
+    return datetime.datetime.fromisoformat(value)
+
+
+class TTNRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.startswith('/log2.asp'):
+            self.server.gmcmap_requests += 1
+            self.reply(b'OK')
+        elif '/api/v3/' in url.path:
+            self.server.requests += 1
+            self.reply(b'\n'.join(self.server.select(query)))
+        elif '/api/v2/' in url.path:
+            self.server.requests += 1
+            self.reply(json.dumps(self.server.select(query)).encode())
+        else:
+            self.send_error(404)
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RedirectAdapter(requests.adapters.HTTPAdapter):
+    """ Sends every request of a session to the stand-in server, keeping the path and query """
+    def __init__(self, base_url):
+        super(RedirectAdapter, self).__init__()
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        request.url = self.base_url + url.path + ('?' + url.query if url.query else '')
+        return super(RedirectAdapter, self).send(request, **kwargs)
+
+
+class SafecastStandIn:
+    """ Stand-in for the SafecastPy module """
+    UNIT_USV = 'usv'
+    UNIT_CPM = 'cpm'
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.measurements = 0
+
+    def SafecastPy(self, api_key=None):
+        return types.SimpleNamespace(add_measurement=self.add_measurement)
+
+    def add_measurement(self, json=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.measurements += 1
+        return {'id': self.measurements}
+
+
+class StageTimes:
+    """ Accumulates the time spent in wrapped functions """
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, stage, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+                self.calls[stage] = self.calls.get(stage, 0) + 1
+        return timed
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--version', choices=sorted(INPUTS), default='v3')
+    parser.add_argument('--days', type=float, default=7, help='days of synthetic uplinks')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between synthetic uplinks')
+    parser.add_argument('--recording', help='file of recorded uplinks to serve instead')
+    parser.add_argument('--safecast', action='store_true', help='enable Safecast and GMC Map uploads')
+    parser.add_argument('--safecast-latency', type=float, default=0, help='seconds per Safecast upload')
+    parser.add_argument('--payload-decoding', choices=('ttn', 'local_uint16'), default='ttn',
+                        help='how the v3 Input decodes payloads')
+    parser.add_argument('--debug', action='store_true', help='enable debug logging of the Input')
+    args = parser.parse_args()
+
+    now = datetime.datetime.utcnow()
+    if args.recording:
+        with open(args.recording, 'rb') as recording:
+            if args.version == 'v3':
+                uplinks = [(parse_time(json.loads(line)['result']['received_at']), line.strip())
+                           for line in recording if line.strip()]
+            else:
+                uplinks = [(parse_time(each['time']), each) for each in json.load(recording)]
+        uplinks.sort(key=lambda each: each[0])
+        now = uplinks[-1][0] + datetime.timedelta(seconds=1) if uplinks else now
+    else:
+        formatter = format_v3 if args.version == 'v3' else format_v2
+        uplinks = [(timestamp, formatter(timestamp, cpm, usv_h))
+                   for timestamp, cpm, usv_h in synthetic_uplinks(args.days, args.interval, now)]
+
+    server = TTNStandIn(uplinks, now)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    safecast = SafecastStandIn(args.safecast_latency)
+    sys.modules['SafecastPy'] = safecast
+    stages = StageTimes()
+    safecast.add_measurement = stages.wrap('Safecast upload', safecast.add_measurement)
+
+    module = mycodo_stubs.load_input(INPUTS[args.version])
+    module.parse_ttn_timestamp = stages.wrap('timestamp parse', module.parse_ttn_timestamp)
+    module.json = types.SimpleNamespace(loads=stages.wrap('JSON decode', json.loads), dumps=json.dumps)
+    mycodo_stubs.logging.getLogger(module.__name__).setLevel(
+        mycodo_stubs.logging.DEBUG if args.debug else mycodo_stubs.logging.INFO)
+
+    input_dev = mycodo_stubs.InputDevice(
+        custom_options={
+            'application_id': 'benchmark',
+            'app_api_key': 'benchmark',
+            'device_id': DEVICE_ID,
+            'payload_decoding': args.payload_decoding,
+            'send_safecast': args.safecast,
+            'send_gmcmap': args.safecast,
+        },
+        channels=(0, 1),
+        datetime=None)
+    geiger = module.InputModule(input_dev, testing=True)
+    geiger.initialize_input()
+    geiger.http_session.mount('https://', RedirectAdapter(base_url))
+    geiger.http_session.mount('http://', RedirectAdapter(base_url))
+    geiger.http_session.get = stages.wrap('HTTP request', geiger.http_session.get)
+    geiger.get_conversion = stages.wrap('conversion', geiger.get_conversion)
+    geiger.influxdb_writer.add = stages.wrap('InfluxDB batch', geiger.influxdb_writer.add)
+    geiger.influxdb_writer.flush = stages.wrap('InfluxDB write', geiger.influxdb_writer.flush)
+    if hasattr(geiger, 'save_progress'):
+        geiger.save_progress = stages.wrap('checkpoint', geiger.save_progress)
+
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    geiger.get_measurement()
+    cpu_seconds = time.process_time() - cpu_start
+    elapsed = time.perf_counter() - start
+    rss_after = peak_rss_mb()
+
+    if args.safecast:
+        geiger.uploader.queue.join()
+    geiger.stop_input()
+    server.shutdown()
+
+    processed = stages.calls.get('timestamp parse', 0)
+    print("Input:             TTN {}".format(args.version))
+    print("Uplinks served:    {} ({} TTN requests)".format(len(uplinks), server.requests))
+    print("Uplinks processed: {} in {:.3f} s".format(processed, elapsed))
+    print("Uplinks/sec:       {:.0f}".format(processed / elapsed if elapsed else 0))
+    print("CPU time:          {:.3f} s ({:.1f} us per uplink)".format(
+        cpu_seconds, cpu_seconds / processed * 1e6 if processed else 0))
+    print("Peak RSS:          {:.1f} MB ({:+.1f} MB during the run)".format(rss_after, rss_after - rss_before))
+    print("InfluxDB:          {} points in {} writes".format(
+        mycodo_stubs.INFLUXDB.points, mycodo_stubs.INFLUXDB.writes))
+    if args.safecast:
+        print("Safecast:          {} measurements, {} dropped".format(
+            safecast.measurements, geiger.uploader.dropped))
+        print("GMC Map:           {} requests".format(server.gmcmap_requests))
+    print()
+    print("{:<18}{:>10}{:>12}{:>14}".format("stage", "calls", "total s", "per call us"))
+    for stage, seconds in sorted(stages.seconds.items(), key=lambda each: -each[1]):
+        calls = stages.calls[stage]
+        print("{:<18}{:>10}{:>12.3f}{:>14.1f}".format(stage, calls, seconds, seconds / calls * 1e6))
+
+    if hasattr(geiger, 'metrics'):
+        print()
+        print("Metrics reported by the Input:")
+        print(geiger.metrics.summary())
+
+
+if __name__ == '__main__':
+    main()
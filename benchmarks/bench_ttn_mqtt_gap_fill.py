@@ -0,0 +1,193 @@
+# coding=utf-8
+"""
+Run the TTN v3 Geiger Input in MQTT Push mode against a local MQTT broker
+and a local Data Storage stand-in, disconnect it, and check that the
+uplinks published while it was disconnected are filled in from Data Storage.
+
+Every uplink is published to the broker and stored by the Data Storage
+stand-in, as TTN does. The run has three phases:
+
+    live        --uplinks uplinks published while the Input is subscribed
+    gap         another client connects with the Input's client ID, which
+                makes the broker drop the Input, and --gap uplinks are
+                published before that client disconnects again
+    after       once the Input has reconnected, its next poll fills the gap
+                from Data Storage, and --uplinks more uplinks are published
+
+The time from publishing a live uplink to the Input storing it, and the
+uplinks missing or stored twice, are reported. The exit status is 1 if any
+uplink is missing or duplicated.
+
+The broker is local_mqtt_broker.py unless --broker HOST:PORT is given, e.g.
+a mosquitto started with `mosquitto -p 1883`.
+
+Usage: python benchmarks/bench_ttn_mqtt_gap_fill.py [--uplinks 20] [--gap 10] [--broker 127.0.0.1:1883]
+"""
+import argparse
+import collections
+import datetime
+import json
+import statistics
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import mycodo_stubs
+import bench_ttn_geiger_ingest as ingest
+from local_mqtt_broker import LocalMQTTBroker
+
+APPLICATION_ID = 'benchmark'
+
+
+def wait_for(condition, timeout):
+    """ Wait until condition() is true, return whether it became true """
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uplinks', type=int, default=20, help='uplinks published live, before and after the gap')
+    parser.add_argument('--gap', type=int, default=10, help='uplinks published while the Input is disconnected')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between published uplinks')
+    parser.add_argument('--broker', help='HOST:PORT of an MQTT broker to use instead of the built-in one')
+    args = parser.parse_args()
+
+    broker = None
+    if args.broker:
+        host, port = args.broker.rsplit(':', 1)
+        port = int(port)
+    else:
+        broker = LocalMQTTBroker().start()
+        host, port = '127.0.0.1', broker.port
+
+    # Uplinks from before the Input started, so its first download sets where to continue from
+    now = datetime.datetime.utcnow()
+    history = [(timestamp, ingest.format_v3(timestamp, cpm, usv_h))
+               for timestamp, cpm, usv_h in ingest.synthetic_uplinks(0.01, 60, now)]
+    storage = ingest.TTNStandIn(list(history), now)
+    threading.Thread(target=storage.serve_forever, daemon=True).start()
+
+    sys.modules['SafecastPy'] = ingest.SafecastStandIn(0)
+    module = mycodo_stubs.load_input(ingest.INPUTS['v3'])
+    mycodo_stubs.logging.getLogger(module.__name__).setLevel(mycodo_stubs.logging.WARNING)
+    input_dev = mycodo_stubs.InputDevice(
+        custom_options={
+            'application_id': APPLICATION_ID,
+            'app_api_key': 'benchmark',
+            'device_id': ingest.DEVICE_ID,
+            'ttn_clusters': 'http://127.0.0.1:{}'.format(storage.server_address[1]),
+            'poll_mode': 'mqtt',
+            'mqtt_host': host,
+            'mqtt_port': port,
+            'mqtt_use_tls': False,
+            'send_safecast': False,
+            'send_gmcmap': False,
+            'influxdb_batch_size': 1,
+        },
+        channels=(0, 1),
+        datetime=None)
+    geiger = module.InputModule(input_dev, testing=True)
+    geiger.initialize_input()
+
+    # Count every CPM point the Input stores, by uplink timestamp
+    stored = collections.Counter()
+    add = geiger.influxdb_writer.add
+
+    def count_points(points):
+        points = list(points)
+        for channel, measurement, unit, value, timestamp in points:
+            if channel == 0:
+                stored[timestamp] += 1
+        add(points)
+
+    geiger.influxdb_writer.add = count_points
+
+    # The first poll downloads the history and subscribes
+    geiger.get_measurement()
+    if not wait_for(lambda: geiger.mqtt_client.is_connected(), 10):
+        print("The Input could not connect to the MQTT broker at {}:{}".format(host, port))
+        return 1
+    # Let the subscription complete before publishing
+    time.sleep(0.2)
+
+    publisher = mqtt.Client(client_id='benchmark_publisher')
+    publisher.connect(host, port)
+    publisher.loop_start()
+    topic = 'v3/{}@ttn/devices/{}/up'.format(APPLICATION_ID, ingest.DEVICE_ID)
+    published = []
+    latencies = []
+
+    def publish(count, live):
+        for _ in range(count):
+            timestamp = datetime.datetime.utcnow()
+            uplink = ingest.format_v3(timestamp, 20, 0.114)
+            # TTN stores every uplink, and publishes it without the 'result' wrapper
+            storage.uplinks.append((timestamp, uplink))
+            published.append(timestamp)
+            start = time.perf_counter()
+            publisher.publish(topic, json.dumps(json.loads(uplink)['result'])).wait_for_publish()
+            if live and wait_for(lambda: stored[timestamp], 5):
+                latencies.append(time.perf_counter() - start)
+            time.sleep(args.interval)
+
+    publish(args.uplinks, live=True)
+
+    # Take over the Input's session, so the broker drops its connection
+    disconnected_at = time.perf_counter()
+    intruder = mqtt.Client(client_id=geiger.mqtt_client._client_id.decode())
+    intruder.connect(host, port)
+    intruder.loop_start()
+    wait_for(lambda: not geiger.mqtt_client.is_connected(), 10)
+    publish(args.gap, live=False)
+    intruder.disconnect()
+    intruder.loop_stop()
+
+    reconnected = wait_for(lambda: geiger.mqtt_client.is_connected(), 30)
+    reconnect_seconds = time.perf_counter() - disconnected_at
+    time.sleep(0.2)
+    gap_start = time.perf_counter()
+    geiger.get_measurement()
+    gap_fill_seconds = time.perf_counter() - gap_start
+
+    publish(args.uplinks, live=True)
+    wait_for(lambda: all(stored[timestamp] for timestamp in published), 5)
+
+    publisher.disconnect()
+    publisher.loop_stop()
+    geiger.stop_input()
+    storage.shutdown()
+    if broker:
+        broker.stop()
+
+    expected = [timestamp for timestamp, _ in history] + published
+    missing = [timestamp for timestamp in expected if not stored[timestamp]]
+    duplicated = [timestamp for timestamp in expected if stored[timestamp] > 1]
+
+    print("Broker:            {}".format(args.broker or "built-in ({}:{})".format(host, port)))
+    print("Uplinks:           {} history, {} live, {} during the gap".format(
+        len(history), 2 * args.uplinks, args.gap))
+    print("Stored:            {} ({} missing, {} stored twice)".format(
+        sum(1 for timestamp in expected if stored[timestamp]), len(missing), len(duplicated)))
+    if latencies:
+        latencies.sort()
+        print("Live latency:      mean {:.1f} ms, median {:.1f} ms, max {:.1f} ms ({} uplinks)".format(
+            statistics.mean(latencies) * 1000, statistics.median(latencies) * 1000,
+            latencies[-1] * 1000, len(latencies)))
+    print("Reconnect:         {}".format(
+        "{:.1f} s after the disconnect".format(reconnect_seconds) if reconnected else "not within 30 s"))
+    print("Gap fill poll:     {:.1f} ms, {} Data Storage requests in total".format(
+        gap_fill_seconds * 1000, storage.requests))
+    for timestamp in missing:
+        print("Missing:           {}".format(timestamp))
+    return 1 if missing or duplicated or not reconnected else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# coding=utf-8
+"""
+Compare parse_ttn_timestamp() of the Geiger Inputs with the strptime()
+approach it replaced, for millisecond and nanosecond TTN timestamps.
+
+Usage: python benchmarks/bench_ttn_timestamp.py [--iterations 100000]
+"""
+import argparse
+import datetime
+import timeit
+
+from mycodo_stubs import load_input
+
+GEIGER_V3 = 'custom_inputs/geiger counter/mycodo_custom_input_ttn_data_storage_geiger_counter_ttn_v3.py'
+
+TIMESTAMPS = {
+    'nanoseconds': '2021-10-30T15:04:05.123456789Z',
+    'microseconds': '2021-10-30T15:04:05.123456Z',
+    'milliseconds': '2021-10-30T15:04:05.123Z',
+}
+
+
+def parse_strptime(timestamp):
+    """ The slice and strptime() parsing previously used by the Inputs """
+    timestamp_format = '%Y-%m-%dT%H:%M:%S.%f'
+    try:
+        return datetime.datetime.strptime(timestamp[:-7], timestamp_format)
+    except:
+        try:
+            return datetime.datetime.strptime(timestamp[:-4], timestamp_format)
+        except:
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100000, help='parses timed per timestamp')
+    iterations = parser.parse_args().iterations
+    parse_ttn_timestamp = load_input(GEIGER_V3).parse_ttn_timestamp
+
+    print("{:<14}{:>14}{:>14}{:>10}  {}".format(
+        "precision", "strptime us", "parser us", "speedup", "parsed (strptime / parser)"))
+    for precision, timestamp in TIMESTAMPS.items():
+        old = timeit.timeit(lambda: parse_strptime(timestamp), number=iterations)
+        new = timeit.timeit(lambda: parse_ttn_timestamp(timestamp), number=iterations)
+        print("{:<14}{:>14.3f}{:>14.3f}{:>9.1f}x  {} / {}".format(
+            precision, old / iterations * 1e6, new / iterations * 1e6, old / new,
+            parse_strptime(timestamp), parse_ttn_timestamp(timestamp)))
+
+
+if __name__ == '__main__':
+    main()
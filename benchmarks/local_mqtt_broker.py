@@ -0,0 +1,227 @@
+# coding=utf-8
+"""
+Minimal MQTT 3.1.1 broker for benchmarks that need one on this machine
+without installing mosquitto. It supports what the TTN v3 Geiger Input and
+the benchmarks use: CONNECT (any credentials are accepted, and a client that
+connects with the client ID of a connected client takes over its session),
+SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PUBLISH at QoS 0 and 1
+(delivered at QoS 0), PINGREQ, and DISCONNECT. Sessions aren't persisted.
+"""
+import socketserver
+import struct
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    """ Whether a topic matches a subscription filter with + and # wildcards """
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_packet(packet_type, flags, body):
+    """ Fixed header (type, flags, remaining length) followed by the body """
+    header = bytearray([(packet_type << 4) | flags])
+    length = len(body)
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def encode_string(value):
+    value = value.encode()
+    return struct.pack('>H', len(value)) + value
+
+
+class Reader:
+    """ Reads the fields of a packet body in order """
+    def __init__(self, body):
+        self.body = body
+        self.offset = 0
+
+    def uint16(self):
+        value, = struct.unpack_from('>H', self.body, self.offset)
+        self.offset += 2
+        return value
+
+    def byte(self):
+        self.offset += 1
+        return self.body[self.offset - 1]
+
+    def string(self):
+        length = self.uint16()
+        self.offset += length
+        return self.body[self.offset - length:self.offset].decode()
+
+    def rest(self):
+        return self.body[self.offset:]
+
+    def more(self):
+        return self.offset < len(self.body)
+
+
+class ClientHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.client_id = None
+        self.subscriptions = set()
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def handle(self):
+        broker = self.server
+        try:
+            while not self.closed:
+                packet = self.read_packet()
+                if packet is None:
+                    break
+                packet_type, flags, body = packet
+                if packet_type == CONNECT:
+                    self.connect(Reader(body))
+                elif packet_type == PUBLISH:
+                    reader = Reader(body)
+                    topic = reader.string()
+                    qos = (flags >> 1) & 0x03
+                    if qos:
+                        self.send(encode_packet(PUBACK, 0, struct.pack('>H', reader.uint16())))
+                    broker.publish(topic, reader.rest())
+                elif packet_type == SUBSCRIBE:
+                    reader = Reader(body)
+                    packet_id = reader.uint16()
+                    granted = bytearray()
+                    while reader.more():
+                        self.subscriptions.add(reader.string())
+                        reader.byte()
+                        granted.append(0)
+                    self.send(encode_packet(SUBACK, 0, struct.pack('>H', packet_id) + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    reader = Reader(body)
+                    packet_id = reader.uint16()
+                    while reader.more():
+                        self.subscriptions.discard(reader.string())
+                    self.send(encode_packet(UNSUBACK, 0, struct.pack('>H', packet_id)))
+                elif packet_type == PINGREQ:
+                    self.send(encode_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    break
+        except OSError:
+            pass
+        finally:
+            broker.remove(self)
+
+    def connect(self, reader):
+        reader.string()  # Protocol name
+        reader.byte()  # Protocol level
+        reader.byte()  # Connect flags
+        reader.uint16()  # Keep alive
+        self.client_id = reader.string()
+        self.server.add(self)
+        self.send(encode_packet(CONNACK, 0, b'\x00\x00'))
+
+    def read_exactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def read_packet(self):
+        header = self.read_exactly(1)
+        if header is None:
+            return None
+        length = 0
+        shift = 0
+        while True:
+            byte = self.read_exactly(1)
+            if byte is None:
+                return None
+            length |= (byte[0] & 0x7F) << shift
+            shift += 7
+            if not byte[0] & 0x80:
+                break
+        body = self.read_exactly(length) if length else b''
+        if body is None:
+            return None
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    def send(self, data):
+        with self.send_lock:
+            if not self.closed:
+                self.request.sendall(data)
+
+    def close(self):
+        """ Drop the connection without a DISCONNECT, as a broker or network failure would """
+        self.closed = True
+        try:
+            self.request.shutdown(2)
+        except OSError:
+            pass
+
+
+class LocalMQTTBroker(socketserver.ThreadingTCPServer):
+    """ MQTT broker on 127.0.0.1 (port 0 picks a free port, see .port) """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        super(LocalMQTTBroker, self).__init__(('127.0.0.1', port), ClientHandler)
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.published = 0
+        self.delivered = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def add(self, client):
+        with self.lock:
+            previous = self.clients.get(client.client_id)
+            self.clients[client.client_id] = client
+        if previous is not None:
+            # Session takeover
+            previous.close()
+
+    def remove(self, client):
+        with self.lock:
+            if self.clients.get(client.client_id) is client:
+                del self.clients[client.client_id]
+
+    def publish(self, topic, payload):
+        packet = encode_packet(PUBLISH, 0, encode_string(topic) + payload)
+        with self.lock:
+            self.published += 1
+            subscribers = [client for client in self.clients.values()
+                           if any(topic_matches(each, topic) for each in client.subscriptions)]
+        for client in subscribers:
+            try:
+                client.send(packet)
+                self.delivered += 1
+            except OSError:
+                pass
+
+    def stop(self):
+        self.shutdown()
+        with self.lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.close()
+        self.server_close()
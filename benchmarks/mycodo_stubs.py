@@ -0,0 +1,175 @@
+# coding=utf-8
+"""
+Minimal stand-ins for the Mycodo and Flask-Babel modules that the custom
+Inputs import, so the Input files can be loaded and exercised outside of a
+Mycodo install. Only what the Inputs in this repository use is provided.
+"""
+import contextlib
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+REPO_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+class InfluxDBSink:
+    """ Stand-in for InfluxDB that counts the points written to it """
+    def __init__(self):
+        self.points = 0
+        self.writes = 0
+        self.seconds = 0.0
+
+    def format_influxdb_data(self, unique_id, unit, value, channel=None, measure=None, timestamp=None):
+        return unique_id, unit, value, channel, measure, timestamp
+
+    def write_influxdb_list(self, data):
+        start = time.perf_counter()
+        self.writes += 1
+        self.points += len(data)
+        self.seconds += time.perf_counter() - start
+
+
+class InputRow:
+    """ Stand-in for the row of an Input in the Mycodo settings database """
+    def __init__(self):
+        self.datetime = None
+        self.commits = 0
+
+
+class DatabaseSession:
+    """ Stand-in for a SQLAlchemy session that only knows about one Input row """
+    def __init__(self, row):
+        self.row = row
+
+    def query(self, *args):
+        return self
+
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        return self.row
+
+    def commit(self):
+        self.row.commits += 1
+
+
+INFLUXDB = InfluxDBSink()
+INPUT_ROW = InputRow()
+
+
+@contextlib.contextmanager
+def session_scope(uri):
+    yield DatabaseSession(INPUT_ROW)
+
+
+class InputDevice:
+    """ Stand-in for the Input settings passed to an InputModule """
+    def __init__(self, custom_options=None, channels=(0,), period=60, datetime=None,
+                 i2c_location='0x76', i2c_bus=1, unique_id='benchmark'):
+        self.unique_id = unique_id
+        self.custom_options = custom_options or {}
+        self.channels = channels
+        self.period = period
+        self.datetime = datetime
+        self.interface = None
+        self.i2c_location = i2c_location
+        self.i2c_bus = i2c_bus
+
+
+class AbstractInput:
+    """ Stand-in for mycodo.inputs.base_input.AbstractInput """
+    def __init__(self, input_dev, testing=False, name=__name__):
+        self.input_dev = input_dev
+        self.unique_id = input_dev.unique_id
+        self.logger = logging.getLogger(name)
+        self.running = True
+        self.return_dict = {}
+        self.channels_measurement = {
+            channel: types.SimpleNamespace(channel=channel, conversion_id='')
+            for channel in input_dev.channels}
+        self.channels_conversion = {channel: None for channel in input_dev.channels}
+
+    def setup_custom_options(self, custom_options, input_dev):
+        for each_option in custom_options:
+            if 'id' not in each_option:
+                continue
+            value = input_dev.custom_options.get(
+                each_option['id'], each_option.get('default_value'))
+            setattr(self, each_option['id'], value)
+
+    def is_enabled(self, channel):
+        return channel in self.channels_measurement
+
+    def value_set(self, channel, value, timestamp=None):
+        self.return_dict[channel]['value'] = value
+
+    def value_get(self, channel):
+        return self.return_dict[channel].get('value')
+
+    def lock_acquire(self, lockfile, timeout):
+        return True
+
+    def lock_release(self, lockfile):
+        pass
+
+    def stop_input(self):
+        self.running = False
+
+
+def install():
+    """ Register the stand-in modules in sys.modules """
+    if 'mycodo' in sys.modules:
+        return
+
+    _module('flask_babel', lazy_gettext=lambda text: text)
+
+    _module('mycodo')
+    _module('mycodo.config',
+            MYCODO_DB_PATH='sqlite://',
+            # Files the Inputs keep next to the database go to a fresh directory each run
+            SQL_DATABASE_MYCODO=os.path.join(tempfile.mkdtemp(prefix='mycodo_benchmark_'), 'mycodo.db'))
+    _module('mycodo.databases')
+    _module('mycodo.databases.models',
+            Conversion=types.SimpleNamespace(unique_id=None),
+            Input=types.SimpleNamespace(unique_id=None))
+    _module('mycodo.databases.utils', session_scope=session_scope)
+    _module('mycodo.inputs')
+    _module('mycodo.inputs.base_input', AbstractInput=AbstractInput)
+    _module('mycodo.inputs.sensorutils',
+            calculate_altitude=lambda pressure: 0.0,
+            calculate_dewpoint=lambda temperature, humidity: 0.0,
+            calculate_vapor_pressure_deficit=lambda temperature, humidity: 0.0,
+            is_device=lambda path: True)
+    _module('mycodo.utils')
+    _module('mycodo.utils.database', db_retrieve_table_daemon=lambda *args, **kwargs: None)
+    _module('mycodo.utils.influx',
+            format_influxdb_data=INFLUXDB.format_influxdb_data,
+            write_influxdb_list=INFLUXDB.write_influxdb_list)
+    _module('mycodo.utils.inputs',
+            parse_measurement=lambda conversion, measurement, measurements, channel, measurement_single, timestamp=None: measurements)
+
+
+def load_input(relative_path):
+    """
+    Load a custom Input file from this repository as a module
+    :param relative_path: path of the .py file relative to the repository root
+    """
+    install()
+    path = os.path.join(REPO_DIRECTORY, relative_path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,503 @@
+# coding=utf-8
+"""
+Simulated I2C sensors behind an SMBus-compatible interface, so the I2C
+Inputs can be exercised without hardware. With a SimulatedClock, bus
+transactions and measurements advance the clock instead of sleeping, and
+the clock's sleep() is patched into the modules under test; with a
+WallClock they take real time, so Inputs can run in threads.
+
+The sensors measure a configurable environment with noise, take the
+measurement durations of their datasheets, and can inject faults:
+
+    nack_rate  fraction of transactions the sensor NACKs
+    stale      the data registers stop updating, new data is still flagged
+    lockup     (BME680) temperature reads 34.54 C while the other values update
+
+stale and lockup last until the sensor is soft reset.
+"""
+import random
+import time
+import types
+
+import bme680
+from bme680 import constants
+
+LOCKUP_TEMPERATURE = 34.54
+
+
+class SimulatedClock:
+    """ Stand-in for the time module that only advances when asked to """
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def monotonic(self):
+        return self.now
+
+    time = perf_counter = monotonic
+
+    def patch(self, *modules):
+        """ Replace the time module imported by each module with this clock """
+        for module in modules:
+            module.time = self
+
+
+class WallClock:
+    """ Clock of the simulated devices that follows real time, for benchmarks with threads """
+    @property
+    def now(self):
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(max(seconds, 0))
+
+    def patch(self, *modules):
+        pass
+
+
+class SimulatedSMBus:
+    """
+    SMBus-compatible bus that routes transactions to the simulated devices
+    at their addresses and counts them. Each transaction advances the clock
+    by the time its bytes take at the bus frequency (9 clocks per byte), and
+    raises OSError (Remote I/O error) when no device, or a device injecting
+    NACKs, is at the address.
+    """
+    def __init__(self, clock, frequency=100000):
+        self.clock = clock
+        self.frequency = frequency
+        self.devices = {}
+        self.transactions = 0
+        self.bytes = 0
+
+    def add_device(self, device):
+        self.devices[device.address] = device
+        return device
+
+    def _transfer(self, address, length):
+        self.transactions += 1
+        self.bytes += length
+        self.clock.sleep(length * 9 / self.frequency)
+        device = self.devices.get(address)
+        if device is None or device.nacks():
+            raise OSError(121, 'Remote I/O error')
+        return device
+
+    def read_byte(self, address):
+        return self._transfer(address, 2).read(None, 1)[0]
+
+    def write_byte(self, address, value):
+        self._transfer(address, 2).write(None, [value])
+
+    def read_byte_data(self, address, register):
+        # Address + register, repeated start + address, data
+        return self._transfer(address, 4).read(register, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        self._transfer(address, 3).write(register, [value])
+
+    def read_word_data(self, address, register):
+        low, high = self._transfer(address, 5).read(register, 2)
+        return low | (high << 8)
+
+    def write_word_data(self, address, register, value):
+        self._transfer(address, 4).write(register, [value & 0xFF, value >> 8])
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._transfer(address, 3 + length).read(register, length)
+
+    def write_i2c_block_data(self, address, register, values):
+        self._transfer(address, 2 + len(values)).write(register, values)
+
+    def close(self):
+        pass
+
+
+def _word(registers, lsb, value):
+    """ Store a 16-bit value little-endian, as the calibration registers are """
+    registers[lsb] = value & 0xFF
+    registers[lsb + 1] = (value >> 8) & 0xFF
+
+
+def _search(function, target, low, high, increasing=True):
+    """
+    Smallest integer in [low, high) at which the monotonic function reaches
+    target, or high - 1 if it doesn't (the ADC saturates)
+    """
+    limit = high - 1
+    while low < high - 1:
+        middle = (low + high) // 2
+        if (function(middle) < target) == increasing:
+            low = middle
+        else:
+            high = middle
+    return min(high, limit)
+
+
+class SimulatedSensor:
+    """
+    Register map of a sensor that measures the environment it is given.
+    Subclasses set up the registers in _reset(), start measurements in
+    _write_register(), and write the data registers in _store_measurement().
+    """
+    def __init__(self, clock, address, environment, noise=0.002, seed=0):
+        self.clock = clock
+        self.address = address
+        self.environment = environment
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.registers = bytearray(256)
+        self.pointer = 0
+        self.measurements = 0
+        self.resets = 0
+        self.nack_rate = 0.0
+        self.stale = False
+        self.lockup = False
+        self._reset()
+
+    def nacks(self):
+        return bool(self.nack_rate) and self.rng.random() < self.nack_rate
+
+    def soft_reset(self):
+        """ Reset the registers and clear the stale and lockup faults """
+        self.resets += 1
+        self.stale = False
+        self.lockup = False
+        self._reset()
+
+    def _reset(self):
+        raise NotImplementedError
+
+    def _update(self):
+        """ Finish the measurements due by now """
+
+    def _write_register(self, register, value):
+        self.registers[register] = value
+
+    def _sample(self):
+        return {name: value * (1 + self.rng.uniform(-self.noise, self.noise))
+                for name, value in self.environment.items()}
+
+    def _measure(self):
+        """ Store a new measurement, unless the sensor is stale """
+        self.measurements += 1
+        if not self.stale:
+            self._store_measurement(self._sample())
+
+    def _store_measurement(self, values):
+        raise NotImplementedError
+
+    def read(self, register, length):
+        self._update()
+        if register is None:
+            register = self.pointer
+        self.pointer = register + length
+        return list(self.registers[register:register + length])
+
+    def write(self, register, values):
+        self._update()
+        if register is None:
+            # A write without data only sets the register pointer
+            self.pointer = values[0]
+            return
+        for offset, value in enumerate(values):
+            self._write_register(register + offset, value)
+
+
+class SimulatedBME680(SimulatedSensor):
+    """
+    BME680 that measures in forced mode with the measurement duration of
+    the Bosch API. A forced mode write to ctrl_meas clears new_data, and the
+    data registers only hold the new measurement once its duration has
+    passed.
+    """
+    # Calibration of a BME680 (the compensation only needs plausible values)
+    CALIBRATION = {
+        'par_t1': 26024, 'par_t2': 26478, 'par_t3': 3,
+        'par_p1': 36154, 'par_p2': -10490, 'par_p3': 88, 'par_p4': 6960, 'par_p5': -115,
+        'par_p6': 30, 'par_p7': 29, 'par_p8': -1467, 'par_p9': -3096, 'par_p10': 30,
+        'par_h1': 797, 'par_h2': 1017, 'par_h3': 0, 'par_h4': 45, 'par_h5': 20, 'par_h6': 120, 'par_h7': -100,
+        'par_gh1': -30, 'par_gh2': -12336, 'par_gh3': 18,
+    }
+
+    def __init__(self, clock, address=0x76, temperature=22.0, humidity=45.0, pressure=1013.25,
+                 gas_resistance=120000, noise=0.002, seed=0):
+        self.ready_at = None
+        self.compensation = self._compensation()
+        super(SimulatedBME680, self).__init__(
+            clock, address,
+            {'temperature': temperature, 'humidity': humidity, 'pressure': pressure,
+             'gas_resistance': gas_resistance},
+            noise=noise, seed=seed)
+
+    def _calibration_registers(self):
+        """ Calibration registers as the one array the bme680 library reads them into """
+        c = self.CALIBRATION
+        calibration = [0] * (constants.COEFF_ADDR1_LEN + constants.COEFF_ADDR2_LEN)
+        for name, register in (('par_t1', constants.T1_LSB_REG), ('par_t2', constants.T2_LSB_REG),
+                               ('par_p1', constants.P1_LSB_REG), ('par_p2', constants.P2_LSB_REG),
+                               ('par_p4', constants.P4_LSB_REG), ('par_p5', constants.P5_LSB_REG),
+                               ('par_p8', constants.P8_LSB_REG), ('par_p9', constants.P9_LSB_REG),
+                               ('par_gh2', constants.GH2_LSB_REG)):
+            _word(calibration, register, c[name])
+        for name, register in (('par_t3', constants.T3_REG), ('par_p3', constants.P3_REG),
+                               ('par_p6', constants.P6_REG), ('par_p7', constants.P7_REG),
+                               ('par_p10', constants.P10_REG), ('par_h3', constants.H3_REG),
+                               ('par_h4', constants.H4_REG), ('par_h5', constants.H5_REG),
+                               ('par_h6', constants.H6_REG), ('par_h7', constants.H7_REG),
+                               ('par_gh1', constants.GH1_REG), ('par_gh3', constants.GH3_REG)):
+            calibration[register] = c[name] & 0xFF
+        calibration[constants.H1_MSB_REG] = c['par_h1'] >> 4
+        calibration[constants.H1_LSB_REG] = (c['par_h1'] & 0x0F) | ((c['par_h2'] & 0x0F) << 4)
+        calibration[constants.H2_MSB_REG] = c['par_h2'] >> 4
+        return calibration
+
+    def _compensation(self):
+        """ Object the bme680 library's compensation functions can run on """
+        compensation = types.SimpleNamespace(
+            calibration_data=constants.CalibrationData(),
+            offset_temp_in_t_fine=0,
+            _variant=constants.VARIANT_LOW)
+        compensation.calibration_data.set_from_array(self._calibration_registers())
+        compensation.calibration_data.set_other(0x10, 42, 0)
+        for name in ('_calc_temperature', '_calc_pressure', '_calc_humidity', '_calc_gas_resistance_low'):
+            setattr(compensation, name, getattr(bme680.BME680, name).__get__(compensation))
+        return compensation
+
+    def _reset(self):
+        """ Power on / soft reset state of the registers """
+        self.registers[:] = bytes(256)
+        calibration = self._calibration_registers()
+        self.registers[constants.COEFF_ADDR1:constants.COEFF_ADDR1 + constants.COEFF_ADDR1_LEN] = \
+            bytes(calibration[:constants.COEFF_ADDR1_LEN])
+        self.registers[constants.COEFF_ADDR2:constants.COEFF_ADDR2 + constants.COEFF_ADDR2_LEN] = \
+            bytes(calibration[constants.COEFF_ADDR1_LEN:])
+        self.registers[constants.ADDR_RES_HEAT_VAL_ADDR] = 42
+        self.registers[constants.ADDR_RES_HEAT_RANGE_ADDR] = 0x10
+        self.registers[constants.CHIP_ID_ADDR] = constants.CHIP_ID
+        self.registers[constants.CHIP_VARIANT_ADDR] = constants.VARIANT_LOW
+        self.ready_at = None
+
+    def measurement_seconds(self):
+        """ Measurement duration of the configured oversampling and heater, as in the Bosch API """
+        cycles = (0, 1, 2, 4, 8, 16, 16, 16)
+        ctrl_meas = self.registers[constants.CONF_T_P_MODE_ADDR]
+        meas_cycles = (cycles[ctrl_meas >> 5] + cycles[(ctrl_meas >> 2) & 0x07] +
+                       cycles[self.registers[constants.CONF_OS_H_ADDR] & 0x07])
+        duration_ms = (meas_cycles * 1963 + 477 * 4 + 477 * 5 + 500) // 1000 + 1
+        ctrl_gas_1 = self.registers[constants.CONF_ODR_RUN_GAS_NBC_ADDR]
+        if ctrl_gas_1 & constants.RUN_GAS_MSK:
+            gas_wait = self.registers[constants.GAS_WAIT0_ADDR + (ctrl_gas_1 & constants.NBCONV_MSK)]
+            duration_ms += (gas_wait & 0x3F) * 4 ** (gas_wait >> 6)
+        return duration_ms / 1000
+
+    def _adc(self, values):
+        """ Raw ADC values the compensation turns into the values """
+        compensation = self.compensation
+        adc_temp = _search(compensation._calc_temperature, values['temperature'] * 100, 0, 1 << 20)
+        compensation._calc_temperature(adc_temp)  # Sets t_fine for pressure and humidity
+        adc_pres = _search(compensation._calc_pressure, values['pressure'] * 100, 0, 1 << 20, increasing=False)
+        adc_hum = _search(compensation._calc_humidity, values['humidity'] * 1000, 0, 1 << 16)
+        # The lowest range that reaches down to the resistance
+        gas_range = 0
+        while gas_range < 15 and compensation._calc_gas_resistance_low(1023, gas_range) > values['gas_resistance']:
+            gas_range += 1
+        adc_gas = _search(lambda adc: compensation._calc_gas_resistance_low(adc, gas_range),
+                          values['gas_resistance'], 0, 1023, increasing=False)
+        return adc_temp, adc_pres, adc_hum, adc_gas, gas_range
+
+    def _store_measurement(self, values):
+        if self.lockup:
+            values['temperature'] = LOCKUP_TEMPERATURE
+        adc_temp, adc_pres, adc_hum, adc_gas, gas_range = self._adc(values)
+        # Measurements skipped with oversampling OS_NONE read the reset value
+        ctrl_meas = self.registers[constants.CONF_T_P_MODE_ADDR]
+        if not ctrl_meas >> 5:
+            adc_temp = 0x80000
+        if not (ctrl_meas >> 2) & 0x07:
+            adc_pres = 0x80000
+        if not self.registers[constants.CONF_OS_H_ADDR] & 0x07:
+            adc_hum = 0x8000
+        field = bytearray(constants.FIELD_LENGTH)
+        field[1] = self.measurements & 0xFF
+        field[2:5] = (adc_pres >> 12, (adc_pres >> 4) & 0xFF, (adc_pres & 0x0F) << 4)
+        field[5:8] = (adc_temp >> 12, (adc_temp >> 4) & 0xFF, (adc_temp & 0x0F) << 4)
+        field[8:10] = (adc_hum >> 8, adc_hum & 0xFF)
+        if self.registers[constants.CONF_ODR_RUN_GAS_NBC_ADDR] & constants.RUN_GAS_MSK:
+            gas_lsb = ((adc_gas & 0x03) << 6) | constants.GASM_VALID_MSK | constants.HEAT_STAB_MSK | gas_range
+            field[13:15] = (adc_gas >> 2, gas_lsb)
+            field[15:17] = (adc_gas >> 2, gas_lsb)
+        self.registers[constants.FIELD0_ADDR:constants.FIELD0_ADDR + constants.FIELD_LENGTH] = field
+
+    def _update(self):
+        if self.ready_at is not None and self.clock.now >= self.ready_at:
+            self.ready_at = None
+            self._measure()
+            ctrl_gas_1 = self.registers[constants.CONF_ODR_RUN_GAS_NBC_ADDR]
+            self.registers[constants.FIELD0_ADDR] = constants.NEW_DATA_MSK | (ctrl_gas_1 & constants.NBCONV_MSK)
+            # Back to sleep mode
+            self.registers[constants.CONF_T_P_MODE_ADDR] &= ~constants.MODE_MSK & 0xFF
+
+    def _write_register(self, register, value):
+        if register == constants.SOFT_RESET_ADDR:
+            if value == constants.SOFT_RESET_CMD:
+                self.soft_reset()
+            return
+        self.registers[register] = value
+        if register == constants.CONF_T_P_MODE_ADDR and value & constants.MODE_MSK == constants.FORCED_MODE:
+            # Measuring: new_data is cleared until the measurement finishes
+            self.registers[constants.FIELD0_ADDR] &= ~constants.NEW_DATA_MSK & 0xFF
+            self.ready_at = self.clock.now + self.measurement_seconds()
+
+
+class SimulatedBME280(SimulatedSensor):
+    """
+    BME280 that measures in normal mode (every measurement duration plus
+    standby time) or forced mode, with the maximum measurement duration of
+    the datasheet (section 9.1), and sets the measuring bit of the status
+    register while it converts
+    """
+    CHIP_ID = 0x60
+    CALIB_ADDR = 0x88
+    HUM_CALIB_ADDR = 0xE1
+    SOFT_RESET_ADDR = 0xE0
+    CTRL_HUM_ADDR = 0xF2
+    STATUS_ADDR = 0xF3
+    CTRL_MEAS_ADDR = 0xF4
+    CONFIG_ADDR = 0xF5
+    DATA_ADDR = 0xF7
+    MEASURING = 0x08
+    STANDBY_MS = (0.5, 62.5, 125, 250, 500, 1000, 10, 20)
+
+    # Calibration of a BME280 (the compensation only needs plausible values)
+    CALIBRATION = {
+        'dig_T1': 27504, 'dig_T2': 26435, 'dig_T3': -1000,
+        'dig_P1': 36477, 'dig_P2': -10685, 'dig_P3': 3024, 'dig_P4': 2855, 'dig_P5': 140,
+        'dig_P6': -7, 'dig_P7': 15500, 'dig_P8': -14600, 'dig_P9': 6000,
+        'dig_H1': 75, 'dig_H2': 362, 'dig_H3': 0, 'dig_H4': 313, 'dig_H5': 50, 'dig_H6': 30,
+    }
+
+    def __init__(self, clock, address=0x76, temperature=22.0, humidity=45.0, pressure=1013.25,
+                 noise=0.002, seed=0):
+        self.cycle_start = None
+        self.ready_at = None
+        super(SimulatedBME280, self).__init__(
+            clock, address,
+            {'temperature': temperature, 'humidity': humidity, 'pressure': pressure},
+            noise=noise, seed=seed)
+
+    def _reset(self):
+        self.registers[:] = bytes(256)
+        c = self.CALIBRATION
+        for i, name in enumerate(('dig_T1', 'dig_T2', 'dig_T3', 'dig_P1', 'dig_P2', 'dig_P3',
+                                  'dig_P4', 'dig_P5', 'dig_P6', 'dig_P7', 'dig_P8', 'dig_P9')):
+            _word(self.registers, self.CALIB_ADDR + 2 * i, c[name])
+        self.registers[0xA1] = c['dig_H1']
+        _word(self.registers, self.HUM_CALIB_ADDR, c['dig_H2'])
+        self.registers[0xE3] = c['dig_H3']
+        self.registers[0xE4] = (c['dig_H4'] >> 4) & 0xFF
+        self.registers[0xE5] = (c['dig_H4'] & 0x0F) | ((c['dig_H5'] & 0x0F) << 4)
+        self.registers[0xE6] = (c['dig_H5'] >> 4) & 0xFF
+        self.registers[0xE7] = c['dig_H6'] & 0xFF
+        self.registers[0xD0] = self.CHIP_ID
+        # Skipped measurements read 0x80000
+        self.registers[self.DATA_ADDR:self.DATA_ADDR + 8] = bytes((0x80, 0, 0, 0x80, 0, 0, 0x80, 0))
+        self.cycle_start = None
+        self.ready_at = None
+
+    def measurement_seconds(self):
+        """ Maximum measurement duration of the configured oversampling """
+        oversamples = (0, 1, 2, 4, 8, 16, 16, 16)
+        ctrl_meas = self.registers[self.CTRL_MEAS_ADDR]
+        duration_ms = 1.25 + 2.3 * oversamples[ctrl_meas >> 5]
+        pressure_oversample = oversamples[(ctrl_meas >> 2) & 0x07]
+        if pressure_oversample:
+            duration_ms += 2.3 * pressure_oversample + 0.575
+        humidity_oversample = oversamples[self.registers[self.CTRL_HUM_ADDR] & 0x07]
+        if humidity_oversample:
+            duration_ms += 2.3 * humidity_oversample + 0.575
+        return duration_ms / 1000
+
+    def _compensate(self, adc_t, adc_p, adc_h):
+        """ Floating point compensation of the datasheet (section 8.1) """
+        c = self.CALIBRATION
+        var1 = (adc_t / 16384.0 - c['dig_T1'] / 1024.0) * c['dig_T2']
+        var2 = ((adc_t / 131072.0 - c['dig_T1'] / 8192.0) ** 2) * c['dig_T3']
+        t_fine = var1 + var2
+        temperature = t_fine / 5120.0
+
+        pressure = None
+        if adc_p is not None:
+            var1 = t_fine / 2.0 - 64000.0
+            var2 = var1 * var1 * c['dig_P6'] / 32768.0
+            var2 = var2 + var1 * c['dig_P5'] * 2.0
+            var2 = var2 / 4.0 + c['dig_P4'] * 65536.0
+            var1 = (c['dig_P3'] * var1 * var1 / 524288.0 + c['dig_P2'] * var1) / 524288.0
+            var1 = (1.0 + var1 / 32768.0) * c['dig_P1']
+            pressure = 1048576.0 - adc_p
+            pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
+            var1 = c['dig_P9'] * pressure * pressure / 2147483648.0
+            var2 = pressure * c['dig_P8'] / 32768.0
+            pressure = pressure + (var1 + var2 + c['dig_P7']) / 16.0
+
+        humidity = None
+        if adc_h is not None:
+            h = t_fine - 76800.0
+            h = ((adc_h - (c['dig_H4'] * 64.0 + c['dig_H5'] / 16384.0 * h)) *
+                 (c['dig_H2'] / 65536.0 * (1.0 + c['dig_H6'] / 67108864.0 * h * (1.0 + c['dig_H3'] / 67108864.0 * h))))
+            humidity = h * (1.0 - c['dig_H1'] * h / 524288.0)
+
+        return temperature, pressure, humidity
+
+    def _store_measurement(self, values):
+        adc_t = _search(lambda adc: self._compensate(adc, None, None)[0], values['temperature'], 0, 1 << 20)
+        adc_p = _search(lambda adc: self._compensate(adc_t, adc, None)[1], values['pressure'] * 100,
+                        0, 1 << 20, increasing=False)
+        adc_h = _search(lambda adc: self._compensate(adc_t, None, adc)[2], values['humidity'], 0, 1 << 16)
+        self.registers[self.DATA_ADDR:self.DATA_ADDR + 8] = bytes((
+            adc_p >> 12, (adc_p >> 4) & 0xFF, (adc_p & 0x0F) << 4,
+            adc_t >> 12, (adc_t >> 4) & 0xFF, (adc_t & 0x0F) << 4,
+            adc_h >> 8, adc_h & 0xFF))
+
+    def _update(self):
+        now = self.clock.now
+        measuring = False
+        if self.ready_at is not None:
+            # Forced mode
+            if now >= self.ready_at:
+                self.ready_at = None
+                self._measure()
+                self.registers[self.CTRL_MEAS_ADDR] &= 0xFC
+            else:
+                measuring = True
+        elif self.cycle_start is not None:
+            # Normal mode: measure, then stand by, repeatedly
+            measurement = self.measurement_seconds()
+            cycle = measurement + self.STANDBY_MS[self.registers[self.CONFIG_ADDR] >> 5] / 1000
+            while now >= self.cycle_start + measurement:
+                self._measure()
+                self.cycle_start += cycle
+            measuring = now >= self.cycle_start
+        if measuring:
+            self.registers[self.STATUS_ADDR] |= self.MEASURING
+        else:
+            self.registers[self.STATUS_ADDR] &= ~self.MEASURING & 0xFF
+
+    def _write_register(self, register, value):
+        if register == self.SOFT_RESET_ADDR:
+            if value == 0xB6:
+                self.soft_reset()
+            return
+        self.registers[register] = value
+        if register == self.CTRL_MEAS_ADDR:
+            mode = value & 0x03
+            self.cycle_start = None
+            self.ready_at = None
+            if mode == 0x03:
+                self.cycle_start = self.clock.now
+            elif mode:
+                self.ready_at = self.clock.now + self.measurement_seconds()
+        self._update()
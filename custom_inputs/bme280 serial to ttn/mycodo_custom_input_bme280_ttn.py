@@ -13,7 +13,10 @@
 # Author: Tony DiCola
 # Based on the BMP280 driver with BME280 changes provided by
 # David J Taylor, Edinburgh (www.satsignal.eu)
+import sys
+import threading
 import time
+import types
 
 from flask_babel import lazy_gettext
 
@@ -22,6 +25,14 @@ from mycodo.inputs.sensorutils import calculate_altitude
 from mycodo.inputs.sensorutils import calculate_dewpoint
 from mycodo.inputs.sensorutils import calculate_vapor_pressure_deficit
 
+# Name of the module, registered in sys.modules, that holds the I2C bus
+# schedulers shared by the Inputs on the same bus
+I2C_BUS_REGISTRY = 'mycodo_custom_input_i2c_bus_schedulers'
+
+# Seconds a measurement waits for the measurements of other Inputs on the bus
+# to be batched with it
+I2C_BATCH_WINDOW = 0.02
+
 # Measurements
 measurements_dict = {
     0: {
@@ -81,6 +92,7 @@ INPUT_INFORMATION = {
     'dependencies_module': [
         ('pip-pypi', 'serial', 'pyserial'),
         ('pip-pypi', 'Adafruit_GPIO', 'Adafruit_GPIO'),
+        ('pip-pypi', 'smbus2', 'smbus2'),
         ('pip-git', 'Adafruit_BME280', 'git://github.com/adafruit/Adafruit_Python_BME280.git#egg=adafruit-bme280')
     ],
 
@@ -103,6 +115,261 @@ INPUT_INFORMATION = {
 }
 
 
+class BusMeasurement:
+    """ A measurement waiting to be made by an I2CBusScheduler """
+    def __init__(self, start, seconds, read, user=None):
+        self.start = start
+        self.seconds = seconds
+        self.read = read
+        self.user = user
+        self.ready_at = None
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class I2CBusScheduler:
+    """
+    Owns the one SMBus handle of an I2C bus for all Inputs on it
+
+    Every SMBus call is made under one lock, so the transactions of the
+    Inputs don't interleave. Measurements that have to be started, waited
+    for, and read (see measure()) are batched: when another Input that
+    batches its measurements (see add_batching_user()) is due within
+    I2C_BATCH_WINDOW, the first measurement waits for it, and the
+    measurements requested in that time are started, waited for once, and
+    read together. Batches run concurrently, so a measurement requested
+    while another batch is running doesn't wait for it.
+    """
+    def __init__(self, smbus):
+        self.smbus = smbus
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = []
+        self.collecting = False
+        self.users = 0
+        # [period, time of the next measurement] of each Input that batches
+        self.batching_users = {}
+        self.transactions = 0
+
+    def transaction(self, function, *args):
+        with self.lock:
+            self.transactions += 1
+            return function(*args)
+
+    # SMBus methods used by the sensor libraries
+    def read_byte(self, i2c_addr):
+        return self.transaction(self.smbus.read_byte, i2c_addr)
+
+    def write_byte(self, i2c_addr, value):
+        return self.transaction(self.smbus.write_byte, i2c_addr, value)
+
+    def read_byte_data(self, i2c_addr, register):
+        return self.transaction(self.smbus.read_byte_data, i2c_addr, register)
+
+    def write_byte_data(self, i2c_addr, register, value):
+        return self.transaction(self.smbus.write_byte_data, i2c_addr, register, value)
+
+    def read_word_data(self, i2c_addr, register):
+        return self.transaction(self.smbus.read_word_data, i2c_addr, register)
+
+    def write_word_data(self, i2c_addr, register, value):
+        return self.transaction(self.smbus.write_word_data, i2c_addr, register, value)
+
+    def read_i2c_block_data(self, i2c_addr, register, length):
+        return self.transaction(self.smbus.read_i2c_block_data, i2c_addr, register, length)
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        return self.transaction(self.smbus.write_i2c_block_data, i2c_addr, register, data)
+
+    def add_batching_user(self, user, period):
+        """
+        Count an Input as one that measures with measure() every period
+        seconds, so the measurements of the others wait for it when it's due
+        """
+        with self.condition:
+            self.batching_users[user] = [period, None]
+
+    def remove_batching_user(self, user):
+        with self.condition:
+            self.batching_users.pop(user, None)
+
+    def batching_user_due(self, user):
+        """
+        Whether an Input that batches, other than user, is due to measure
+        within I2C_BATCH_WINDOW and hasn't requested its measurement yet.
+        Must be called with self.condition held.
+        """
+        now = time.monotonic()
+        pending = [each.user for each in self.pending]
+        for other, (_, due) in self.batching_users.items():
+            if other is user or other in pending:
+                continue
+            # An Input that hasn't measured yet may be due at any time
+            if due is None or abs(due - now) <= I2C_BATCH_WINDOW:
+                return True
+        return False
+
+    def measure(self, start, seconds, read, user=None):
+        """
+        Start a measurement, wait for it to finish, and read it, together
+        with the measurements other Inputs on the bus request at the same time
+        :param start: function that starts the measurement
+        :param seconds: float, time the measurement takes
+        :param read: function that reads the finished measurement
+        :param user: the Input measuring, if it was added with add_batching_user()
+        :return: what read returns
+        """
+        measurement = BusMeasurement(start, seconds, read, user)
+        with self.condition:
+            if user in self.batching_users:
+                self.batching_users[user][1] = time.monotonic() + self.batching_users[user][0]
+            self.pending.append(measurement)
+            # Join the batch being collected, or collect the next one
+            while not measurement.done and (self.collecting or measurement not in self.pending):
+                self.condition.wait()
+            leading = not measurement.done
+            if leading:
+                self.collecting = True
+                wait = self.batching_user_due(user)
+
+        if leading:
+            try:
+                if wait:
+                    # Let the other Inputs due in the same tick join the batch
+                    time.sleep(I2C_BATCH_WINDOW)
+            finally:
+                with self.condition:
+                    batch = self.pending
+                    self.pending = []
+                    self.collecting = False
+            try:
+                self.run_batch(batch)
+            finally:
+                with self.condition:
+                    self.condition.notify_all()
+
+        if measurement.error:
+            raise measurement.error
+        return measurement.result
+
+    @staticmethod
+    def run_batch(batch):
+        started = []
+        for measurement in batch:
+            try:
+                measurement.start()
+                measurement.ready_at = time.monotonic() + measurement.seconds
+                started.append(measurement)
+            except Exception as err:
+                measurement.error = err
+
+        for measurement in sorted(started, key=lambda each: each.ready_at):
+            time.sleep(max(measurement.ready_at - time.monotonic(), 0))
+            try:
+                measurement.result = measurement.read()
+            except Exception as err:
+                measurement.error = err
+
+        for measurement in batch:
+            measurement.done = True
+
+
+def get_i2c_bus_scheduler(bus, open_bus):
+    """
+    Return the scheduler of an I2C bus and count the caller as one of its users
+
+    Mycodo loads each Input from its file as a separate module, so module
+    globals aren't shared between Inputs. The schedulers are instead kept
+    in a module registered in sys.modules.
+    :param bus: int, I2C bus number
+    :param open_bus: function(bus) that opens an SMBus handle, if the bus has none yet
+    :return: I2CBusScheduler
+    """
+    new_registry = types.ModuleType(I2C_BUS_REGISTRY)
+    new_registry.lock = threading.Lock()
+    new_registry.schedulers = {}
+    registry = sys.modules.setdefault(I2C_BUS_REGISTRY, new_registry)
+    with registry.lock:
+        if bus not in registry.schedulers:
+            registry.schedulers[bus] = I2CBusScheduler(open_bus(bus))
+        scheduler = registry.schedulers[bus]
+        scheduler.users += 1
+        return scheduler
+
+
+def release_i2c_bus_scheduler(bus):
+    """ Stop using the scheduler of an I2C bus, closing the bus after its last user """
+    registry = sys.modules.get(I2C_BUS_REGISTRY)
+    if registry is None:
+        return
+    with registry.lock:
+        scheduler = registry.schedulers.get(bus)
+        if scheduler is None:
+            return
+        scheduler.users -= 1
+        if scheduler.users <= 0:
+            del registry.schedulers[bus]
+            scheduler.smbus.close()
+
+
+class AdafruitI2CDevice:
+    """
+    Adafruit_GPIO.I2C.Device that makes its transactions through an
+    I2CBusScheduler, for Adafruit drivers to share the bus with other Inputs
+    """
+    def __init__(self, scheduler, address):
+        self.scheduler = scheduler
+        self._address = address
+
+    def writeRaw8(self, value):
+        self.scheduler.write_byte(self._address, value & 0xFF)
+
+    def write8(self, register, value):
+        self.scheduler.write_byte_data(self._address, register, value & 0xFF)
+
+    def write16(self, register, value):
+        self.scheduler.write_word_data(self._address, register, value & 0xFFFF)
+
+    def writeList(self, register, data):
+        self.scheduler.write_i2c_block_data(self._address, register, data)
+
+    def readList(self, register, length):
+        return self.scheduler.read_i2c_block_data(self._address, register, length)
+
+    def readRaw8(self):
+        return self.scheduler.read_byte(self._address) & 0xFF
+
+    def readU8(self, register):
+        return self.scheduler.read_byte_data(self._address, register) & 0xFF
+
+    def readS8(self, register):
+        result = self.readU8(register)
+        return result - 256 if result > 127 else result
+
+    def readU16(self, register, little_endian=True):
+        result = self.scheduler.read_word_data(self._address, register) & 0xFFFF
+        if not little_endian:
+            result = ((result << 8) & 0xFF00) + (result >> 8)
+        return result
+
+    def readS16(self, register, little_endian=True):
+        result = self.readU16(register, little_endian)
+        return result - 65536 if result > 32767 else result
+
+    def readU16LE(self, register):
+        return self.readU16(register, little_endian=True)
+
+    def readU16BE(self, register):
+        return self.readU16(register, little_endian=False)
+
+    def readS16LE(self, register):
+        return self.readS16(register, little_endian=True)
+
+    def readS16BE(self, register):
+        return self.readS16(register, little_endian=False)
+
+
 class InputModule(AbstractInput):
     """
     A sensor support class that measures the BME280's humidity, temperature,
@@ -116,6 +383,7 @@ class InputModule(AbstractInput):
         self.sensor = None
         self.serial = None
         self.serial_send = None
+        self.i2c_scheduler = None
         self.lock_file = "/var/lock/mycodo_ttn.lock"
         self.ttn_serial_error = False
         self.timer = 0
@@ -131,12 +399,18 @@ class InputModule(AbstractInput):
 
     def initialize_input(self):
         from Adafruit_BME280 import BME280
+        from smbus2 import SMBus
         import serial
 
         self.serial = serial
+
+        # All Inputs on the bus share one SMBus handle
+        self.i2c_scheduler = get_i2c_bus_scheduler(self.input_dev.i2c_bus, SMBus)
+        i2c = types.SimpleNamespace(
+            get_i2c_device=lambda address, **kwargs: AdafruitI2CDevice(self.i2c_scheduler, address))
         self.sensor = BME280(
             address=int(str(self.input_dev.i2c_location), 16),
-            busnum=self.input_dev.i2c_bus)
+            i2c=i2c)
 
     def get_measurement(self):
         """ Gets the measurement in units by reading the """
@@ -185,7 +459,14 @@ class InputModule(AbstractInput):
         except Exception as e:
             if not self.ttn_serial_error:
                 # Only send this error once if it continually occurs
-                self.logger.error("TTN: Could not send serial: {}".format(e))
+                self.logger.error("TTN: Could not send serial: %s", e)
                 self.ttn_serial_error = True
 
         return self.return_dict
+
+    def stop_input(self):
+        """ Release the I2C bus """
+        if self.i2c_scheduler:
+            release_i2c_bus_scheduler(self.input_dev.i2c_bus)
+            self.i2c_scheduler = None
+        super(InputModule, self).stop_input()
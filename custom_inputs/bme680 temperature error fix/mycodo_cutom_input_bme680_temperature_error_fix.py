@@ -1,4 +1,10 @@
 # coding=utf-8
+import sys
+import threading
+import time
+import types
+from array import array
+
 from flask_babel import lazy_gettext
 
 from mycodo.inputs.base_input import AbstractInput
@@ -93,6 +99,86 @@ def constraints_pass_gas_heater_profile(mod_input, value):
         errors.append("Invalid range. Need one of {}".format(range_pass))
     return all_passed, errors, mod_input
 
+def constraints_pass_stuck_reads(mod_input, value):
+    """
+    Check if the user input is acceptable
+    :param mod_input: SQL object with user-saved Input options
+    :param value: integer
+    :return: tuple: (bool, list of strings)
+    """
+    errors = []
+    all_passed = True
+    # Ensure value is 0 (disabled) or at least 2
+    if value < 0 or value == 1:
+        all_passed = False
+        errors.append("Must be 0 (disabled) or 2 or greater")
+    return all_passed, errors, mod_input
+
+def constraints_pass_iaq_humidity_baseline(mod_input, value):
+    """
+    Check if the user input is acceptable
+    :param mod_input: SQL object with user-saved Input options
+    :param value: float
+    :return: tuple: (bool, list of strings)
+    """
+    errors = []
+    all_passed = True
+    # Ensure 0 < value < 100, the score divides by both distances
+    if value <= 0 or value >= 100:
+        all_passed = False
+        errors.append("Must be greater than 0 and less than 100")
+    return all_passed, errors, mod_input
+
+def constraints_pass_iaq_baseline_reads(mod_input, value):
+    """
+    Check if the user input is acceptable
+    :param mod_input: SQL object with user-saved Input options
+    :param value: integer
+    :return: tuple: (bool, list of strings)
+    """
+    errors = []
+    all_passed = True
+    # Ensure value is 1 or greater
+    if value < 1:
+        all_passed = False
+        errors.append("Must be 1 or greater")
+    return all_passed, errors, mod_input
+
+# Registers read and written by the burst read (BME680 datasheet section 5.2)
+CTRL_MEAS_ADDR = 0x74
+FIELD0_ADDR = 0x1D
+FIELD0_LENGTH = 17
+FORCED_MODE = 0x01
+NEW_DATA_MSK = 0x80
+GAS_INDEX_MSK = 0x0F
+GAS_RANGE_MSK = 0x0F
+GASM_VALID_MSK = 0x20
+HEAT_STAB_MSK = 0x10
+
+# Private attributes of bme680.BME680 the burst read compensates with, which
+# the library may change. Without them the Input uses the library's read.
+BURST_READ_ATTRIBUTES = ('_variant', '_calc_temperature', '_calc_pressure', '_calc_humidity', '_calc_gas_resistance')
+
+# Measurement cycles of each oversampling setting, OS_NONE to OS_16X
+OVERSAMPLE_CYCLES = (0, 1, 2, 4, 8, 16)
+
+# Name of the module, registered in sys.modules, that holds the I2C bus
+# schedulers shared by the Inputs on the same bus
+I2C_BUS_REGISTRY = 'mycodo_custom_input_i2c_bus_schedulers'
+
+# Seconds a measurement waits for the measurements of other Inputs on the bus
+# to be batched with it
+I2C_BATCH_WINDOW = 0.02
+
+# Temperature the sensor is known to lock up at while the other channels keep updating
+LOCKUP_TEMPERATURE = 34.54
+
+# Values the compensation clamps a channel to. A channel pinned at one of them
+# (e.g. 100% humidity in condensing air) repeats while the sensor is working.
+SATURATION_LIMITS = {
+    1: (0.0, 100.0)
+}
+
 # Measurements
 measurements_dict = {
     0: {
@@ -122,6 +208,11 @@ measurements_dict = {
     6: {
         'measurement': 'vapor_pressure_deficit',
         'unit': 'Pa'
+    },
+    7: {
+        'measurement': 'air_quality',
+        'unit': 'percent',
+        'name': 'IAQ'
     }
 }
 
@@ -265,10 +356,374 @@ INPUT_INFORMATION = {
             'name': lazy_gettext('Temperature Offset'),
             'phrase': lazy_gettext('The amount to offset the temperature, either negative or positive')
         },
+        {
+            'id': 'read_mode',
+            'type': 'select',
+            'default_value': 'burst',
+            'options_select': [
+                ('burst', 'Burst Read'),
+                ('library', 'bme680 Library')
+            ],
+            'name': lazy_gettext('Read Mode'),
+            'phrase': lazy_gettext('Burst Read starts the measurement with one write, waits the measurement duration calculated from the oversampling and heater duration, and reads all data registers at once. bme680 Library uses get_sensor_data(), which polls the sensor for new data.')
+        },
+        {
+            'id': 'stuck_reads',
+            'type': 'integer',
+            'default_value': 10,
+            'constraints_pass': constraints_pass_stuck_reads,
+            'name': lazy_gettext('Stuck Reading Count'),
+            'phrase': lazy_gettext('Reset the sensor when temperature, humidity, or pressure (if enabled and oversampled) or gas resistance returns the same value this many times in a row while another of them changes, or when the gas resistance does on its own. Humidity at 0 or 100% is not counted. (0 disables)')
+        },
+        {
+            'id': 'iaq_burn_in',
+            'type': 'integer',
+            'default_value': 300,
+            'name': lazy_gettext('IAQ Burn-In (seconds)'),
+            'phrase': lazy_gettext('How long the gas sensor heats up after the Input starts before the air quality is calculated')
+        },
+        {
+            'id': 'iaq_baseline_reads',
+            'type': 'integer',
+            'default_value': 50,
+            'constraints_pass': constraints_pass_iaq_baseline_reads,
+            'name': lazy_gettext('IAQ Baseline Reads'),
+            'phrase': lazy_gettext('The gas resistance baseline (clean air) is the average of this many reads at the end of the burn-in, and is raised when the average of this many recent reads is higher')
+        },
+        {
+            'id': 'iaq_humidity_baseline',
+            'type': 'float',
+            'default_value': 40.0,
+            'constraints_pass': constraints_pass_iaq_humidity_baseline,
+            'name': lazy_gettext('IAQ Humidity Baseline (%)'),
+            'phrase': lazy_gettext('The relative humidity the air quality score is highest at')
+        },
     ],
 }
 
 
+def calculate_measurement_duration(temperature_oversample, pressure_oversample, humidity_oversample,
+                                   gas_heater_duration=None):
+    """
+    Time the sensor takes for a forced mode measurement, the same as
+    bme680_get_profile_dur() of the Bosch BME680 API
+    :param temperature_oversample: bme680.OS_* of temperature
+    :param pressure_oversample: bme680.OS_* of pressure
+    :param humidity_oversample: bme680.OS_* of humidity
+    :param gas_heater_duration: heater duration (ms), or None if gas is not measured
+    :return: float, seconds
+    """
+    cycles = (OVERSAMPLE_CYCLES[temperature_oversample] +
+              OVERSAMPLE_CYCLES[pressure_oversample] +
+              OVERSAMPLE_CYCLES[humidity_oversample])
+    # Conversion, TPH switching, gas measurement, and wake up time (us)
+    duration_us = cycles * 1963 + 477 * 4 + 477 * 5 + 500
+    duration_ms = duration_us // 1000 + 1
+    if gas_heater_duration:
+        duration_ms += gas_heater_duration
+    return duration_ms / 1000
+
+
+class BusMeasurement:
+    """ A measurement waiting to be made by an I2CBusScheduler """
+    def __init__(self, start, seconds, read, user=None):
+        self.start = start
+        self.seconds = seconds
+        self.read = read
+        self.user = user
+        self.ready_at = None
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class I2CBusScheduler:
+    """
+    Owns the one SMBus handle of an I2C bus for all Inputs on it
+
+    Every SMBus call is made under one lock, so the transactions of the
+    Inputs don't interleave. Measurements that have to be started, waited
+    for, and read (see measure()) are batched: when another Input that
+    batches its measurements (see add_batching_user()) is due within
+    I2C_BATCH_WINDOW, the first measurement waits for it, and the
+    measurements requested in that time are started, waited for once, and
+    read together. Batches run concurrently, so a measurement requested
+    while another batch is running doesn't wait for it.
+    """
+    def __init__(self, smbus):
+        self.smbus = smbus
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = []
+        self.collecting = False
+        self.users = 0
+        # [period, time of the next measurement] of each Input that batches
+        self.batching_users = {}
+        self.transactions = 0
+
+    def transaction(self, function, *args):
+        with self.lock:
+            self.transactions += 1
+            return function(*args)
+
+    # SMBus methods used by the sensor libraries
+    def read_byte(self, i2c_addr):
+        return self.transaction(self.smbus.read_byte, i2c_addr)
+
+    def write_byte(self, i2c_addr, value):
+        return self.transaction(self.smbus.write_byte, i2c_addr, value)
+
+    def read_byte_data(self, i2c_addr, register):
+        return self.transaction(self.smbus.read_byte_data, i2c_addr, register)
+
+    def write_byte_data(self, i2c_addr, register, value):
+        return self.transaction(self.smbus.write_byte_data, i2c_addr, register, value)
+
+    def read_word_data(self, i2c_addr, register):
+        return self.transaction(self.smbus.read_word_data, i2c_addr, register)
+
+    def write_word_data(self, i2c_addr, register, value):
+        return self.transaction(self.smbus.write_word_data, i2c_addr, register, value)
+
+    def read_i2c_block_data(self, i2c_addr, register, length):
+        return self.transaction(self.smbus.read_i2c_block_data, i2c_addr, register, length)
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        return self.transaction(self.smbus.write_i2c_block_data, i2c_addr, register, data)
+
+    def add_batching_user(self, user, period):
+        """
+        Count an Input as one that measures with measure() every period
+        seconds, so the measurements of the others wait for it when it's due
+        """
+        with self.condition:
+            self.batching_users[user] = [period, None]
+
+    def remove_batching_user(self, user):
+        with self.condition:
+            self.batching_users.pop(user, None)
+
+    def batching_user_due(self, user):
+        """
+        Whether an Input that batches, other than user, is due to measure
+        within I2C_BATCH_WINDOW and hasn't requested its measurement yet.
+        Must be called with self.condition held.
+        """
+        now = time.monotonic()
+        pending = [each.user for each in self.pending]
+        for other, (_, due) in self.batching_users.items():
+            if other is user or other in pending:
+                continue
+            # An Input that hasn't measured yet may be due at any time
+            if due is None or abs(due - now) <= I2C_BATCH_WINDOW:
+                return True
+        return False
+
+    def measure(self, start, seconds, read, user=None):
+        """
+        Start a measurement, wait for it to finish, and read it, together
+        with the measurements other Inputs on the bus request at the same time
+        :param start: function that starts the measurement
+        :param seconds: float, time the measurement takes
+        :param read: function that reads the finished measurement
+        :param user: the Input measuring, if it was added with add_batching_user()
+        :return: what read returns
+        """
+        measurement = BusMeasurement(start, seconds, read, user)
+        with self.condition:
+            if user in self.batching_users:
+                self.batching_users[user][1] = time.monotonic() + self.batching_users[user][0]
+            self.pending.append(measurement)
+            # Join the batch being collected, or collect the next one
+            while not measurement.done and (self.collecting or measurement not in self.pending):
+                self.condition.wait()
+            leading = not measurement.done
+            if leading:
+                self.collecting = True
+                wait = self.batching_user_due(user)
+
+        if leading:
+            try:
+                if wait:
+                    # Let the other Inputs due in the same tick join the batch
+                    time.sleep(I2C_BATCH_WINDOW)
+            finally:
+                with self.condition:
+                    batch = self.pending
+                    self.pending = []
+                    self.collecting = False
+            try:
+                self.run_batch(batch)
+            finally:
+                with self.condition:
+                    self.condition.notify_all()
+
+        if measurement.error:
+            raise measurement.error
+        return measurement.result
+
+    @staticmethod
+    def run_batch(batch):
+        started = []
+        for measurement in batch:
+            try:
+                measurement.start()
+                measurement.ready_at = time.monotonic() + measurement.seconds
+                started.append(measurement)
+            except Exception as err:
+                measurement.error = err
+
+        for measurement in sorted(started, key=lambda each: each.ready_at):
+            time.sleep(max(measurement.ready_at - time.monotonic(), 0))
+            try:
+                measurement.result = measurement.read()
+            except Exception as err:
+                measurement.error = err
+
+        for measurement in batch:
+            measurement.done = True
+
+
+def get_i2c_bus_scheduler(bus, open_bus):
+    """
+    Return the scheduler of an I2C bus and count the caller as one of its users
+
+    Mycodo loads each Input from its file as a separate module, so module
+    globals aren't shared between Inputs. The schedulers are instead kept
+    in a module registered in sys.modules.
+    :param bus: int, I2C bus number
+    :param open_bus: function(bus) that opens an SMBus handle, if the bus has none yet
+    :return: I2CBusScheduler
+    """
+    new_registry = types.ModuleType(I2C_BUS_REGISTRY)
+    new_registry.lock = threading.Lock()
+    new_registry.schedulers = {}
+    registry = sys.modules.setdefault(I2C_BUS_REGISTRY, new_registry)
+    with registry.lock:
+        if bus not in registry.schedulers:
+            registry.schedulers[bus] = I2CBusScheduler(open_bus(bus))
+        scheduler = registry.schedulers[bus]
+        scheduler.users += 1
+        return scheduler
+
+
+def release_i2c_bus_scheduler(bus):
+    """ Stop using the scheduler of an I2C bus, closing the bus after its last user """
+    registry = sys.modules.get(I2C_BUS_REGISTRY)
+    if registry is None:
+        return
+    with registry.lock:
+        scheduler = registry.schedulers.get(bus)
+        if scheduler is None:
+            return
+        scheduler.users -= 1
+        if scheduler.users <= 0:
+            del registry.schedulers[bus]
+            scheduler.smbus.close()
+
+
+class StuckChannelDetector:
+    """
+    Flags channels that return the same value for a number of consecutive
+    reads while at least one of the other channels changed in that time.
+    Channels that change on every read (changing) are flagged even when no
+    other channel changed, as all of them repeating means stale data.
+    """
+    def __init__(self, reads, changing=()):
+        self.reads = reads
+        self.changing = changing
+        self.last = {}
+        self.repeats = {}
+
+    def update(self, values):
+        """
+        Add the values of a read
+        :param values: dict of channel: value
+        :return: list of stuck channels
+        """
+        for channel, value in values.items():
+            if channel in self.last and self.last[channel] == value:
+                self.repeats[channel] += 1
+            else:
+                self.last[channel] = value
+                self.repeats[channel] = 1
+
+        stuck = []
+        moving = False
+        for channel in values:
+            if self.repeats[channel] >= self.reads:
+                stuck.append(channel)
+            else:
+                moving = True
+        if moving:
+            return stuck
+        return [channel for channel in stuck if channel in self.changing]
+
+    def forget(self, channel):
+        """ Start counting the repeats of a channel again """
+        self.last.pop(channel, None)
+        self.repeats.pop(channel, None)
+
+    def reset(self):
+        self.last.clear()
+        self.repeats.clear()
+
+
+class RingBuffer:
+    """
+    Fixed number of the most recent values in an array, with their running
+    sum so the mean is available without iterating over them
+    """
+    def __init__(self, size):
+        self.values = array('d', bytes(8 * size))
+        self.size = size
+        self.count = 0
+        self.index = 0
+        self.total = 0.0
+
+    def append(self, value):
+        if self.count == self.size:
+            self.total -= self.values[self.index]
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.total += value
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # Drop the rounding error the running sum gathered
+            self.total = sum(self.values)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+def calculate_air_quality(gas, humidity, gas_baseline, hum_baseline, hum_weighting=0.25):
+    """
+    Indoor air quality score of the Pimoroni BME680 example: the gas
+    resistance below its baseline lowers up to 75% of the score, and the
+    humidity away from its baseline lowers the remaining 25%
+    :param gas: gas resistance (Ohm)
+    :param humidity: relative humidity (percent)
+    :param gas_baseline: gas resistance in clean air (Ohm)
+    :param hum_baseline: relative humidity the score is highest at (percent, 0 < hum_baseline < 100)
+    :param hum_weighting: fraction of the score from humidity
+    :return: float, 0 (poor) to 100 (good)
+    """
+    hum_offset = humidity - hum_baseline
+    if hum_offset > 0:
+        hum_score = (100 - hum_baseline - hum_offset) / (100 - hum_baseline) * (hum_weighting * 100)
+    else:
+        hum_score = (hum_baseline + hum_offset) / hum_baseline * (hum_weighting * 100)
+
+    if gas < gas_baseline:
+        gas_score = (gas / gas_baseline) * (100 - hum_weighting * 100)
+    else:
+        gas_score = 100 - hum_weighting * 100
+
+    return max(0.0, min(100.0, hum_score + gas_score))
+
+
 class InputModule(AbstractInput):
     """
     A sensor support class that measures the BME680's humidity, temperature,
@@ -279,6 +734,14 @@ class InputModule(AbstractInput):
         super(InputModule, self).__init__(input_dev, testing=testing, name=__name__)
 
         self.sensor = None
+        self.sensor_configuration = None
+        self.stuck_detector = None
+        self.stuck_channels = None
+        self.gas_readings = None
+        self.gas_baseline = None
+        self.burn_in_end = None
+        self.ctrl_meas = None
+        self.measurement_seconds = None
 
         self.humidity_oversample = None
         self.temperature_oversample = None
@@ -288,6 +751,12 @@ class InputModule(AbstractInput):
         self.gas_heater_duration = None
         self.gas_heater_profile = None
         self.temp_offset = None
+        self.stuck_reads = None
+        self.iaq_burn_in = None
+        self.iaq_baseline_reads = None
+        self.iaq_humidity_baseline = None
+        self.read_mode = None
+        self.i2c_scheduler = None
 
         self.setup_custom_options(
             INPUT_INFORMATION['custom_options'], input_dev)
@@ -355,27 +824,211 @@ class InputModule(AbstractInput):
         elif self.iir_filter == 'FILTER_SIZE_127':
             self.iir_filter = bme680.FILTER_SIZE_127
 
+        # Snapshot of the configuration, replayed after a soft reset
+        self.sensor_configuration = {
+            'humidity_oversample': self.humidity_oversample,
+            'temperature_oversample': self.temperature_oversample,
+            'pressure_oversample': self.pressure_oversample,
+            'iir_filter': self.iir_filter,
+            'temp_offset': self.temp_offset,
+            'gas_status': bme680.ENABLE_GAS_MEAS if self.gas_enabled() else bme680.DISABLE_GAS_MEAS,
+            'gas_heater_temperature': self.gas_heater_temperature,
+            'gas_heater_duration': self.gas_heater_duration,
+            'gas_heater_profile': int(self.gas_heater_profile) if self.gas_heater_profile else None
+        }
+
+        if self.stuck_reads:
+            # Without oversampling (OS_NONE) a channel isn't measured and keeps its reset value
+            oversample = {
+                0: self.temperature_oversample,
+                1: self.humidity_oversample,
+                2: self.pressure_oversample
+            }
+            self.stuck_channels = [channel for channel, setting in oversample.items()
+                                   if self.is_enabled(channel) and setting != bme680.OS_NONE]
+            if self.is_enabled(3):
+                self.stuck_channels.append(3)
+            # The heat-stable gas resistance is never the same twice, so it
+            # repeating means stale data even when all channels repeat
+            self.stuck_detector = StuckChannelDetector(self.stuck_reads, changing=(3,))
+
+        if self.is_enabled(7):
+            self.gas_readings = RingBuffer(self.iaq_baseline_reads)
+            self.burn_in_end = time.monotonic() + self.iaq_burn_in
+
+        # All Inputs on the bus share one SMBus handle
+        self.i2c_scheduler = get_i2c_bus_scheduler(self.input_dev.i2c_bus, SMBus)
         self.sensor = bme680.BME680(
             i2c_addr=int(str(self.input_dev.i2c_location), 16),
-            i2c_device=SMBus(self.input_dev.i2c_bus))
+            i2c_device=self.i2c_scheduler)
+        self.configure_sensor()
+
+        if self.read_mode == 'burst':
+            missing = [name for name in BURST_READ_ATTRIBUTES if not hasattr(self.sensor, name)]
+            if missing:
+                self.use_library_read("the installed bme680 library has no {}".format(", ".join(missing)))
+            else:
+                self.i2c_scheduler.add_batching_user(self, self.input_dev.period)
+
+    def gas_enabled(self):
+        """ The gas resistance is measured for itself or for the air quality """
+        return self.is_enabled(3) or self.is_enabled(7)
+
+    def configure_sensor(self):
+        """ Apply the configuration snapshot to the sensor """
+        config = self.sensor_configuration
 
         # Set oversampling settings (can be tweaked to balance accuracy and noise in data
-        self.sensor.set_humidity_oversample(self.humidity_oversample)
-        self.sensor.set_temperature_oversample(self.temperature_oversample)
-        self.sensor.set_pressure_oversample(self.pressure_oversample)
-        self.sensor.set_filter(self.iir_filter)
+        self.sensor.set_humidity_oversample(config['humidity_oversample'])
+        self.sensor.set_temperature_oversample(config['temperature_oversample'])
+        self.sensor.set_pressure_oversample(config['pressure_oversample'])
+        self.sensor.set_filter(config['iir_filter'])
 
-        if self.temp_offset is not None:
-            self.sensor.set_temp_offset(self.temp_offset)
+        if config['temp_offset'] is not None:
+            self.sensor.set_temp_offset(config['temp_offset'])
 
-        if self.is_enabled(3):
-            self.sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
-            self.sensor.set_gas_heater_temperature(self.gas_heater_temperature)
-            self.sensor.set_gas_heater_duration(self.gas_heater_duration)
-            if self.gas_heater_profile:
-                self.sensor.select_gas_heater_profile(int(self.gas_heater_profile))
-        else:
-            self.sensor.set_gas_status(bme680.DISABLE_GAS_MEAS)
+        self.sensor.set_gas_status(config['gas_status'])
+        if self.gas_enabled():
+            # Heat with the selected profile, which is profile 0 unless one is selected
+            profile = config['gas_heater_profile'] or 0
+            self.sensor.set_gas_heater_temperature(config['gas_heater_temperature'], nb_profile=profile)
+            self.sensor.set_gas_heater_duration(config['gas_heater_duration'], nb_profile=profile)
+            if config['gas_heater_profile'] is not None:
+                self.sensor.select_gas_heater_profile(profile)
+
+        # Starts a forced mode measurement with the configured oversampling
+        self.ctrl_meas = (config['temperature_oversample'] << 5) | (config['pressure_oversample'] << 2) | FORCED_MODE
+        self.measurement_seconds = calculate_measurement_duration(
+            config['temperature_oversample'],
+            config['pressure_oversample'],
+            config['humidity_oversample'],
+            config['gas_heater_duration'] if self.gas_enabled() else None)
+
+    def read_sensor(self):
+        """
+        Measure and store the compensated values in self.sensor.data
+        :return: bool, whether new data was measured
+        """
+        if self.read_mode == 'burst':
+            try:
+                return self.read_burst()
+            except (AttributeError, TypeError) as err:
+                # The bme680 library changed in a way the burst read doesn't support
+                self.use_library_read(err)
+        return self.sensor.get_sensor_data()
+
+    def use_library_read(self, reason):
+        """ Fall back from the burst read to the bme680 library's read """
+        self.logger.error("Burst Read can't be used ({}), using bme680 Library read mode".format(reason))
+        self.read_mode = 'library'
+        self.i2c_scheduler.remove_batching_user(self)
+
+    def read_burst(self):
+        """
+        Start a forced mode measurement, wait for it to finish, and read
+        all data registers in one block read. Measurements of other Inputs
+        on the bus that are due at the same time are batched with it.
+        :return: bool, whether new data was measured
+        """
+        return self.i2c_scheduler.measure(
+            self.start_measurement, self.measurement_seconds, self.read_data, user=self)
+
+    def start_measurement(self):
+        self.i2c_scheduler.write_byte_data(self.sensor.i2c_addr, CTRL_MEAS_ADDR, self.ctrl_meas)
+
+    def read_data(self):
+        """
+        Read the data registers of a finished measurement
+        :return: bool, whether new data was measured
+        """
+        for _ in range(10):
+            regs = self.i2c_scheduler.read_i2c_block_data(self.sensor.i2c_addr, FIELD0_ADDR, FIELD0_LENGTH)
+            if regs[0] & NEW_DATA_MSK:
+                self.compensate(regs)
+                return True
+            time.sleep(0.001)
+        return False
+
+    def compensate(self, regs):
+        """
+        Convert the data registers to values in self.sensor.data the way
+        bme680.BME680.get_sensor_data() does
+        :param regs: list of the FIELD0_LENGTH data registers
+        """
+        sensor = self.sensor
+        data = sensor.data
+
+        data.status = regs[0] & NEW_DATA_MSK
+        data.gas_index = regs[0] & GAS_INDEX_MSK
+        data.meas_index = regs[1]
+
+        adc_pres = (regs[2] << 12) | (regs[3] << 4) | (regs[4] >> 4)
+        adc_temp = (regs[5] << 12) | (regs[6] << 4) | (regs[7] >> 4)
+        adc_hum = (regs[8] << 8) | regs[9]
+
+        # The low variant reports gas in registers 0x2A-0x2B, the high variant in 0x2C-0x2D
+        gas_msb, gas_lsb = (regs[15], regs[16]) if sensor._variant else (regs[13], regs[14])
+        adc_gas_res = (gas_msb << 2) | (gas_lsb >> 6)
+        gas_range = gas_lsb & GAS_RANGE_MSK
+        data.status |= gas_lsb & (GASM_VALID_MSK | HEAT_STAB_MSK)
+        data.heat_stable = (data.status & HEAT_STAB_MSK) > 0
+
+        temperature = sensor._calc_temperature(adc_temp)
+        data.temperature = temperature / 100.0
+        sensor.ambient_temperature = temperature  # Used by the heater resistance calculation
+
+        data.pressure = sensor._calc_pressure(adc_pres) / 100.0
+        data.humidity = sensor._calc_humidity(adc_hum) / 1000.0
+        data.gas_resistance = sensor._calc_gas_resistance(adc_gas_res, gas_range)
+
+    def find_stuck_channels(self):
+        """
+        Check the last read for channels that stopped updating
+        :return: list of stuck channels
+        """
+        data = self.sensor.data
+        stuck = []
+        if self.stuck_detector:
+            readings = {0: data.temperature, 1: data.humidity, 2: data.pressure, 3: data.gas_resistance}
+            values = {}
+            for channel in self.stuck_channels:
+                if channel == 3 and not data.heat_stable:
+                    continue
+                if readings[channel] in SATURATION_LIMITS.get(channel, ()):
+                    self.stuck_detector.forget(channel)
+                    continue
+                values[channel] = readings[channel]
+            stuck = self.stuck_detector.update(values)
+        if data.temperature == LOCKUP_TEMPERATURE and 0 not in stuck:
+            stuck.append(0)
+        return stuck
+
+    def recover_sensor(self):
+        """
+        Soft reset the sensor, replay its configuration, and measure again
+        :return: bool, whether new data was measured
+        """
+        start = time.monotonic()
+        try:
+            self.sensor.soft_reset()
+            self.configure_sensor()
+            if not self.read_sensor():
+                self.logger.debug("soft_reset() executed, no new data measured.")
+                return False
+        except Exception as err:
+            self.logger.error("Could not recover sensor: {}".format(err))
+            return False
+        finally:
+            if self.stuck_detector:
+                self.stuck_detector.reset()
+
+        self.logger.debug("soft_reset() executed in {:.0f} ms, remeasured Temp: {}, Hum: {}, Press: {}, Gas: {}".format(
+            (time.monotonic() - start) * 1000,
+            self.sensor.data.temperature,
+            self.sensor.data.humidity,
+            self.sensor.data.pressure,
+            self.sensor.data.gas_resistance))
+        return True
 
     def get_measurement(self):
         """ Get measurements and store in the database """
@@ -385,21 +1038,20 @@ class InputModule(AbstractInput):
 
         self.return_dict = measurements_dict.copy()
 
-        if not self.sensor.get_sensor_data():
-            self.logger.debug("Sensor get_sensor_data() returned False.")
+        if not self.read_sensor():
+            self.logger.debug("Sensor measured no new data.")
             return
 
-        if self.sensor.data.temperature == 34.54:
-            self.logger.debug("sensor yielded 34.54 C, executing soft_reset() and remeasuring.")
-            self.sensor.soft_reset()
-            self.sensor_initialize()
-            if not self.sensor.get_sensor_data():
-                self.logger.debug("soft_reset() executed, get_sensor_data() returned False.")
+        stuck = self.find_stuck_channels()
+        if stuck:
+            self.logger.debug("Channels {} stopped updating, executing soft_reset() and remeasuring.".format(stuck))
+            if not self.recover_sensor():
                 return
-            if self.sensor.data.temperature == 34.54:
-                self.logger.debug("soft_reset() executed, second measure attempt yielded 34.54 C")
-            else:
-                self.logger.debug("soft_reset() executed, normal temperature measured: {} C".format(self.sensor.data.temperature))
+            if self.sensor.data.temperature == LOCKUP_TEMPERATURE:
+                self.logger.debug("soft_reset() executed, second measure attempt yielded {} C".format(
+                    LOCKUP_TEMPERATURE))
+            # Start counting again from the new read
+            self.find_stuck_channels()
 
         if self.is_enabled(0):
             self.value_set(0, self.sensor.data.temperature)
@@ -428,4 +1080,39 @@ class InputModule(AbstractInput):
         if self.is_enabled(6) and self.is_enabled(0) and self.is_enabled(1):
             self.value_set(6, calculate_vapor_pressure_deficit(self.value_get(0), self.value_get(1)))
 
+        if self.is_enabled(7) and self.sensor.data.heat_stable:
+            self.add_air_quality()
+
         return self.return_dict
+
+    def add_air_quality(self):
+        """
+        Add the read to the gas resistance baseline and, after the burn-in,
+        set the air quality score
+
+        The baseline is the gas resistance in clean air, so it is only ever
+        raised: polluted air lowers the resistance, and a baseline that
+        followed it would score the polluted air as good.
+        """
+        gas = self.sensor.data.gas_resistance
+        self.gas_readings.append(gas)
+
+        if time.monotonic() < self.burn_in_end:
+            self.logger.debug("Gas sensor burn-in, {:.0f} seconds remaining".format(
+                self.burn_in_end - time.monotonic()))
+            return
+
+        recent_mean = self.gas_readings.mean()
+        if self.gas_baseline is None or recent_mean > self.gas_baseline:
+            self.gas_baseline = recent_mean
+
+        self.value_set(7, calculate_air_quality(
+            gas, self.sensor.data.humidity, self.gas_baseline, self.iaq_humidity_baseline))
+
+    def stop_input(self):
+        """ Release the I2C bus """
+        if self.i2c_scheduler:
+            self.i2c_scheduler.remove_batching_user(self)
+            release_i2c_bus_scheduler(self.input_dev.i2c_bus)
+            self.i2c_scheduler = None
+        super(InputModule, self).stop_input()
@@ -1,7 +1,15 @@
 # coding=utf-8
+import bisect
+import collections
+import contextlib
 import datetime
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
 import time
-import urllib.request
 
 import requests
 from flask_babel import lazy_gettext
@@ -12,11 +20,34 @@ from mycodo.databases.models import Input
 from mycodo.databases.utils import session_scope
 from mycodo.inputs.base_input import AbstractInput
 from mycodo.utils.database import db_retrieve_table_daemon
-from mycodo.utils.influx import add_measurements_influxdb
+from mycodo.utils.influx import format_influxdb_data
+from mycodo.utils.influx import write_influxdb_list
 from mycodo.utils.inputs import parse_measurement
 
 MYCODO_DB_PATH = 'sqlite:///' + SQL_DATABASE_MYCODO
 
+# Connections kept alive per Input (TTN, Safecast, GMC Map)
+HTTP_POOL_CONNECTIONS = 4
+
+# Uploads are recorded in this file, next to the Mycodo database, for this
+# many seconds (longer than TTN stores uplinks, so no uplink that can be
+# downloaded again is sent twice)
+UPLOAD_LEDGER_FILENAME = 'ttn_geiger_upload_ledger.db'
+LEDGER_RETENTION_SECONDS = 8 * 86400
+
+# Seconds to wait for a connection and between bytes of a response
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30
+
+# Share of the period a poll may take before its requests are aborted
+POLL_DEADLINE_FRACTION = 0.9
+
+# Characters of a response or uplink included in a log message by default
+LOG_EXCERPT_LENGTH = 1000
+
+# Seconds of overlap between consecutive queries, to not miss delayed uplinks
+CURSOR_OVERLAP_SECONDS = 60
+
 
 def constraints_pass_positive_value(mod_input, value):
     """
@@ -78,6 +109,15 @@ INPUT_INFORMATION = {
 
     'interfaces': ['Mycodo'],
 
+    'custom_actions_message': 'Show the number of calls and latency of each stage of the ingest pipeline since the Input was activated.',
+    'custom_actions': [
+        {
+            'id': 'show_metrics',
+            'type': 'button',
+            'name': lazy_gettext('Show Pipeline Metrics')
+        }
+    ],
+
     'custom_options': [
         {
             'id': 'application_id',
@@ -173,10 +213,539 @@ INPUT_INFORMATION = {
             'name': lazy_gettext('GMC Map Geiger Counter ID'),
             'phrase': lazy_gettext('GMC Map ID of the geiger counter')
         },
+        {
+            'id': 'influxdb_batch_size',
+            'type': 'integer',
+            'default_value': 500,
+            'required': True,
+            'name': lazy_gettext('InfluxDB Batch Size'),
+            'phrase': lazy_gettext('Maximum number of points to collect before writing them to InfluxDB')
+        },
+        {
+            'id': 'influxdb_batch_seconds',
+            'type': 'float',
+            'default_value': 10,
+            'required': True,
+            'name': lazy_gettext('InfluxDB Batch Interval (seconds)'),
+            'phrase': lazy_gettext('Maximum time a point may wait before the batch is written to InfluxDB')
+        },
+        {
+            'id': 'upload_queue_size',
+            'type': 'integer',
+            'default_value': 1000,
+            'required': True,
+            'name': lazy_gettext('Upload Queue Size'),
+            'phrase': lazy_gettext('Maximum number of Safecast/GMC Map uploads waiting to be sent. The oldest upload is dropped when full.')
+        },
+        {
+            'id': 'log_excerpt_length',
+            'type': 'integer',
+            'default_value': LOG_EXCERPT_LENGTH,
+            'required': True,
+            'name': lazy_gettext('Log Payload Length'),
+            'phrase': lazy_gettext('Maximum number of characters of TTN responses and uplinks included in log messages')
+        },
+        {
+            'id': 'checkpoint_interval',
+            'type': 'integer',
+            'default_value': 300,
+            'required': True,
+            'name': lazy_gettext('Checkpoint Interval (seconds)'),
+            'phrase': lazy_gettext('How often the timestamp of the latest uplink stored is saved to the database. Downloads resume from this timestamp after a restart, and uplinks downloaded again are skipped by the upload ledger.')
+        },
     ]
 }
 
 
+class LogExcerpt:
+    """
+    Log message argument that is only converted to a string if the message is
+    emitted, and is then cut to max_length characters
+    """
+    __slots__ = ('value', 'max_length')
+
+    def __init__(self, value, max_length=LOG_EXCERPT_LENGTH):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        if isinstance(self.value, (bytes, bytearray)):
+            # Only decode the part that is logged
+            text = self.value[:self.max_length].decode(errors='replace')
+            length = len(self.value)
+        else:
+            text = str(self.value)
+            length = len(text)
+        if length > self.max_length:
+            return "{}... ({} of {} characters)".format(text[:self.max_length], self.max_length, length)
+        return text
+
+
+def parse_ttn_timestamp(timestamp):
+    """
+    Parse an RFC 3339 timestamp from TTN into a naive UTC datetime
+    Accepts any number of fractional second digits (TTN sends anywhere from
+    milliseconds to nanoseconds) and either a 'Z' or a numeric offset suffix.
+    :param timestamp: string, e.g. '2021-10-30T15:04:05.123456789Z'
+    :return: datetime or None if the timestamp could not be parsed
+    """
+    end = len(timestamp)
+    if end < 20 or timestamp[4] != '-' or timestamp[10] not in 'Tt ':
+        return None
+
+    offset = None
+    if timestamp[-1] in 'Zz':
+        end -= 1
+    elif timestamp[-6] in '+-' and timestamp[-3] == ':':
+        offset = timestamp[-6:]
+        end -= 6
+    else:
+        return None
+
+    try:
+        microsecond = 0
+        if end > 19:
+            if timestamp[19] != '.':
+                return None
+            # Pad or truncate the fraction to microseconds
+            microsecond = int(timestamp[20:min(end, 26)].ljust(6, '0'))
+        offset_minutes = 0
+        if offset:
+            offset_minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+            if offset[0] == '-':
+                offset_minutes = -offset_minutes
+        datetime_utc = datetime.datetime(
+            int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+            microsecond)
+    except ValueError:
+        return None
+
+    if offset_minutes:
+        datetime_utc -= datetime.timedelta(minutes=offset_minutes)
+    return datetime_utc
+
+
+class RecentUplinks:
+    """
+    Remember the keys of the most recently processed uplinks
+
+    Consecutive TTN queries can return some of the same uplinks. Keeping a
+    bounded set of the latest uplink keys allows these to be skipped.
+    """
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self.keys = collections.OrderedDict()
+
+    def is_new(self, key):
+        """
+        Record an uplink key
+        :param key: hashable that uniquely identifies an uplink
+        :return: bool, False if the key was already seen
+        """
+        if key in self.keys:
+            return False
+        self.keys[key] = None
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+        return True
+
+
+class StageMetrics:
+    """
+    Count calls and record latency histograms for the stages of the ingest pipeline
+    """
+    # Upper bounds (seconds) of the histogram buckets. The last bucket is unbounded.
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def record(self, stage, seconds):
+        """
+        Record one call of a stage
+        :param stage: string, name of the stage
+        :param seconds: float, duration of the call
+        """
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {
+                    'count': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'histogram': [0] * (len(self.BUCKETS) + 1)
+                }
+            metrics = self.stages[stage]
+            metrics['count'] += 1
+            metrics['total'] += seconds
+            metrics['max'] = max(metrics['max'], seconds)
+            metrics['histogram'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ Record the duration of the with block as one call of a stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def count(self, counter, amount=1):
+        """ Increment a counter that has no latency """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def summary(self):
+        """
+        Return a readable summary of all stages and counters
+        :return: string
+        """
+        bucket_names = ["<{:g}ms".format(bucket * 1000) for bucket in self.BUCKETS]
+        bucket_names.append(">={:g}ms".format(self.BUCKETS[-1] * 1000))
+        lines = []
+        with self.lock:
+            for stage, metrics in self.stages.items():
+                lines.append("{}: count {}, mean {:.3f} ms, max {:.3f} ms, histogram {}".format(
+                    stage,
+                    metrics['count'],
+                    metrics['total'] / metrics['count'] * 1000,
+                    metrics['max'] * 1000,
+                    ", ".join("{} {}".format(name, count) for name, count in
+                              zip(bucket_names, metrics['histogram']) if count)))
+            for counter, value in self.counters.items():
+                lines.append("{}: {}".format(counter, value))
+        return "\n".join(lines)
+
+
+class InfluxBatchWriter:
+    """
+    Collect measurements and write them to InfluxDB in batches
+
+    Each point keeps its own timestamp. The batch is written when it reaches
+    batch_size points or when its oldest point has waited max_seconds.
+    """
+    def __init__(self, unique_id, logger, metrics, batch_size=500, max_seconds=10):
+        self.unique_id = unique_id
+        self.logger = logger
+        self.metrics = metrics
+        self.batch_size = max(1, int(batch_size))
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.points = []
+        self.oldest_point_time = None
+
+    def add(self, points):
+        """
+        Queue points
+        :param points: iterable of (channel, measurement, unit, value, timestamp_utc) tuples
+        """
+        with self.lock:
+            for channel, measurement, unit, value, timestamp_utc in points:
+                self.points.append(format_influxdb_data(
+                    self.unique_id,
+                    unit,
+                    value,
+                    channel=channel,
+                    measure=measurement,
+                    timestamp=timestamp_utc))
+                if self.oldest_point_time is None:
+                    self.oldest_point_time = time.time()
+            flush = (len(self.points) >= self.batch_size or
+                     (self.oldest_point_time is not None and
+                      time.time() - self.oldest_point_time >= self.max_seconds))
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """ Write all queued points to InfluxDB """
+        with self.lock:
+            points = self.points
+            self.points = []
+            self.oldest_point_time = None
+        if points:
+            self.logger.debug("Writing %d points to influxdb", len(points))
+            with self.metrics.timer('InfluxDB write'):
+                write_influxdb_list(points)
+
+
+class BackgroundUploader:
+    """
+    Run uploads to third-party services on worker threads
+
+    Uploads are queued so a slow or unresponsive service doesn't stall the
+    measurement thread. A failed upload is retried with exponential backoff.
+    When the queue is full, the oldest queued upload is dropped.
+
+    The capture times of uploads that are queued or being retried are kept
+    so the Input's checkpoint doesn't move past them. After a restart, they
+    are downloaded and queued again. Uploads that still fail after their
+    retries, or are dropped, are logged and released so they don't hold the
+    checkpoint back; the upload ledger keeps what was delivered from being
+    sent twice.
+    """
+    def __init__(self, logger, max_size=1000, workers=1, retries=3, backoff_seconds=5):
+        self.logger = logger
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.queue = queue.Queue(maxsize=max(1, int(max_size)))
+        self.stop_event = threading.Event()
+        self.dropped = 0
+        self.undelivered_lock = threading.Lock()
+        self.undelivered = collections.Counter()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self.worker, name="geiger_uploader_{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, name, function, *args, captured_at=None, **kwargs):
+        """
+        Queue an upload
+        :param name: name of the service, used in log messages
+        :param function: callable that performs the upload and raises on failure
+        :param captured_at: datetime (UTC) of the uplink the upload is from
+        """
+        if captured_at:
+            with self.undelivered_lock:
+                self.undelivered[captured_at] += 1
+        job = (name, function, args, kwargs, captured_at)
+        while True:
+            try:
+                self.queue.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    dropped_job = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    self.release(dropped_job[4])
+                    self.logger.error(
+                        "Upload queue full, dropped oldest {} upload (from {})".format(
+                            dropped_job[0], dropped_job[4]))
+                except queue.Empty:
+                    pass
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            try:
+                name, function, args, kwargs, captured_at = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        function(*args, **kwargs)
+                        self.release(captured_at)
+                        break
+                    except Exception as err:
+                        if attempt == self.retries:
+                            self.logger.error("Error adding data to {} (from {}), not retrying: {}".format(
+                                name, captured_at, err))
+                            self.release(captured_at)
+                            break
+                        delay = self.backoff_seconds * 2 ** attempt
+                        self.logger.debug("Error adding data to %s, retrying in %s seconds: %s",
+                                          name, delay, err)
+                        if self.stop_event.wait(delay):
+                            break
+            finally:
+                self.queue.task_done()
+
+    def release(self, captured_at):
+        """ Stop holding the checkpoint for an upload that was delivered, failed, or dropped """
+        if captured_at:
+            with self.undelivered_lock:
+                self.undelivered[captured_at] -= 1
+                if not self.undelivered[captured_at]:
+                    del self.undelivered[captured_at]
+
+    def oldest_undelivered(self):
+        """
+        :return: datetime (UTC) of the oldest uplink with an upload queued or being retried, or None
+        """
+        with self.undelivered_lock:
+            return min(self.undelivered) if self.undelivered else None
+
+    def stop(self, timeout=5):
+        """ Stop the workers, giving them up to timeout seconds to finish the current upload """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        if not self.queue.empty():
+            self.logger.info("Discarding {} queued uploads, they are queued again after a restart".format(
+                self.queue.qsize()))
+
+
+class UploadLedger:
+    """
+    Record of the measurements sent to an external service
+
+    The ledger is a SQLite database next to the Mycodo database, so it
+    survives restarts. When an Input restarts and downloads uplinks again,
+    measurements already in the ledger aren't sent again. Entries older than
+    the retention are deleted when the ledger is opened and once per day, and
+    the freed pages are returned to the file system.
+    """
+    def __init__(self, path, logger, retention_seconds=LEDGER_RETENTION_SECONDS):
+        self.logger = logger
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.last_compaction = None
+        self.closed = False
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            # auto_vacuum only takes effect if set before the first table is created
+            self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "service TEXT NOT NULL, "
+                "device TEXT NOT NULL, "
+                "captured_at TEXT NOT NULL, "
+                "PRIMARY KEY (service, device, captured_at)) WITHOUT ROWID")
+        self.compact()
+
+    def contains(self, service, device, captured_at):
+        """
+        Check if a measurement was sent
+        :param service: string, service and measurement (e.g. 'Safecast cpm')
+        :param device: string, device the measurement is from
+        :param captured_at: datetime (UTC) of the measurement
+        :return: bool
+        """
+        with self.lock:
+            if self.closed:
+                # Called after the Input stopped
+                return False
+            row = self.connection.execute(
+                "SELECT 1 FROM uploads WHERE service = ? AND device = ? AND captured_at = ?",
+                (service, device, captured_at.isoformat())).fetchone()
+        return row is not None
+
+    def add(self, service, device, captured_at):
+        """ Record that a measurement was sent """
+        with self.lock, self.connection:
+            if self.closed:
+                # An upload finished after the Input stopped
+                return
+            self.connection.execute(
+                "INSERT OR IGNORE INTO uploads (service, device, captured_at) VALUES (?, ?, ?)",
+                (service, device, captured_at.isoformat()))
+        if time.time() - self.last_compaction > 86400:
+            self.compact()
+
+    def compact(self):
+        """ Delete entries older than the retention and shrink the file """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention_seconds)
+        with self.lock:
+            with self.connection:
+                deleted = self.connection.execute(
+                    "DELETE FROM uploads WHERE captured_at < ?", (cutoff.isoformat(),)).rowcount
+            if deleted:
+                self.connection.execute("PRAGMA incremental_vacuum")
+            self.last_compaction = time.time()
+        if deleted:
+            self.logger.debug("Deleted %d upload ledger entries older than %s", deleted, cutoff)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.connection.close()
+
+
+class PollAborted(Exception):
+    """ Raised when a request is started after the poll deadline passed or the Input stopped """
+
+
+class PollDeadline:
+    """
+    Bound the time a poll may take, and abort its requests when the Input stops
+
+    Requests get connect and read timeouts that end no later than the
+    deadline. When the deadline passes, responses still being read are
+    aborted. Closing a response doesn't wake a thread that is blocked reading
+    it, so the socket of the response is shut down first.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = []
+        self.deadline = None
+        self.timer = None
+        self.reason = None
+        self.stopped = False
+
+    def begin(self, seconds):
+        """ Start a poll that may take up to seconds, or as long as it needs if None """
+        with self.lock:
+            self.deadline = None if seconds is None else time.monotonic() + seconds
+            self.reason = 'stop' if self.stopped else None
+        if seconds is None:
+            self.timer = None
+            return
+        self.timer = threading.Timer(seconds, self.abort, ('deadline',))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def end(self):
+        """ End the poll """
+        if self.timer:
+            self.timer.cancel()
+        with self.lock:
+            self.deadline = None
+            self.responses = []
+
+    def remaining(self):
+        """ Return the seconds left until the deadline """
+        if self.deadline is None:
+            return float('inf')
+        return max(0.0, self.deadline - time.monotonic())
+
+    def timeout(self):
+        """
+        Return the (connect, read) timeout of a request started now
+        :return: tuple of floats
+        """
+        remaining = self.remaining()
+        if self.reason or not remaining:
+            raise PollAborted(self.reason or 'deadline')
+        return min(HTTP_CONNECT_TIMEOUT, remaining), min(HTTP_READ_TIMEOUT, remaining)
+
+    def track(self, response):
+        """ Abort the response if the poll is aborted while it's being read """
+        with self.lock:
+            self.responses.append(response)
+            aborted = self.reason is not None
+        if aborted:
+            self.abort_response(response)
+
+    def abort(self, reason):
+        """
+        Abort the responses of the poll
+        :param reason: string, 'deadline' or 'stop'. After 'stop', every request fails.
+        """
+        with self.lock:
+            self.reason = reason
+            if reason == 'stop':
+                self.stopped = True
+            responses = self.responses
+            self.responses = []
+        for response in responses:
+            self.abort_response(response)
+
+    @staticmethod
+    def abort_response(response):
+        connection = getattr(response.raw, '_connection', None)
+        sock = getattr(connection, 'sock', None)
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        response.close()
+
+
 class InputModule(AbstractInput):
     """ A sensor support class that retrieves stored data from The Things Network """
 
@@ -184,10 +753,23 @@ class InputModule(AbstractInput):
         super(InputModule, self).__init__(input_dev, testing=testing, name=__name__)
 
         self.safecastpy = None
+        self.safecast = None
+        self.http_session = None
         self.interface = None
         self.period = None
         self.latest_datetime = None
         self.first_run = True
+        self.influxdb_writer = None
+        self.uploader = None
+        self.flushed_datetime = None
+        self.checkpoint_datetime = None
+        self.checkpoint_time = 0
+        self.upload_ledger = None
+        self.conversions = {}
+        self.extractors = []
+        self.recent_uplinks = RecentUplinks()
+        self.metrics = StageMetrics()
+        self.deadline = PollDeadline()
 
         # Initialize custom options
         self.send_safecast = None
@@ -204,6 +786,11 @@ class InputModule(AbstractInput):
         self.send_gmcmap = None
         self.gmcmap_account_id = None
         self.gmcmap_geiger_counter_id = None
+        self.influxdb_batch_size = None
+        self.influxdb_batch_seconds = None
+        self.upload_queue_size = None
+        self.log_excerpt_length = None
+        self.checkpoint_interval = None
         # Set custom_options
         self.setup_custom_options(
             INPUT_INFORMATION['custom_options'], input_dev)
@@ -216,158 +803,327 @@ class InputModule(AbstractInput):
 
         self.safecastpy = SafecastPy
 
+        # One keep-alive connection pool for TTN, Safecast, and GMC Map
+        self.http_session = requests.Session()
+        http_adapter = requests.adapters.HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_CONNECTIONS)
+        self.http_session.mount('https://', http_adapter)
+        self.http_session.mount('http://', http_adapter)
+
+        self.safecast = self.safecastpy.SafecastPy(api_key=self.safecast_api_key)
+        # SafecastPy sends requests through its own requests.Session (.client)
+        # with its own headers and parameters. Mount the shared adapter on it so
+        # its connections come from the same pool.
+        if isinstance(getattr(self.safecast, 'client', None), requests.Session):
+            self.safecast.client.mount('https://', http_adapter)
+            self.safecast.client.mount('http://', http_adapter)
+
         self.interface = self.input_dev.interface
         self.period = self.input_dev.period
         self.latest_datetime = self.input_dev.datetime
+        self.flushed_datetime = self.latest_datetime
+        self.checkpoint_datetime = self.latest_datetime
+        self.checkpoint_time = time.time()
+
+        self.influxdb_writer = InfluxBatchWriter(
+            self.unique_id, self.logger, self.metrics,
+            batch_size=self.influxdb_batch_size,
+            max_seconds=self.influxdb_batch_seconds)
+
+        self.uploader = BackgroundUploader(
+            self.logger, max_size=self.upload_queue_size)
+
+        if self.send_safecast:
+            self.upload_ledger = UploadLedger(
+                os.path.join(os.path.dirname(SQL_DATABASE_MYCODO), UPLOAD_LEDGER_FILENAME),
+                self.logger)
+
+        self.extractors = self.compile_extractors()
+
+    def stop_input(self):
+        """ Write queued measurements and the checkpoint, stop the uploader, and close connections """
+        # Interrupt a poll that is downloading, then store what it processed
+        self.deadline.abort('stop')
+        if self.uploader:
+            self.uploader.stop()
+        # After the uploader, so the checkpoint stays before the uploads it didn't deliver
+        if self.influxdb_writer:
+            self.save_progress(force=True)
+        if self.upload_ledger:
+            self.upload_ledger.close()
+        if self.http_session:
+            self.http_session.close()
+        super(InputModule, self).stop_input()
+
+    def get_conversion(self, channel):
+        """
+        Return the Conversion of a channel from memory, only querying the
+        database when the channel's conversion_id differs from the cached one
+        :param channel: int, measurement channel
+        :return: Conversion or None
+        """
+        conversion_id = self.channels_measurement[channel].conversion_id
+        if channel not in self.conversions or self.conversions[channel][0] != conversion_id:
+            conversion = None
+            if conversion_id:
+                conversion = db_retrieve_table_daemon(Conversion, unique_id=conversion_id)
+            self.conversions[channel] = (conversion_id, conversion)
+        return self.conversions[channel][1]
+
+    def submit_safecast(self, value, unit, timestamp):
+        """ Queue a measurement for Safecast, unless the ledger shows it was already sent """
+        if self.upload_ledger.contains('Safecast {}'.format(unit), self.device_id, timestamp):
+            self.logger.debug("Skipping Safecast %s measurement from %s, already sent", unit, timestamp)
+            return
+        self.uploader.submit('Safecast', self.upload_safecast, value, unit, timestamp, captured_at=timestamp)
+
+    def upload_safecast(self, value, unit, timestamp):
+        """ Send one measurement to Safecast """
+        with self.metrics.timer('Safecast upload'):
+            measurement = self.safecast.add_measurement(json={
+                'latitude': self.safecast_latitude,
+                'longitude': self.safecast_longitude,
+                'value': value,
+                'unit': unit,
+                'captured_at': timestamp.isoformat() + '+00:00',
+                'device_id': self.safecast_device_id,
+                'location_name': self.safecast_location_name
+            })
+        self.logger.debug('Safecast %s measurement id: %s', unit, measurement['id'])
+        self.upload_ledger.add('Safecast {}'.format(unit), self.device_id, timestamp)
+
+    def upload_gmcmap(self, cpm_value, usv_h_value):
+        """ Send the latest measurement to GMC Map """
+        gmcmap = 'http://www.GMCmap.com/log2.asp?AID={aid}&GID={gcid}&CPM={cpm:.0f}&uSV={usv:.3f}'.format(
+            aid=self.gmcmap_account_id,
+            gcid=self.gmcmap_geiger_counter_id,
+            cpm=cpm_value,
+            usv=usv_h_value)
+        with self.metrics.timer('GMC Map upload'):
+            response = self.http_session.get(gmcmap, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        response.raise_for_status()
+        self.logger.debug("GMCMap: %s", LogExcerpt(response.content, self.log_excerpt_length))
 
     def get_new_data(self, past_seconds):
         # Basic implementation. Future development may use more complex library to access API
         endpoint = "https://{app}.data.thethingsnetwork.org/api/v2/query/{dev}?last={time}".format(
             app=self.application_id, dev=self.device_id, time="{}s".format(int(past_seconds)))
         headers = {"Authorization": "key {k}".format(k=self.app_api_key)}
-        timestamp_format = '%Y-%m-%dT%H:%M:%S.%f'
 
-        response = requests.get(endpoint, headers=headers)
+        timeout = self.deadline.timeout()
+        with self.metrics.timer('HTTP fetch'):
+            # Stream, so the body can be aborted while it's downloading
+            response = self.http_session.get(endpoint, headers=headers, stream=True, timeout=timeout)
+            self.deadline.track(response)
+            response.content
         try:
-            responses = response.json()
+            with self.metrics.timer('JSON decode'):
+                responses = response.json()
         except ValueError:  # No data returned
-            self.logger.debug("Response Error. Response: {}. Likely there is no data to be retrieved on TTN".format(
-                response.content))
+            self.logger.debug("Response Error. Response: %s. Likely there is no data to be retrieved on TTN",
+                              LogExcerpt(response.content, self.log_excerpt_length))
             return
 
-        for i, each_resp in enumerate(response.json(), 1):
-            self.return_dict = measurements_dict.copy()
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for i, each_resp in enumerate(responses, 1):
             if not self.running:
                 break
 
-            try:
-                datetime_utc = datetime.datetime.strptime(
-                    each_resp['time'][:-7], timestamp_format)
-            except:
-                # Sometimes the original timestamp is in milliseconds
-                # instead of nanoseconds. Therefore, remove 3 less digits
-                # past the decimal and try again to parse.
-                try:
-                    datetime_utc = datetime.datetime.strptime(
-                        each_resp['time'][:-4], timestamp_format)
-                except:
-                    self.logger.error("Could not parse timestamp: {}".format(
-                        each_resp['time']))
-                    continue
+            start = time.perf_counter()
+            datetime_utc = parse_ttn_timestamp(each_resp['time'])
+            self.metrics.record('timestamp parse', time.perf_counter() - start)
+            if datetime_utc is None:
+                self.logger.error("Could not parse timestamp: {}".format(
+                    each_resp['time']))
+                continue
+
+            if not self.recent_uplinks.is_new((each_resp.get('device_id'), each_resp['time'])):
+                if debug:
+                    self.logger.debug("Skipping already processed uplink from %s", each_resp['time'])
+                continue
 
             if (not self.latest_datetime or
                     self.latest_datetime < datetime_utc):
                 self.latest_datetime = datetime_utc
             
-            cpm_value = None
-            cpm_ts = None
-            usv_h_value = None
-            usv_h_ts = None
-
-            for channel in self.return_dict:
-                if (self.is_enabled(channel) and
-                        self.return_dict[channel]['name'] in each_resp and
-                        each_resp[self.return_dict[channel]['name']] is not None):
-
-                    self.return_dict[channel]['value'] = each_resp[self.return_dict[channel]['name']]
-                    self.return_dict[channel]['timestamp_utc'] = datetime_utc
-
-                    if self.return_dict[channel]['unit'] == 'cpm':
-                        cpm_value = float(self.return_dict[channel]['value'])
-                        cpm_ts = self.return_dict[channel]['timestamp_utc']
-                    elif self.return_dict[channel]['unit'] == 'uSv_hr':
-                        usv_h_value = float(self.return_dict[channel]['value'])
-                        usv_h_ts = self.return_dict[channel]['timestamp_utc']
-
-                    # Convert value/unit if conversion_id present and valid
-                    if self.channels_conversion[channel]:
-                        conversion = db_retrieve_table_daemon(
-                            Conversion, unique_id=self.channels_measurement[channel].conversion_id)
-                        if conversion:
-                            meas = parse_measurement(
-                                self.channels_conversion[channel],
-                                self.channels_measurement[channel],
-                                self.return_dict,
-                                channel,
-                                self.return_dict[channel],
-                                timestamp=datetime_utc)
-
-                            self.return_dict[channel]['unit'] = meas[channel]['unit']
-                            self.return_dict[channel]['value'] = meas[channel]['value']
-
-            if 'value' in self.return_dict[0] and 'value' in self.return_dict[1]:
-                self.logger.debug("Adding measurements to influxdb: {}".format(self.return_dict))
-                add_measurements_influxdb(
-                    self.unique_id, self.return_dict,
-                    use_same_timestamp=INPUT_INFORMATION['measurements_use_same_timestamp'])
-            else:
+            points = self.extract_points(each_resp, datetime_utc)
+            if points:
+                self.influxdb_writer.add(points)
+            elif debug:
                 self.logger.debug("No measurements to add to influxdb.")
 
+            cpm_value = each_resp.get('cpm')
+            usv_h_value = each_resp.get('usv_h')
+            if cpm_value is not None and usv_h_value is not None:
+                cpm_value = float(cpm_value)
+                usv_h_value = float(usv_h_value)
+            cpm_ts = usv_h_ts = datetime_utc
+
             # Send to GMC Map
             if (self.send_gmcmap and
-                    i == len(response.json()) and
-                    cpm_value > 0 and
-                    usv_h_value > 0):
-                try:
-                    gmcmap = 'http://www.GMCmap.com/log2.asp?AID=02376&GID=22044260632&CPM={cpm:.0f}&uSV={usv:.3f}'.format(
-                        aid=self.gmcmap_account_id,
-                        gcid=self.gmcmap_geiger_counter_id,
-                        cpm=cpm_value,
-                        usv=usv_h_value)
-                    contents = urllib.request.urlopen(gmcmap).read()
-                    self.logger.debug("GMCMap: {}".format(contents))
-                except Exception as e:
-                    self.logger.error("Error adding data to GMC Map: {}".format(e))
-
-            # Send uSv/hr to Safecast
-            if self.send_safecast and cpm_value > 0 and usv_h_value > 0:
-                try:
-                    safecast = self.safecastpy.SafecastPy(api_key=self.safecast_api_key)
-                    measurement_usv = safecast.add_measurement(json={
-                        'latitude': self.safecast_latitude,
-                        'longitude': self.safecast_longitude,
-                        'value': usv_h_value,
-                        'unit': self.safecastpy.UNIT_USV,
-                        'captured_at': usv_h_ts.isoformat() + '+00:00',
-                        'device_id': self.safecast_device_id,
-                        'location_name': self.safecast_location_name
-                    })
-                    measurement_cpm = safecast.add_measurement(json={
-                        'latitude': self.safecast_latitude,
-                        'longitude': self.safecast_longitude,
-                        'value': cpm_value,
-                        'unit': self.safecastpy.UNIT_CPM,
-                        'captured_at': cpm_ts.isoformat() + '+00:00',
-                        'device_id': self.safecast_device_id,
-                        'location_name': self.safecast_location_name
-                    })
-                    self.logger.debug('uSv/hr measurement id: {0}'.format(measurement_usv['id']))
-                    self.logger.debug('CPM measurement id: {0}'.format(measurement_cpm['id']))
-                except Exception as e:
-                    self.logger.error("Error adding data to Safecast: {}".format(e))
-
-        # set datetime to latest timestamp
-        if self.running:
-            with session_scope(MYCODO_DB_PATH) as new_session:
-                mod_input = new_session.query(Input).filter(
-                    Input.unique_id == self.unique_id).first()
-                if not mod_input.datetime or mod_input.datetime < self.latest_datetime:
-                    mod_input.datetime = self.latest_datetime
-                    new_session.commit()
+                    i == len(responses) and
+                    cpm_value and
+                    usv_h_value):
+                # Only the latest measurement matters to GMC Map, so it doesn't hold the checkpoint
+                self.uploader.submit('GMC Map', self.upload_gmcmap, cpm_value, usv_h_value)
+
+            # Send uSv/hr and CPM to Safecast
+            if self.send_safecast and cpm_value and usv_h_value:
+                self.submit_safecast(usv_h_value, self.safecastpy.UNIT_USV, usv_h_ts)
+                self.submit_safecast(cpm_value, self.safecastpy.UNIT_CPM, cpm_ts)
+
+        self.save_progress()
+
+    def compile_extractors(self):
+        """
+        Build the list of payload fields to store, for the enabled channels only
+        :return: list of (channel, payload field, measurement, unit) tuples
+        """
+        extractors = []
+        for channel, measurement in measurements_dict.items():
+            if not self.is_enabled(channel):
+                continue
+            extractors.append((
+                channel,
+                measurement['name'],
+                measurement['measurement'],
+                measurement['unit']))
+        return extractors
+
+    def convert(self, channel, conversion, measurement, unit, value, timestamp_utc):
+        """
+        Convert the value of a channel with its Conversion
+        :return: tuple of the converted unit and value
+        """
+        measurement_dict = {channel: {'measurement': measurement, 'unit': unit, 'value': value}}
+        meas = parse_measurement(
+            conversion,
+            self.channels_measurement[channel],
+            measurement_dict,
+            channel,
+            measurement_dict[channel],
+            timestamp=timestamp_utc)
+        return meas[channel]['unit'], meas[channel]['value']
+
+    def extract_points(self, payload, datetime_utc):
+        """
+        Return the points of the enabled channels in a payload
+        :param payload: dict of field name: value
+        :param datetime_utc: datetime (UTC) of the uplink
+        :return: list of (channel, measurement, unit, value, timestamp_utc) tuples
+        """
+        points = []
+        for channel, field, measurement, unit in self.extractors:
+            value = payload.get(field)
+            if value is None:
+                continue
+            # Looked up per uplink, so a changed conversion_id takes effect without a restart
+            conversion = self.get_conversion(channel)
+            if conversion:
+                with self.metrics.timer('conversion'):
+                    unit, value = self.convert(channel, conversion, measurement, unit, value, datetime_utc)
+            points.append((channel, measurement, unit, value, datetime_utc))
+        return points
+
+    def save_progress(self, force=False):
+        """
+        Write the queued measurements and checkpoint the timestamp of the
+        latest uplink processed
+
+        The checkpoint is kept in memory and saved to the database every
+        checkpoint_interval seconds, and when the Input stops. After a crash,
+        downloads resume from the last saved checkpoint.
+        :param force: bool, save the checkpoint regardless of the interval
+        """
+        # Write what is left of the batch before moving the checkpoint forward,
+        # so the checkpoint never gets ahead of what is in InfluxDB
+        self.influxdb_writer.flush()
+        self.flushed_datetime = self.checkpoint_limit()
+
+        if force or time.time() - self.checkpoint_time >= self.checkpoint_interval:
+            self.write_checkpoint()
+
+    def checkpoint_limit(self):
+        """
+        The latest uplink processed, or the last one before the oldest uplink
+        with an upload queued or being retried, so a restart downloads and uploads it again
+        :return: datetime (UTC) or None
+        """
+        oldest_undelivered = self.uploader.oldest_undelivered() if self.uploader else None
+        if (oldest_undelivered and self.latest_datetime and
+                oldest_undelivered <= self.latest_datetime):
+            # Downloads resume after the checkpoint
+            return oldest_undelivered - datetime.timedelta(microseconds=1)
+        return self.latest_datetime
+
+    def write_checkpoint(self):
+        """ Save the in-memory checkpoint to the database, if it moved forward """
+        if (not self.flushed_datetime or
+                (self.checkpoint_datetime and self.checkpoint_datetime >= self.flushed_datetime)):
+            return
+
+        with self.metrics.timer('checkpoint'), session_scope(MYCODO_DB_PATH) as new_session:
+            mod_input = new_session.query(Input).filter(
+                Input.unique_id == self.unique_id).first()
+            if not mod_input.datetime or mod_input.datetime < self.flushed_datetime:
+                mod_input.datetime = self.flushed_datetime
+                new_session.commit()
+        self.checkpoint_datetime = self.flushed_datetime
+        self.checkpoint_time = time.time()
+
+    def show_metrics(self, args_dict):
+        """ Custom action: return the pipeline metrics """
+        summary = self.metrics.summary() or "No metrics recorded yet"
+        self.logger.info("Pipeline metrics:\n{}".format(summary))
+        return summary
 
     def get_measurement(self):
         """ Gets the data """
+        start = time.monotonic()
+        # The first download can be 7 days of uplinks, which a single v2
+        # request can't resume, so it may take longer than a period
+        self.deadline.begin(None if self.first_run else self.period * POLL_DEADLINE_FRACTION)
+        try:
+            self.get_data()
+        except (PollAborted, requests.exceptions.RequestException) as err:
+            if self.deadline.reason == 'deadline':
+                self.metrics.count('polls cut short')
+                self.logger.info("Poll reached its deadline of {:.0f} seconds, continuing next period".format(
+                    self.period * POLL_DEADLINE_FRACTION))
+            elif not self.deadline.reason:
+                self.logger.error("Could not download uplinks: {}".format(err))
+        finally:
+            self.deadline.end()
+        self.count_overrun(time.monotonic() - start)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Pipeline metrics:\n%s", self.metrics.summary())
+
+        return {}
+
+    def count_overrun(self, elapsed):
+        """ Count a poll that took longer than the period, and the periods it skipped """
+        if elapsed > self.period:
+            self.metrics.count('polls overrun')
+            self.metrics.count('periods skipped', int(elapsed // self.period))
+            self.logger.warning("Poll took {:.1f} seconds, longer than the period of {} seconds".format(
+                elapsed, self.period))
+
+    def get_data(self):
+        """ Download and store uplinks, continuing from the last uplink processed """
         if self.first_run:
             # Get data for up to 7 days (longest Data Storage Integration
             # stores data) in the past or until last_datetime.
             seconds_seven_days = 604800  # 604800 seconds = 7 days
             seconds_download = seconds_seven_days
             start = time.time()
-            self.first_run = False
 
             if self.latest_datetime:
                 utc_now = datetime.datetime.utcnow()
-                seconds_since_last = (utc_now - self.latest_datetime).total_seconds()
+                # With the same overlap as later polls, so the uplink right
+                # after the checkpoint isn't missed. The ledger keeps overlapping uplinks
+                # from being uploaded again.
+                seconds_since_last = (utc_now - self.latest_datetime).total_seconds() + CURSOR_OVERLAP_SECONDS
                 if seconds_since_last < seconds_seven_days:
                     seconds_download = seconds_since_last
 
@@ -382,13 +1138,18 @@ class InputModule(AbstractInput):
                         int(seconds_download)))
 
             self.get_new_data(seconds_download)
+            # Only once it succeeded, so a failed first download is retried in full
+            self.first_run = False
 
             if seconds_download == seconds_seven_days:
                 elapsed = time.time() - start
                 self.logger.info(
                     "Download and parsing completed in {} seconds.".format(
                         int(elapsed)))
+        elif self.latest_datetime:
+            # The v2 API only accepts a duration, so continue from the last
+            # processed uplink with some overlap. Overlapping uplinks are skipped.
+            seconds_since_last = (datetime.datetime.utcnow() - self.latest_datetime).total_seconds()
+            self.get_new_data(min(seconds_since_last + CURSOR_OVERLAP_SECONDS, 604800))
         else:
             self.get_new_data(self.period)
-
-        return {}
@@ -1,9 +1,24 @@
 # coding=utf-8
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import itertools
 import json
+import logging
+import math
+import os
+import queue
+import socket
 import requests
+import sqlite3
+import struct
+import sys
+import threading
 import time
-import urllib.request
+import types
 from flask_babel import lazy_gettext
 from mycodo.config import MYCODO_DB_PATH
 from mycodo.config import SQL_DATABASE_MYCODO
@@ -12,9 +27,69 @@ from mycodo.databases.models import Input
 from mycodo.databases.utils import session_scope
 from mycodo.inputs.base_input import AbstractInput
 from mycodo.utils.database import db_retrieve_table_daemon
-from mycodo.utils.influx import add_measurements_influxdb
+from mycodo.utils.influx import format_influxdb_data
+from mycodo.utils.influx import write_influxdb_list
 from mycodo.utils.inputs import parse_measurement
 
+# Bytes read from the TTN response at a time when streaming uplinks
+STREAM_CHUNK_SIZE = 8192
+
+# Connections kept alive per Input (TTN, Safecast, GMC Map)
+HTTP_POOL_CONNECTIONS = 4
+
+# Longest the Data Storage Integration stores data
+SECONDS_SEVEN_DAYS = 604800
+
+# Seconds to wait for a connection and between bytes of a response
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30
+
+# Share of the period a poll may take before its requests are aborted
+POLL_DEADLINE_FRACTION = 0.9
+
+# Weight of the newest request in a cluster's average latency, and seconds a
+# failed cluster is skipped for (doubling with each consecutive failure, up to
+# the maximum)
+CLUSTER_LATENCY_WEIGHT = 0.3
+CLUSTER_RETRY_SECONDS = 30
+CLUSTER_RETRY_MAX_SECONDS = 900
+
+# Characters of a response or uplink included in a log message by default
+LOG_EXCERPT_LENGTH = 1000
+
+# Backfills are downloaded in windows of this many seconds, this many windows
+# at a time, retrying each failed window this many times
+BACKFILL_WINDOW_SECONDS = 21600
+BACKFILL_WORKERS = 3
+BACKFILL_RETRIES = 2
+
+# Name of the module, registered in sys.modules, that holds the application
+# pollers shared by the Inputs of the same TTN application
+APPLICATION_POLLER_REGISTRY = 'mycodo_custom_input_ttn_geiger_application_pollers'
+
+# Uploads are recorded in this file, next to the Mycodo database, for this
+# many seconds (longer than TTN stores uplinks, so no uplink that can be
+# downloaded again is sent twice)
+UPLOAD_LEDGER_FILENAME = 'ttn_geiger_upload_ledger.db'
+LEDGER_RETENTION_SECONDS = 8 * 86400
+
+# Layout of the start of the payload sent by the Moteino: CPM and an SFloat16
+# of uSv/hr / 10, each a little-endian 16-bit integer, followed by the mode.
+# The TTN v3 payload formatter instead decodes CPM as an SFloat16 of CPM / 1e8.
+FRM_PAYLOAD = struct.Struct('<HH')
+
+# Field masks of the uplink fields requested from Data Storage
+FIELD_MASK_RAW = 'up.uplink_message.frm_payload'
+FIELD_MASK_DECODED = 'up.uplink_message.decoded_payload'
+
+# Standard normal quantile of the two-sided 95% confidence bounds on CPM
+POISSON_CONFIDENCE_Z = 1.96
+
+# Packages MQTT Push mode and the aggregate channels need. They aren't
+# dependencies of the Input, so Inputs that don't use them don't install them.
+MQTT_REQUIREMENT = 'paho-mqtt==1.6.1'
+AGGREGATION_REQUIREMENT = 'numpy'
+
 
 def constraints_pass_positive_value(mod_input, value):
     """
@@ -46,9 +121,37 @@ measurements_dict = {
         'measurement': 'radiation_dose_rate',
         'unit': 'uSv_hr',
         'name': 'usv_h'
+    },
+    2: {
+        'measurement': 'radiation_dose_rate',
+        'unit': 'cpm',
+        'name': 'cpm_mean'
+    },
+    3: {
+        'measurement': 'radiation_dose_rate',
+        'unit': 'cpm',
+        'name': 'cpm_max'
+    },
+    4: {
+        'measurement': 'radiation_dose_rate',
+        'unit': 'cpm',
+        'name': 'cpm_lower_95'
+    },
+    5: {
+        'measurement': 'radiation_dose_rate',
+        'unit': 'cpm',
+        'name': 'cpm_upper_95'
+    },
+    6: {
+        'measurement': 'radiation_dose_rate',
+        'unit': 'uSv_hr',
+        'name': 'usv_h_mean'
     }
 }
 
+# Channels computed by RollingAggregator rather than read from the uplink
+AGGREGATE_CHANNELS = (2, 3, 4, 5, 6)
+
 
 # Input information
 INPUT_INFORMATION = {
@@ -71,11 +174,21 @@ INPUT_INFORMATION = {
     'options_disabled': ['interface'],
 
     'dependencies_module': [
-        ('pip-pypi', 'SafecastPy', 'SafecastPy')
+        ('pip-pypi', 'SafecastPy', 'SafecastPy'),
+        ('pip-pypi', 'numpy', 'numpy')
     ],
 
     'interfaces': ['Mycodo'],
 
+    'custom_actions_message': 'Show the number of calls and latency of each stage of the ingest pipeline since the Input was activated.',
+    'custom_actions': [
+        {
+            'id': 'show_metrics',
+            'type': 'button',
+            'name': lazy_gettext('Show Pipeline Metrics')
+        }
+    ],
+
     'custom_options': [
         {
             'id': 'application_id',
@@ -101,6 +214,59 @@ INPUT_INFORMATION = {
             'name': lazy_gettext('TTN Device ID'),
             'phrase': lazy_gettext('The Things Network Device ID')
         },
+        {
+            'id': 'ttn_clusters',
+            'type': 'text',
+            'default_value': 'nam1.cloud.thethings.network',
+            'required': True,
+            'name': lazy_gettext('TTN Clusters'),
+            'phrase': lazy_gettext('Comma-separated addresses of the TTN clusters to request uplinks from (e.g. eu1.cloud.thethings.network, au1.cloud.thethings.network). The fastest cluster that responds without errors is used, and the others are tried when it fails. An address may include the scheme and port (e.g. http://127.0.0.1:8080).')
+        },
+        {
+            'id': 'poll_mode',
+            'type': 'select',
+            'default_value': 'device',
+            'options_select': [
+                ('device', 'Device'),
+                ('application', 'Application'),
+                ('mqtt', 'MQTT Push')
+            ],
+            'name': lazy_gettext('Poll Mode'),
+            'phrase': lazy_gettext('Device: request this device\'s uplinks. Application: request the uplinks of all devices in the application once per period and share them with the other Inputs of the application that use this mode. MQTT Push: receive uplinks from the TTN MQTT server as they arrive and only request uplinks from Data Storage to fill gaps after a disconnect. MQTT Push requires paho-mqtt 1.6.1, which isn\'t installed with the Input (pip install paho-mqtt==1.6.1 in Mycodo\'s environment). Without it, the Input falls back to Device.')
+        },
+        {
+            'id': 'payload_decoding',
+            'type': 'select',
+            'default_value': 'ttn',
+            'options_select': [
+                ('ttn', 'TTN Payload Formatter'),
+                ('local_sflt16', 'Local (CPM as SFloat16)'),
+                ('local_uint16', 'Local (CPM as Integer)')
+            ],
+            'name': lazy_gettext('Payload Decoding'),
+            'phrase': lazy_gettext('TTN Payload Formatter: request the payload decoded by the formatter set up in the TTN console. Local: request the raw payload and decode it in Mycodo, so no formatter is needed. CPM as SFloat16 decodes the same values as the TTN v3 payload formatter, CPM as Integer matches the Arduino sketch.')
+        },
+        {
+            'id': 'mqtt_host',
+            'type': 'text',
+            'default_value': 'nam1.cloud.thethings.network',
+            'name': lazy_gettext('MQTT Host'),
+            'phrase': lazy_gettext('Host of the TTN MQTT server (MQTT Push mode)')
+        },
+        {
+            'id': 'mqtt_port',
+            'type': 'integer',
+            'default_value': 8883,
+            'name': lazy_gettext('MQTT Port'),
+            'phrase': lazy_gettext('Port of the TTN MQTT server (MQTT Push mode)')
+        },
+        {
+            'id': 'mqtt_use_tls',
+            'type': 'bool',
+            'default_value': True,
+            'name': lazy_gettext('MQTT Use TLS'),
+            'phrase': lazy_gettext('Connect to the MQTT server with TLS (MQTT Push mode)')
+        },
         {
             'id': 'send_safecast',
             'type': 'bool',
@@ -171,10 +337,809 @@ INPUT_INFORMATION = {
             'name': lazy_gettext('GMC Map Geiger Counter ID'),
             'phrase': lazy_gettext('GMC Map ID of the geiger counter')
         },
+        {
+            'id': 'influxdb_batch_size',
+            'type': 'integer',
+            'default_value': 500,
+            'required': True,
+            'name': lazy_gettext('InfluxDB Batch Size'),
+            'phrase': lazy_gettext('Maximum number of points to collect before writing them to InfluxDB')
+        },
+        {
+            'id': 'influxdb_batch_seconds',
+            'type': 'float',
+            'default_value': 10,
+            'required': True,
+            'name': lazy_gettext('InfluxDB Batch Interval (seconds)'),
+            'phrase': lazy_gettext('Maximum time a point may wait before the batch is written to InfluxDB')
+        },
+        {
+            'id': 'upload_queue_size',
+            'type': 'integer',
+            'default_value': 1000,
+            'required': True,
+            'name': lazy_gettext('Upload Queue Size'),
+            'phrase': lazy_gettext('Maximum number of Safecast/GMC Map uploads waiting to be sent. The oldest upload is dropped when full.')
+        },
+        {
+            'id': 'log_excerpt_length',
+            'type': 'integer',
+            'default_value': LOG_EXCERPT_LENGTH,
+            'required': True,
+            'name': lazy_gettext('Log Payload Length'),
+            'phrase': lazy_gettext('Maximum number of characters of TTN responses and uplinks included in log messages')
+        },
+        {
+            'id': 'checkpoint_interval',
+            'type': 'integer',
+            'default_value': 300,
+            'required': True,
+            'name': lazy_gettext('Checkpoint Interval (seconds)'),
+            'phrase': lazy_gettext('How often the timestamp of the latest uplink stored is saved to the database. Downloads resume from this timestamp after a restart, and uplinks downloaded again are skipped by the upload ledger.')
+        },
+        {
+            'id': 'aggregation_window',
+            'type': 'integer',
+            'default_value': 10,
+            'required': True,
+            'constraints_pass': constraints_pass_positive_value,
+            'name': lazy_gettext('Aggregation Window (uplinks)'),
+            'phrase': lazy_gettext('Number of uplinks the CPM mean, maximum, and 95% confidence bounds and the μSv/hr mean are calculated over. These channels are calculated with NumPy.')
+        },
     ]
 }
 
 
+def sflt16_to_float(raw):
+    """
+    Convert an LMIC SFloat16 to a float
+    Bit 15 is the sign, bits 14-11 the exponent, and bits 10-0 the mantissa,
+    including its most significant bit.
+    :param raw: int, 0 to 0xFFFF
+    :return: float in the open interval (-1.0, 1.0)
+    """
+    value = math.ldexp(raw & 0x7FF, ((raw >> 11) & 0xF) - 26)
+    return -value if raw & 0x8000 else value
+
+
+def decode_frm_payload(frm_payload, cpm_sflt16=True):
+    """
+    Decode the raw payload of an uplink from the Moteino
+    :param frm_payload: string, base64-encoded payload
+    :param cpm_sflt16: bool, CPM is encoded as an SFloat16 of CPM / 1e8 rather than an integer,
+        as the TTN v3 payload formatter decodes it (the default Payload Decoding)
+    :return: dict with 'cpm' and 'usv_h', or None if the payload is too short or not base64
+    """
+    try:
+        raw_cpm, raw_usv_h = FRM_PAYLOAD.unpack_from(base64.b64decode(frm_payload))
+    except (ValueError, TypeError, struct.error):
+        return None
+    return {
+        'cpm': sflt16_to_float(raw_cpm) * 100000000 if cpm_sflt16 else raw_cpm,
+        'usv_h': sflt16_to_float(raw_usv_h) * 10
+    }
+
+
+class LogExcerpt:
+    """
+    Log message argument that is only converted to a string if the message is
+    emitted, and is then cut to max_length characters
+    """
+    __slots__ = ('value', 'max_length')
+
+    def __init__(self, value, max_length=LOG_EXCERPT_LENGTH):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        if isinstance(self.value, (bytes, bytearray)):
+            # Only decode the part that is logged
+            text = self.value[:self.max_length].decode(errors='replace')
+            length = len(self.value)
+        else:
+            text = str(self.value)
+            length = len(text)
+        if length > self.max_length:
+            return "{}... ({} of {} characters)".format(text[:self.max_length], self.max_length, length)
+        return text
+
+
+def parse_ttn_timestamp(timestamp):
+    """
+    Parse an RFC 3339 timestamp from TTN into a naive UTC datetime
+    Accepts any number of fractional second digits (TTN sends anywhere from
+    milliseconds to nanoseconds) and either a 'Z' or a numeric offset suffix.
+    :param timestamp: string, e.g. '2021-10-30T15:04:05.123456789Z'
+    :return: datetime or None if the timestamp could not be parsed
+    """
+    end = len(timestamp)
+    if end < 20 or timestamp[4] != '-' or timestamp[10] not in 'Tt ':
+        return None
+
+    offset = None
+    if timestamp[-1] in 'Zz':
+        end -= 1
+    elif timestamp[-6] in '+-' and timestamp[-3] == ':':
+        offset = timestamp[-6:]
+        end -= 6
+    else:
+        return None
+
+    try:
+        microsecond = 0
+        if end > 19:
+            if timestamp[19] != '.':
+                return None
+            # Pad or truncate the fraction to microseconds
+            microsecond = int(timestamp[20:min(end, 26)].ljust(6, '0'))
+        offset_minutes = 0
+        if offset:
+            offset_minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+            if offset[0] == '-':
+                offset_minutes = -offset_minutes
+        datetime_utc = datetime.datetime(
+            int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+            microsecond)
+    except ValueError:
+        return None
+
+    if offset_minutes:
+        datetime_utc -= datetime.timedelta(minutes=offset_minutes)
+    return datetime_utc
+
+
+class RecentUplinks:
+    """
+    Remember the keys of the most recently processed uplinks
+
+    Consecutive TTN queries can return some of the same uplinks. Keeping a
+    bounded set of the latest uplink keys allows these to be skipped.
+    """
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self.keys = collections.OrderedDict()
+
+    def is_new(self, key):
+        """
+        Record an uplink key
+        :param key: hashable that uniquely identifies an uplink
+        :return: bool, False if the key was already seen
+        """
+        if key in self.keys:
+            return False
+        self.keys[key] = None
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+        return True
+
+
+class ApplicationPoller:
+    """
+    Download the uplinks of all devices of a TTN application with one request
+
+    The Inputs of devices in the same application share a poller. The first
+    Input to poll in a period downloads the uplinks of every device, and each
+    Input then takes the uplinks of its own device.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.latest_datetime = None
+        self.last_download = 0
+
+    def register(self, device_id):
+        """ Start collecting uplinks for a device """
+        with self.lock:
+            self.pending.setdefault(device_id, [])
+
+    def unregister(self, device_id):
+        """ Stop collecting uplinks for a device """
+        with self.lock:
+            self.pending.pop(device_id, None)
+
+    def get_uplinks(self, device_id, request_uplinks, after, min_interval):
+        """
+        Return the uplinks received for a device since it was last polled
+        :param device_id: string, TTN device ID
+        :param request_uplinks: function(params, stream) that queries the application's uplinks
+        :param after: datetime (UTC) to download from if the application hasn't been polled yet
+        :param min_interval: float, seconds since the last download before downloading again
+        :return: list of uplink dicts
+        """
+        with self.lock:
+            self.pending.setdefault(device_id, [])
+            if time.time() - self.last_download >= min_interval:
+                start = time.time()
+                # Only after a successful download, so a failed one is retried at the next poll
+                if self.download(request_uplinks, self.latest_datetime or after):
+                    self.last_download = start
+            uplinks = self.pending[device_id]
+            self.pending[device_id] = []
+            return uplinks
+
+    def download(self, request_uplinks, after):
+        """
+        Collect the uplinks of the registered devices received after a time
+        :return: bool, whether the uplinks were downloaded
+        """
+        response = request_uplinks({'after': after.isoformat() + 'Z'}, stream=True)
+        try:
+            if response.status_code != 200:
+                self.logger.info("response.status_code != 200: {}".format(response.reason))
+                return False
+            for each_resp in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                if not each_resp:
+                    continue
+                try:
+                    resp_json = json.loads(each_resp)
+                    device_id = resp_json['result']['end_device_ids']['device_id']
+                    datetime_utc = parse_ttn_timestamp(resp_json['result']['received_at'])
+                except (ValueError, KeyError):
+                    self.logger.error("Could not parse uplink: %s", LogExcerpt(each_resp))
+                    continue
+                if device_id in self.pending:
+                    self.pending[device_id].append(resp_json)
+                if datetime_utc and (not self.latest_datetime or self.latest_datetime < datetime_utc):
+                    self.latest_datetime = datetime_utc
+        finally:
+            response.close()
+        return True
+
+
+def get_application_poller(application_id, logger):
+    """
+    Return the poller shared by the Inputs of a TTN application
+
+    Mycodo loads each Input from its file as a separate module, so module
+    globals aren't shared between Inputs. The pollers are instead kept in a
+    module registered in sys.modules.
+    :param application_id: string, TTN application ID
+    :param logger: logger used by a newly created poller
+    :return: ApplicationPoller
+    """
+    new_registry = types.ModuleType(APPLICATION_POLLER_REGISTRY)
+    new_registry.lock = threading.Lock()
+    new_registry.pollers = {}
+    registry = sys.modules.setdefault(APPLICATION_POLLER_REGISTRY, new_registry)
+    with registry.lock:
+        if application_id not in registry.pollers:
+            registry.pollers[application_id] = ApplicationPoller(logger)
+        return registry.pollers[application_id]
+
+
+class RollingAggregator:
+    """
+    Rolling statistics of CPM and uSv/hr over the last window uplinks
+
+    Each batch is processed with NumPy array operations. The last window - 1
+    values of a batch are carried over to the next, so the statistics of
+    consecutive batches are the same as if the uplinks arrived in one batch.
+    Until window uplinks have been received, the statistics are calculated
+    over the uplinks received so far.
+
+    The confidence bounds treat each CPM value as the count of one minute, so
+    the sum of a window is a Poisson count. The bounds of that count are
+    calculated with Byar's approximation and divided by the number of minutes.
+    """
+    def __init__(self, window):
+        import numpy
+
+        self.numpy = numpy
+        self.window = max(1, int(window))
+        self.cpm = numpy.empty(0)
+        self.usv_h = numpy.empty(0)
+
+    def update(self, cpm, usv_h):
+        """
+        Calculate the statistics at each new uplink
+        :param cpm: sequence of CPM values of the new uplinks, oldest first
+        :param usv_h: sequence of uSv/hr values of the same uplinks
+        :return: dict of statistic name: array with one value per new uplink
+        """
+        np = self.numpy
+        new = len(cpm)
+        cpm = np.concatenate((self.cpm, np.asarray(cpm, dtype=float)))
+        usv_h = np.concatenate((self.usv_h, np.asarray(usv_h, dtype=float)))
+        self.cpm = cpm[len(cpm) - min(len(cpm), self.window - 1):]
+        self.usv_h = usv_h[len(usv_h) - min(len(usv_h), self.window - 1):]
+
+        # Index one past the last value of each window, and its first value
+        end = np.arange(len(cpm) - new + 1, len(cpm) + 1)
+        start = np.maximum(end - self.window, 0)
+        minutes = end - start
+
+        cpm_sum = np.concatenate(([0.0], np.cumsum(cpm)))
+        counts = cpm_sum[end] - cpm_sum[start]
+        usv_h_sum = np.concatenate(([0.0], np.cumsum(usv_h)))
+
+        padded = np.concatenate((np.full(self.window - 1, -np.inf), cpm))
+        windows = np.lib.stride_tricks.sliding_window_view(padded, self.window)
+
+        # Byar's approximation of the Poisson confidence bounds of a count
+        z = POISSON_CONFIDENCE_Z
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower = counts * (1 - 1 / (9 * counts) - z / (3 * np.sqrt(counts))) ** 3
+        lower = np.where(counts > 0, np.maximum(lower, 0), 0)
+        upper = (counts + 1) * (1 - 1 / (9 * (counts + 1)) + z / (3 * np.sqrt(counts + 1))) ** 3
+
+        return {
+            'cpm_mean': counts / minutes,
+            'cpm_max': windows[len(windows) - new:].max(axis=1),
+            'cpm_lower_95': lower / minutes,
+            'cpm_upper_95': upper / minutes,
+            'usv_h_mean': (usv_h_sum[end] - usv_h_sum[start]) / minutes
+        }
+
+
+class ClusterSelector:
+    """
+    Choose the TTN cluster to send a request to
+
+    The average latency of every cluster is measured from the requests sent
+    to it. Requests go to the healthy cluster with the lowest average latency,
+    and clusters not measured yet are tried first, in the order they were
+    configured. A cluster that fails is skipped for CLUSTER_RETRY_SECONDS,
+    doubling with each consecutive failure. When every cluster is failing,
+    they are all tried, in order of their latency.
+    """
+    def __init__(self, clusters, clock=time.monotonic):
+        """
+        :param clusters: list of addresses, with or without scheme (https is assumed)
+        :param clock: function returning the current time in seconds
+        """
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clusters = []
+        for cluster in clusters:
+            cluster = cluster.strip().rstrip('/')
+            if cluster and '://' not in cluster:
+                cluster = 'https://' + cluster
+            if cluster and cluster not in self.clusters:
+                self.clusters.append(cluster)
+        self.latency = {}
+        self.failures = dict.fromkeys(self.clusters, 0)
+        self.retry_at = dict.fromkeys(self.clusters, 0.0)
+
+    def order(self):
+        """
+        Return the clusters in the order they should be tried
+        :return: list of base URLs
+        """
+        now = self.clock()
+        with self.lock:
+            return sorted(self.clusters, key=lambda cluster: (
+                self.retry_at[cluster] > now,
+                self.latency.get(cluster, 0.0),
+                self.clusters.index(cluster)))
+
+    def record(self, cluster, seconds=None):
+        """
+        Record the result of a request
+        :param cluster: base URL the request was sent to
+        :param seconds: float, latency of a successful request, or None if it failed
+        """
+        with self.lock:
+            if seconds is None:
+                self.failures[cluster] += 1
+                self.retry_at[cluster] = self.clock() + min(
+                    CLUSTER_RETRY_SECONDS * 2 ** (self.failures[cluster] - 1), CLUSTER_RETRY_MAX_SECONDS)
+            else:
+                self.failures[cluster] = 0
+                self.retry_at[cluster] = 0.0
+                if cluster in self.latency:
+                    seconds = (CLUSTER_LATENCY_WEIGHT * seconds +
+                               (1 - CLUSTER_LATENCY_WEIGHT) * self.latency[cluster])
+                self.latency[cluster] = seconds
+
+    def summary(self):
+        """ Return the average latency and state of each cluster, in the order they would be tried """
+        now = self.clock()
+        lines = []
+        for cluster in self.order():
+            with self.lock:
+                latency = self.latency.get(cluster)
+                retry_in = self.retry_at[cluster] - now
+            lines.append("{}: {}{}".format(
+                cluster,
+                "latency {:.0f} ms".format(latency * 1000) if latency is not None else "not measured",
+                ", failing, retry in {:.0f} s".format(retry_in) if retry_in > 0 else ""))
+        return "\n".join(lines)
+
+
+class StageMetrics:
+    """
+    Count calls and record latency histograms for the stages of the ingest pipeline
+    """
+    # Upper bounds (seconds) of the histogram buckets. The last bucket is unbounded.
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def record(self, stage, seconds):
+        """
+        Record one call of a stage
+        :param stage: string, name of the stage
+        :param seconds: float, duration of the call
+        """
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {
+                    'count': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'histogram': [0] * (len(self.BUCKETS) + 1)
+                }
+            metrics = self.stages[stage]
+            metrics['count'] += 1
+            metrics['total'] += seconds
+            metrics['max'] = max(metrics['max'], seconds)
+            metrics['histogram'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ Record the duration of the with block as one call of a stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def count(self, counter, amount=1):
+        """ Increment a counter that has no latency """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def summary(self):
+        """
+        Return a readable summary of all stages and counters
+        :return: string
+        """
+        bucket_names = ["<{:g}ms".format(bucket * 1000) for bucket in self.BUCKETS]
+        bucket_names.append(">={:g}ms".format(self.BUCKETS[-1] * 1000))
+        lines = []
+        with self.lock:
+            for stage, metrics in self.stages.items():
+                lines.append("{}: count {}, mean {:.3f} ms, max {:.3f} ms, histogram {}".format(
+                    stage,
+                    metrics['count'],
+                    metrics['total'] / metrics['count'] * 1000,
+                    metrics['max'] * 1000,
+                    ", ".join("{} {}".format(name, count) for name, count in
+                              zip(bucket_names, metrics['histogram']) if count)))
+            for counter, value in self.counters.items():
+                lines.append("{}: {}".format(counter, value))
+        return "\n".join(lines)
+
+
+class InfluxBatchWriter:
+    """
+    Collect measurements and write them to InfluxDB in batches
+
+    Each point keeps its own timestamp. The batch is written when it reaches
+    batch_size points or when its oldest point has waited max_seconds.
+    """
+    def __init__(self, unique_id, logger, metrics, batch_size=500, max_seconds=10):
+        self.unique_id = unique_id
+        self.logger = logger
+        self.metrics = metrics
+        self.batch_size = max(1, int(batch_size))
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.points = []
+        self.oldest_point_time = None
+
+    def add(self, points):
+        """
+        Queue points
+        :param points: iterable of (channel, measurement, unit, value, timestamp_utc) tuples
+        """
+        with self.lock:
+            for channel, measurement, unit, value, timestamp_utc in points:
+                self.points.append(format_influxdb_data(
+                    self.unique_id,
+                    unit,
+                    value,
+                    channel=channel,
+                    measure=measurement,
+                    timestamp=timestamp_utc))
+                if self.oldest_point_time is None:
+                    self.oldest_point_time = time.time()
+            flush = (len(self.points) >= self.batch_size or
+                     (self.oldest_point_time is not None and
+                      time.time() - self.oldest_point_time >= self.max_seconds))
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """ Write all queued points to InfluxDB """
+        with self.lock:
+            points = self.points
+            self.points = []
+            self.oldest_point_time = None
+        if points:
+            self.logger.debug("Writing %d points to influxdb", len(points))
+            with self.metrics.timer('InfluxDB write'):
+                write_influxdb_list(points)
+
+
+class BackgroundUploader:
+    """
+    Run uploads to third-party services on worker threads
+
+    Uploads are queued so a slow or unresponsive service doesn't stall the
+    measurement thread. A failed upload is retried with exponential backoff.
+    When the queue is full, the oldest queued upload is dropped.
+
+    The capture times of uploads that are queued or being retried are kept
+    so the Input's checkpoint doesn't move past them. After a restart, they
+    are downloaded and queued again. Uploads that still fail after their
+    retries, or are dropped, are logged and released so they don't hold the
+    checkpoint back; the upload ledger keeps what was delivered from being
+    sent twice.
+    """
+    def __init__(self, logger, max_size=1000, workers=1, retries=3, backoff_seconds=5):
+        self.logger = logger
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.queue = queue.Queue(maxsize=max(1, int(max_size)))
+        self.stop_event = threading.Event()
+        self.dropped = 0
+        self.undelivered_lock = threading.Lock()
+        self.undelivered = collections.Counter()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self.worker, name="geiger_uploader_{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, name, function, *args, captured_at=None, **kwargs):
+        """
+        Queue an upload
+        :param name: name of the service, used in log messages
+        :param function: callable that performs the upload and raises on failure
+        :param captured_at: datetime (UTC) of the uplink the upload is from
+        """
+        if captured_at:
+            with self.undelivered_lock:
+                self.undelivered[captured_at] += 1
+        job = (name, function, args, kwargs, captured_at)
+        while True:
+            try:
+                self.queue.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    dropped_job = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    self.release(dropped_job[4])
+                    self.logger.error(
+                        "Upload queue full, dropped oldest {} upload (from {})".format(
+                            dropped_job[0], dropped_job[4]))
+                except queue.Empty:
+                    pass
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            try:
+                name, function, args, kwargs, captured_at = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        function(*args, **kwargs)
+                        self.release(captured_at)
+                        break
+                    except Exception as err:
+                        if attempt == self.retries:
+                            self.logger.error("Error adding data to {} (from {}), not retrying: {}".format(
+                                name, captured_at, err))
+                            self.release(captured_at)
+                            break
+                        delay = self.backoff_seconds * 2 ** attempt
+                        self.logger.debug("Error adding data to %s, retrying in %s seconds: %s",
+                                          name, delay, err)
+                        if self.stop_event.wait(delay):
+                            break
+            finally:
+                self.queue.task_done()
+
+    def release(self, captured_at):
+        """ Stop holding the checkpoint for an upload that was delivered, failed, or dropped """
+        if captured_at:
+            with self.undelivered_lock:
+                self.undelivered[captured_at] -= 1
+                if not self.undelivered[captured_at]:
+                    del self.undelivered[captured_at]
+
+    def oldest_undelivered(self):
+        """
+        :return: datetime (UTC) of the oldest uplink with an upload queued or being retried, or None
+        """
+        with self.undelivered_lock:
+            return min(self.undelivered) if self.undelivered else None
+
+    def stop(self, timeout=5):
+        """ Stop the workers, giving them up to timeout seconds to finish the current upload """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        if not self.queue.empty():
+            self.logger.info("Discarding {} queued uploads, they are queued again after a restart".format(
+                self.queue.qsize()))
+
+
+class UploadLedger:
+    """
+    Record of the measurements sent to an external service
+
+    The ledger is a SQLite database next to the Mycodo database, so it
+    survives restarts. When an Input restarts and downloads uplinks again,
+    measurements already in the ledger aren't sent again. Entries older than
+    the retention are deleted when the ledger is opened and once per day, and
+    the freed pages are returned to the file system.
+    """
+    def __init__(self, path, logger, retention_seconds=LEDGER_RETENTION_SECONDS):
+        self.logger = logger
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.last_compaction = None
+        self.closed = False
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            # auto_vacuum only takes effect if set before the first table is created
+            self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "service TEXT NOT NULL, "
+                "device TEXT NOT NULL, "
+                "captured_at TEXT NOT NULL, "
+                "PRIMARY KEY (service, device, captured_at)) WITHOUT ROWID")
+        self.compact()
+
+    def contains(self, service, device, captured_at):
+        """
+        Check if a measurement was sent
+        :param service: string, service and measurement (e.g. 'Safecast cpm')
+        :param device: string, device the measurement is from
+        :param captured_at: datetime (UTC) of the measurement
+        :return: bool
+        """
+        with self.lock:
+            if self.closed:
+                # Called after the Input stopped
+                return False
+            row = self.connection.execute(
+                "SELECT 1 FROM uploads WHERE service = ? AND device = ? AND captured_at = ?",
+                (service, device, captured_at.isoformat())).fetchone()
+        return row is not None
+
+    def add(self, service, device, captured_at):
+        """ Record that a measurement was sent """
+        with self.lock, self.connection:
+            if self.closed:
+                # An upload finished after the Input stopped
+                return
+            self.connection.execute(
+                "INSERT OR IGNORE INTO uploads (service, device, captured_at) VALUES (?, ?, ?)",
+                (service, device, captured_at.isoformat()))
+        if time.time() - self.last_compaction > 86400:
+            self.compact()
+
+    def compact(self):
+        """ Delete entries older than the retention and shrink the file """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention_seconds)
+        with self.lock:
+            with self.connection:
+                deleted = self.connection.execute(
+                    "DELETE FROM uploads WHERE captured_at < ?", (cutoff.isoformat(),)).rowcount
+            if deleted:
+                self.connection.execute("PRAGMA incremental_vacuum")
+            self.last_compaction = time.time()
+        if deleted:
+            self.logger.debug("Deleted %d upload ledger entries older than %s", deleted, cutoff)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.connection.close()
+
+
+class PollAborted(Exception):
+    """ Raised when a request is started after the poll deadline passed or the Input stopped """
+
+
+class PollDeadline:
+    """
+    Bound the time a poll may take, and abort its requests when the Input stops
+
+    Requests get connect and read timeouts that end no later than the
+    deadline. When the deadline passes, responses still being read are
+    aborted. Closing a response doesn't wake a thread that is blocked reading
+    it, so the socket of the response is shut down first.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = []
+        self.deadline = None
+        self.timer = None
+        self.reason = None
+        self.stopped = False
+
+    def begin(self, seconds):
+        """ Start a poll that may take up to seconds """
+        with self.lock:
+            self.deadline = time.monotonic() + seconds
+            self.reason = 'stop' if self.stopped else None
+        self.timer = threading.Timer(seconds, self.abort, ('deadline',))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def end(self):
+        """ End the poll """
+        if self.timer:
+            self.timer.cancel()
+        with self.lock:
+            self.deadline = None
+            self.responses = []
+
+    def remaining(self):
+        """ Return the seconds left until the deadline """
+        if self.deadline is None:
+            return float('inf')
+        return max(0.0, self.deadline - time.monotonic())
+
+    def timeout(self):
+        """
+        Return the (connect, read) timeout of a request started now
+        :return: tuple of floats
+        """
+        remaining = self.remaining()
+        if self.reason or not remaining:
+            raise PollAborted(self.reason or 'deadline')
+        return min(HTTP_CONNECT_TIMEOUT, remaining), min(HTTP_READ_TIMEOUT, remaining)
+
+    def track(self, response):
+        """ Abort the response if the poll is aborted while it's being read """
+        with self.lock:
+            self.responses.append(response)
+            aborted = self.reason is not None
+        if aborted:
+            self.abort_response(response)
+
+    def abort(self, reason):
+        """
+        Abort the responses of the poll
+        :param reason: string, 'deadline' or 'stop'. After 'stop', every request fails.
+        """
+        with self.lock:
+            self.reason = reason
+            if reason == 'stop':
+                self.stopped = True
+            responses = self.responses
+            self.responses = []
+        for response in responses:
+            self.abort_response(response)
+
+    @staticmethod
+    def abort_response(response):
+        connection = getattr(response.raw, '_connection', None)
+        sock = getattr(connection, 'sock', None)
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        response.close()
+
+
 class InputModule(AbstractInput):
     """ A sensor support class that retrieves stored data from The Things Network """
 
@@ -182,10 +1147,33 @@ class InputModule(AbstractInput):
         super(InputModule, self).__init__(input_dev, testing=testing, name=__name__)
 
         self.safecastpy = None
+        self.safecast = None
+        self.http_session = None
         self.interface = None
         self.period = None
         self.latest_datetime = None
         self.first_run = True
+        self.backfill_start = None
+        self.influxdb_writer = None
+        self.uploader = None
+        self.flushed_datetime = None
+        self.checkpoint_datetime = None
+        self.checkpoint_time = 0
+        self.upload_ledger = None
+        self.conversions = {}
+        self.extractors = []
+        self.cluster_selector = None
+        self.recent_uplinks = RecentUplinks()
+        self.metrics = StageMetrics()
+        self.deadline = PollDeadline()
+        self.aggregator = None
+        self.ingest_lock = threading.RLock()
+        self.mqtt_client = None
+        self.mqtt_queue = queue.Queue()
+        self.mqtt_thread = None
+        self.mqtt_stop = threading.Event()
+        # Last uplink stored before the MQTT connection was lost, None while connected
+        self.mqtt_gap_start = None
 
         # Initialize custom options
         self.send_safecast = None
@@ -193,6 +1181,12 @@ class InputModule(AbstractInput):
         self.application_id = None
         self.app_api_key = None
         self.device_id = None
+        self.ttn_clusters = None
+        self.poll_mode = None
+        self.payload_decoding = None
+        self.mqtt_host = None
+        self.mqtt_port = None
+        self.mqtt_use_tls = None
         self.send_safecast = None
         self.safecast_api_key = None
         self.safecast_latitude = None
@@ -202,6 +1196,12 @@ class InputModule(AbstractInput):
         self.send_gmcmap = None
         self.gmcmap_account_id = None
         self.gmcmap_geiger_counter_id = None
+        self.influxdb_batch_size = None
+        self.influxdb_batch_seconds = None
+        self.upload_queue_size = None
+        self.log_excerpt_length = None
+        self.checkpoint_interval = None
+        self.aggregation_window = None
         # Set custom_options
         self.setup_custom_options(
             INPUT_INFORMATION['custom_options'], input_dev)
@@ -214,193 +1214,765 @@ class InputModule(AbstractInput):
 
         self.safecastpy = SafecastPy
 
+        # One keep-alive connection pool for TTN, Safecast, and GMC Map
+        self.http_session = requests.Session()
+        http_adapter = requests.adapters.HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_CONNECTIONS)
+        self.http_session.mount('https://', http_adapter)
+        self.http_session.mount('http://', http_adapter)
+
+        self.safecast = self.safecastpy.SafecastPy(api_key=self.safecast_api_key)
+        # SafecastPy sends requests through its own requests.Session (.client)
+        # with its own headers and parameters. Mount the shared adapter on it so
+        # its connections come from the same pool.
+        if isinstance(getattr(self.safecast, 'client', None), requests.Session):
+            self.safecast.client.mount('https://', http_adapter)
+            self.safecast.client.mount('http://', http_adapter)
+
         self.interface = self.input_dev.interface
         self.period = self.input_dev.period
         self.latest_datetime = self.input_dev.datetime
+        self.flushed_datetime = self.latest_datetime
+        self.checkpoint_datetime = self.latest_datetime
+        self.checkpoint_time = time.time()
+
+        self.influxdb_writer = InfluxBatchWriter(
+            self.unique_id, self.logger, self.metrics,
+            batch_size=self.influxdb_batch_size,
+            max_seconds=self.influxdb_batch_seconds)
+
+        self.uploader = BackgroundUploader(
+            self.logger, max_size=self.upload_queue_size)
+
+        if self.send_safecast:
+            self.upload_ledger = UploadLedger(
+                os.path.join(os.path.dirname(SQL_DATABASE_MYCODO), UPLOAD_LEDGER_FILENAME),
+                self.logger)
+
+        self.extractors = self.compile_extractors()
+
+        self.cluster_selector = ClusterSelector(self.ttn_clusters.split(','))
 
-    def get_new_data(self, past_seconds):
-        # Basic implementation. Future development may use more complex library to access API
-        endpoint = "https://nam1.cloud.thethings.network/api/v3/as/applications/{app}/devices/{dev}/packages/storage/uplink_message?last={time}&field_mask=up.uplink_message.decoded_payload".format(
-            app=self.application_id, dev=self.device_id, time="{}s".format(int(past_seconds)))
+        if any(self.is_enabled(channel) for channel in AGGREGATE_CHANNELS):
+            try:
+                self.aggregator = RollingAggregator(self.aggregation_window)
+            except ImportError:
+                self.logger.error(
+                    "The CPM mean, maximum, and confidence bound and μSv/hr mean channels require {req}, "
+                    "which isn't installed. Install it with 'pip install {req}' in Mycodo's environment. "
+                    "These channels aren't stored until then.".format(req=AGGREGATION_REQUIREMENT))
+
+        if self.poll_mode == 'application':
+            get_application_poller(self.application_id, self.logger).register(self.device_id)
+        elif self.poll_mode == 'mqtt':
+            try:
+                import paho.mqtt.client
+            except ImportError:
+                self.logger.error(
+                    "MQTT Push mode requires {req}, which isn't installed. Install it with "
+                    "'pip install {req}' in Mycodo's environment. Polling Data Storage (Device mode) "
+                    "until then.".format(req=MQTT_REQUIREMENT))
+                self.poll_mode = 'device'
+
+    def stop_input(self):
+        """ Write queued measurements and the checkpoint, stop the uploader, and close connections """
+        # Interrupt a poll that is downloading, then store what it processed
+        self.deadline.abort('stop')
+        if self.mqtt_client:
+            # The network loop sends the DISCONNECT, so stop it afterwards
+            self.mqtt_client.disconnect()
+            self.mqtt_client.loop_stop()
+        if self.mqtt_thread:
+            # Let the worker finish the uplink it is storing before the ledger is closed
+            self.mqtt_stop.set()
+            self.mqtt_thread.join(5)
+        if self.uploader:
+            self.uploader.stop()
+        # After the uploader, so the checkpoint stays before the uploads it didn't deliver
+        if self.influxdb_writer:
+            self.save_progress(force=True)
+        if self.upload_ledger:
+            self.upload_ledger.close()
+        if self.http_session:
+            self.http_session.close()
+        if self.poll_mode == 'application':
+            get_application_poller(self.application_id, self.logger).unregister(self.device_id)
+        super(InputModule, self).stop_input()
+
+    def get_conversion(self, channel):
+        """
+        Return the Conversion of a channel from memory, only querying the
+        database when the channel's conversion_id differs from the cached one
+        :param channel: int, measurement channel
+        :return: Conversion or None
+        """
+        conversion_id = self.channels_measurement[channel].conversion_id
+        if channel not in self.conversions or self.conversions[channel][0] != conversion_id:
+            conversion = None
+            if conversion_id:
+                conversion = db_retrieve_table_daemon(Conversion, unique_id=conversion_id)
+            self.conversions[channel] = (conversion_id, conversion)
+        return self.conversions[channel][1]
+
+    def submit_safecast(self, value, unit, timestamp):
+        """ Queue a measurement for Safecast, unless the ledger shows it was already sent """
+        if self.upload_ledger.contains('Safecast {}'.format(unit), self.device_id, timestamp):
+            self.logger.debug("Skipping Safecast %s measurement from %s, already sent", unit, timestamp)
+            return
+        self.uploader.submit('Safecast', self.upload_safecast, value, unit, timestamp, captured_at=timestamp)
+
+    def upload_safecast(self, value, unit, timestamp):
+        """ Send one measurement to Safecast """
+        with self.metrics.timer('Safecast upload'):
+            measurement = self.safecast.add_measurement(json={
+                'latitude': self.safecast_latitude,
+                'longitude': self.safecast_longitude,
+                'value': value,
+                'unit': unit,
+                'captured_at': timestamp.isoformat() + '+00:00',
+                'device_id': self.safecast_device_id,
+                'location_name': self.safecast_location_name
+            })
+        self.logger.debug('Safecast %s measurement id: %s', unit, measurement['id'])
+        self.upload_ledger.add('Safecast {}'.format(unit), self.device_id, timestamp)
+
+    def upload_gmcmap(self, cpm_value, usv_h_value):
+        """ Send the latest measurement to GMC Map """
+        gmcmap = 'http://www.GMCmap.com/log2.asp?AID={aid}&GID={gcid}&CPM={cpm:.0f}&uSV={usv:.3f}'.format(
+            aid=self.gmcmap_account_id,
+            gcid=self.gmcmap_geiger_counter_id,
+            cpm=cpm_value,
+            usv=usv_h_value)
+        with self.metrics.timer('GMC Map upload'):
+            response = self.http_session.get(gmcmap, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        response.raise_for_status()
+        self.logger.debug("GMCMap: %s", LogExcerpt(response.content, self.log_excerpt_length))
+
+    def request_uplinks(self, params, stream=False, application=False):
+        """
+        Query the TTN Data Storage Integration for the device's uplinks
+        :param params: dict of query parameters (last, after, before)
+        :param stream: bool, stream the response body
+        :param application: bool, query the uplinks of all devices in the application
+        :return: requests.Response of the first cluster that responded with 200 OK, or of the last cluster tried
+        :raises PollAborted: if the poll deadline passed or the Input is stopping
+        :raises requests.exceptions.RequestException: if no cluster responded
+        """
+        if application:
+            path = "/api/v3/as/applications/{app}/packages/storage/uplink_message".format(
+                app=self.application_id)
+        else:
+            path = "/api/v3/as/applications/{app}/devices/{dev}/packages/storage/uplink_message".format(
+                app=self.application_id, dev=self.device_id)
+        if application:
+            # Inputs sharing the application poller may decode differently
+            field_mask = ','.join((FIELD_MASK_RAW, FIELD_MASK_DECODED))
+        elif self.payload_decoding == 'ttn':
+            field_mask = FIELD_MASK_DECODED
+        else:
+            field_mask = FIELD_MASK_RAW
+        params = dict(params, field_mask=field_mask)
         headers = {
             "Authorization": "Bearer {k}".format(k=self.app_api_key),
             'Content-Type': 'application/json'
         }
-        timestamp_format = '%Y-%m-%dT%H:%M:%S.%f'
 
-        response = requests.get(endpoint, headers=headers)
-        if response.status_code != 200:
-            self.logger.info("response.status_code != 200: {}".format(response.reason))
-        self.logger.debug("response.content: {}".format(response.content))
+        response = None
+        error = None
+        for i, cluster in enumerate(self.cluster_selector.order()):
+            if i:
+                self.metrics.count('cluster failovers')
+                self.logger.info("Could not request uplinks from {}: {}. Trying {}".format(
+                    previous, error, cluster))
+            previous = cluster
+            timeout = self.deadline.timeout()
+            start = time.perf_counter()
+            try:
+                with self.metrics.timer('HTTP fetch'):
+                    # Always stream, so the body can be aborted while it's downloading
+                    response = self.http_session.get(
+                        cluster + path, params=params, headers=headers, stream=True, timeout=timeout)
+                    self.deadline.track(response)
+                    latency = time.perf_counter() - start
+                    if response.status_code == 200 and not stream:
+                        # Download the body here, where it's still timed and can be aborted
+                        response.content
+            except requests.exceptions.RequestException as err:
+                if self.deadline.reason:
+                    raise
+                self.cluster_selector.record(cluster)
+                response = None
+                error = err
+                continue
+
+            if response.status_code == 200:
+                self.cluster_selector.record(cluster, latency)
+                return response
+            self.cluster_selector.record(cluster)
+            error = "{} {}".format(response.status_code, response.reason)
+            response.close()
+
+        if response is None:
+            raise requests.exceptions.ConnectionError(
+                "Could not request uplinks from any TTN cluster: {}".format(error))
+        return response
+
+    def get_new_data(self, past_seconds=None, after=None):
+        """
+        Download and store uplinks from the TTN Data Storage Integration
+        :param past_seconds: int, download uplinks received in the past number of seconds
+        :param after: datetime (UTC), download uplinks received after this time (overrides past_seconds)
+        """
+        if after:
+            params = {'after': after.isoformat() + 'Z'}
+        else:
+            params = {'last': "{}s".format(int(past_seconds))}
+
+        # Stream the response and handle one uplink (line) at a time so memory
+        # use stays flat regardless of how large the backlog is
+        response = self.request_uplinks(params, stream=True)
+        try:
+            if response.status_code != 200:
+                self.logger.info("response.status_code != 200: {}".format(response.reason))
+                return
+            cpm_value, usv_h_value = self.parse_uplinks(
+                response.iter_lines(chunk_size=STREAM_CHUNK_SIZE))
+        finally:
+            response.close()
 
-        list_dicts = response.content.decode().split("\n")
-        self.logger.debug("list_dicts: {}".format(list_dicts))
+        self.send_gmcmap_latest(cpm_value, usv_h_value)
+        self.save_progress()
 
+    def get_application_data(self):
+        """ Store the uplinks of this device from the application-wide poller """
+        poller = get_application_poller(self.application_id, self.logger)
+        uplinks = poller.get_uplinks(
+            self.device_id,
+            lambda params, stream: self.request_uplinks(params, stream=stream, application=True),
+            self.latest_datetime or datetime.datetime.utcnow() - datetime.timedelta(seconds=self.period),
+            self.period / 2)
+        cpm_value, usv_h_value = self.process_uplinks(uplinks)
+        self.send_gmcmap_latest(cpm_value, usv_h_value)
+        self.save_progress()
+
+    def start_mqtt(self):
+        """ Subscribe to the device's uplinks on the TTN MQTT server """
+        import paho.mqtt.client as mqtt
+
+        self.mqtt_client = mqtt.Client(client_id="mycodo_{}".format(self.unique_id))
+        self.mqtt_client.username_pw_set(
+            "{}@ttn".format(self.application_id), password=self.app_api_key)
+        if self.mqtt_use_tls:
+            self.mqtt_client.tls_set()
+        self.mqtt_client.on_connect = self.mqtt_on_connect
+        self.mqtt_client.on_disconnect = self.mqtt_on_disconnect
+        self.mqtt_client.on_message = self.mqtt_on_message
+        self.mqtt_client.connect_async(self.mqtt_host, port=int(self.mqtt_port), keepalive=60)
+        self.mqtt_client.loop_start()
+
+        self.mqtt_thread = threading.Thread(
+            target=self.mqtt_worker, name="geiger_mqtt_{}".format(self.unique_id), daemon=True)
+        self.mqtt_thread.start()
+
+    def mqtt_on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.logger.error("Could not connect to MQTT server (return code {})".format(rc))
+            return
+        topic = "v3/{app}@ttn/devices/{dev}/up".format(app=self.application_id, dev=self.device_id)
+        client.subscribe(topic)
+        self.logger.debug("Subscribed to %s", topic)
+        # Uplinks may have arrived while (re)connecting
+        self.mark_mqtt_gap()
+
+    def mqtt_on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            self.logger.info("Disconnected from MQTT server, reconnecting")
+        self.mark_mqtt_gap()
+
+    def mark_mqtt_gap(self):
+        """
+        Remember where the uplinks missed over MQTT start. Uplinks received
+        after a reconnect advance latest_datetime before the next poll, so the
+        gap is filled from the last uplink stored before it instead.
+        """
+        if self.mqtt_gap_start is None:
+            self.mqtt_gap_start = self.latest_datetime
+
+    def mqtt_on_message(self, client, userdata, msg):
+        # Hand the uplink to the worker so the MQTT network thread is never blocked
+        self.mqtt_queue.put(msg.payload)
+
+    def mqtt_worker(self):
+        """ Store uplinks received over MQTT as they arrive """
+        while not self.mqtt_stop.is_set():
+            try:
+                payload = self.mqtt_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                for uplink in self.decode_uplinks([payload]):
+                    # MQTT delivers the uplink itself, Data Storage wraps it in 'result'
+                    with self.ingest_lock:
+                        cpm_value, usv_h_value = self.process_uplinks([{'result': uplink}])
+                        self.send_gmcmap_latest(cpm_value, usv_h_value)
+            except Exception:
+                # Keep the worker running, so the following uplinks are still stored
+                self.logger.exception("Could not store uplink received over MQTT: %s", LogExcerpt(payload))
+
+    def fetch_window(self, start, end):
+        """
+        Request the uplinks of one backfill window, retrying on failure
+        :param start: datetime (UTC), start of the window
+        :param end: datetime (UTC), end of the window
+        :return: requests.Response with the body not read yet, or None if the request failed
+        """
+        for attempt in range(BACKFILL_RETRIES + 1):
+            if not self.running:
+                return None
+            try:
+                response = self.request_uplinks({
+                    'after': start.isoformat() + 'Z',
+                    'before': end.isoformat() + 'Z'
+                }, stream=True)
+                if response.status_code == 200:
+                    return response
+                error = "{} {}".format(response.status_code, response.reason)
+                response.close()
+            except PollAborted:
+                return None
+            except requests.exceptions.RequestException as err:
+                error = err
+            self.logger.debug("Could not download uplinks from %s to %s (attempt %d): %s",
+                              start, end, attempt + 1, error)
+            if (attempt < BACKFILL_RETRIES and
+                    not self.deadline.reason and
+                    self.deadline.remaining() > 2 ** attempt):
+                time.sleep(2 ** attempt)
+        return None
+
+    def backfill(self, start, end):
+        """
+        Download and store the uplinks between start and end
+
+        The range is split into windows that are requested concurrently and
+        processed in order. Each window's response is streamed and handled one
+        uplink at a time, like a poll. Progress is saved after every window, so
+        if a window can't be downloaded, the backfill can resume from that window.
+        :param start: datetime (UTC)
+        :param end: datetime (UTC)
+        :return: datetime (UTC) to resume the backfill from, or None if it completed
+        """
+        window = datetime.timedelta(seconds=BACKFILL_WINDOW_SECONDS)
+        windows = []
+        while start < end:
+            windows.append((start, min(start + window, end)))
+            start += window
+
+        cpm_latest = None
+        usv_h_latest = None
+        resume_from = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as executor:
+            futures = collections.deque()
+            next_window = 0
+            try:
+                for i, (window_start, window_end) in enumerate(windows, 1):
+                    # Keep at most BACKFILL_WORKERS windows requested or waiting to be processed
+                    while next_window < len(windows) and len(futures) < BACKFILL_WORKERS:
+                        futures.append(executor.submit(self.fetch_window, *windows[next_window]))
+                        next_window += 1
+
+                    response = futures.popleft().result()
+                    processed = False
+                    if response is not None:
+                        try:
+                            cpm_value, usv_h_value = self.parse_uplinks(
+                                response.iter_lines(chunk_size=STREAM_CHUNK_SIZE))
+                            # A response aborted by the deadline or stop can end without an error
+                            processed = not self.deadline.reason
+                        except requests.exceptions.RequestException as err:
+                            self.logger.debug("Download of uplinks from %s to %s failed: %s",
+                                              window_start, window_end, err)
+                        finally:
+                            response.close()
+
+                    if processed:
+                        if cpm_value and usv_h_value:
+                            cpm_latest = cpm_value
+                            usv_h_latest = usv_h_value
+                        self.save_progress()
+                        self.logger.info("Backfill window {}/{} ({} to {}) processed".format(
+                            i, len(windows), window_start, window_end))
+                        continue
+
+                    # Store what was processed of the window, and resume from its start
+                    self.save_progress()
+                    resume_from = window_start
+                    if self.deadline.reason == 'deadline':
+                        self.metrics.count('polls cut short')
+                        self.logger.info(
+                            "Backfill reached the poll deadline at {}. "
+                            "Backfill will resume from there next period.".format(window_start))
+                    elif self.running and not self.deadline.reason:
+                        self.logger.error(
+                            "Could not download uplinks from {} to {}. "
+                            "Backfill will resume from there next period.".format(
+                                window_start, window_end))
+                    break
+            finally:
+                # Close the responses of windows requested but not processed
+                for each_future in futures:
+                    if not each_future.cancel():
+                        response = each_future.result()
+                        if response is not None:
+                            response.close()
+
+        self.send_gmcmap_latest(cpm_latest, usv_h_latest)
+        return resume_from
+
+    def decode_uplinks(self, lines):
+        """
+        Decode NDJSON lines from the TTN Data Storage Integration
+        :param lines: iterable of bytes, one JSON-encoded uplink per line
+        :return: generator of uplink dicts
+        """
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for each_resp in lines:
+            if not each_resp:
+                continue
+            if debug:
+                self.logger.debug("each_resp: %s", LogExcerpt(each_resp, self.log_excerpt_length))
+            start = time.perf_counter()
+            try:
+                resp_json = json.loads(each_resp)
+            except ValueError:
+                self.logger.error("Could not parse uplink: %s", LogExcerpt(each_resp, self.log_excerpt_length))
+                continue
+            self.metrics.record('JSON decode', time.perf_counter() - start)
+            yield resp_json
+
+    def parse_uplinks(self, lines):
+        """
+        Parse and store the uplinks from an iterable of NDJSON lines
+        :param lines: iterable of bytes, one JSON-encoded uplink per line
+        :return: tuple of the CPM and uSv/hr values of the last uplink
+        """
+        return self.process_uplinks(self.decode_uplinks(lines))
+
+    def process_uplinks(self, uplinks):
+        """
+        Store decoded uplinks and queue their uploads
+        :param uplinks: iterable of uplink dicts
+        :return: tuple of the CPM and uSv/hr values of the last uplink
+        """
         cpm_value = None
         cpm_ts = None
         usv_h_value = None
         usv_h_ts = None
+        batch_timestamps = []
+        batch_cpm = []
+        batch_usv_h = []
 
-        for each_resp in list_dicts:
-            if not each_resp:
-                continue
-            self.logger.debug("each_resp: {}".format(each_resp))
-
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for resp_json in uplinks:
             cpm_value = None
             usv_h_value = None
+            if debug:
+                self.logger.debug("resp_json: %s", LogExcerpt(resp_json, self.log_excerpt_length))
 
-            try:
-                resp_json = json.loads(each_resp)
-            except:
-                resp_json = {}
-            self.logger.debug("resp_json: {}".format(resp_json))
-
-            self.return_dict = measurements_dict.copy()
+            start = time.perf_counter()
+            datetime_utc = parse_ttn_timestamp(resp_json['result']['received_at'])
+            self.metrics.record('timestamp parse', time.perf_counter() - start)
+            if datetime_utc is None:
+                self.logger.error("Could not parse timestamp: {}".format(
+                    resp_json['result']['received_at']))
+                continue
 
-            try:
-                datetime_utc = datetime.datetime.strptime(
-                    resp_json['result']['received_at'][:-7], timestamp_format)
-            except:
-                # Sometimes the original timestamp is in milliseconds
-                # instead of nanoseconds. Therefore, remove 3 less digits
-                # past the decimal and try again to parse.
-                try:
-                    datetime_utc = datetime.datetime.strptime(
-                        resp_json['result']['received_at'][:-4], timestamp_format)
-                except:
-                    self.logger.error("Could not parse timestamp: {}".format(
-                        resp_json['result']['received_at']))
-                    return
+            uplink_key = (
+                resp_json['result'].get('end_device_ids', {}).get('device_id', self.device_id),
+                resp_json['result']['received_at'])
+            if not self.recent_uplinks.is_new(uplink_key):
+                if debug:
+                    self.logger.debug("Skipping already processed uplink from %s", uplink_key[1])
+                continue
 
             if (not self.latest_datetime or
                     self.latest_datetime < datetime_utc):
                 self.latest_datetime = datetime_utc
 
-            for channel in self.return_dict:
-                if (self.is_enabled(channel) and
-                        self.return_dict[channel]['name'] in resp_json['result']['uplink_message']['decoded_payload'] and
-                        resp_json['result']['uplink_message']['decoded_payload'][self.return_dict[channel]['name']] is not None):
-
-                    self.return_dict[channel]['value'] = resp_json['result']['uplink_message']['decoded_payload'][self.return_dict[channel]['name']]
-                    self.return_dict[channel]['timestamp_utc'] = datetime_utc
-
-                    if self.return_dict[channel]['unit'] == 'cpm':
-                        cpm_value = float(self.return_dict[channel]['value'])
-                        cpm_ts = self.return_dict[channel]['timestamp_utc']
-                    elif self.return_dict[channel]['unit'] == 'uSv_hr':
-                        usv_h_value = float(self.return_dict[channel]['value'])
-                        usv_h_ts = self.return_dict[channel]['timestamp_utc']
-
-
-                    # Convert value/unit if conversion_id present and valid
-                    if self.channels_conversion[channel]:
-                        conversion = db_retrieve_table_daemon(
-                            Conversion, unique_id=self.channels_measurement[channel].conversion_id)
-                        if conversion:
-                            meas = parse_measurement(
-                                self.channels_conversion[channel],
-                                self.channels_measurement[channel],
-                                self.return_dict,
-                                channel,
-                                self.return_dict[channel],
-                                timestamp=datetime_utc)
-
-                            self.return_dict[channel]['unit'] = meas[channel]['unit']
-                            self.return_dict[channel]['value'] = meas[channel]['value']
-
-            if 'value' in self.return_dict[0] and 'value' in self.return_dict[1]:
-                self.logger.debug("Adding measurements to influxdb: {}".format(self.return_dict))
-                add_measurements_influxdb(
-                    self.unique_id, self.return_dict,
-                    use_same_timestamp=INPUT_INFORMATION['measurements_use_same_timestamp'])
-            else:
+            payload = self.decode_payload(resp_json['result'])
+            if payload is None:
+                continue
+
+            points = self.extract_points(payload, datetime_utc)
+            if points:
+                self.influxdb_writer.add(points)
+            elif debug:
                 self.logger.debug("No measurements to add to influxdb.")
 
-            # Send uSv/hr to Safecast
+            cpm_value = payload.get('cpm')
+            usv_h_value = payload.get('usv_h')
+            if cpm_value is not None and usv_h_value is not None:
+                cpm_value = float(cpm_value)
+                usv_h_value = float(usv_h_value)
+                cpm_ts = usv_h_ts = datetime_utc
+                batch_timestamps.append(datetime_utc)
+                batch_cpm.append(cpm_value)
+                batch_usv_h.append(usv_h_value)
+
+            # Send uSv/hr and CPM to Safecast
             if self.send_safecast and cpm_value and usv_h_value:
-                try:
-                    safecast = self.safecastpy.SafecastPy(api_key=self.safecast_api_key)
-                    measurement_usv = safecast.add_measurement(json={
-                        'latitude': self.safecast_latitude,
-                        'longitude': self.safecast_longitude,
-                        'value': usv_h_value,
-                        'unit': self.safecastpy.UNIT_USV,
-                        'captured_at': usv_h_ts.isoformat() + '+00:00',
-                        'device_id': self.safecast_device_id,
-                        'location_name': self.safecast_location_name
-                    })
-                    measurement_cpm = safecast.add_measurement(json={
-                        'latitude': self.safecast_latitude,
-                        'longitude': self.safecast_longitude,
-                        'value': cpm_value,
-                        'unit': self.safecastpy.UNIT_CPM,
-                        'captured_at': cpm_ts.isoformat() + '+00:00',
-                        'device_id': self.safecast_device_id,
-                        'location_name': self.safecast_location_name
-                    })
-                    self.logger.debug('uSv/hr measurement id: {0}'.format(measurement_usv['id']))
-                    self.logger.debug('CPM measurement id: {0}'.format(measurement_cpm['id']))
-                except Exception as e:
-                    self.logger.error("Error adding data to Safecast: {}".format(e))
-
-        # Send to GMC Map (doesn't accept time, so can only send the latest measurement)
+                self.submit_safecast(usv_h_value, self.safecastpy.UNIT_USV, usv_h_ts)
+                self.submit_safecast(cpm_value, self.safecastpy.UNIT_CPM, cpm_ts)
+
+        if self.aggregator and batch_timestamps:
+            self.add_aggregates(batch_timestamps, batch_cpm, batch_usv_h)
+
+        return cpm_value, usv_h_value
+
+    def compile_extractors(self):
+        """
+        Build the list of payload fields to store, for the enabled channels only
+        :return: list of (channel, payload field, measurement, unit) tuples
+        """
+        extractors = []
+        for channel, measurement in measurements_dict.items():
+            if channel in AGGREGATE_CHANNELS or not self.is_enabled(channel):
+                continue
+            extractors.append((
+                channel,
+                measurement['name'],
+                measurement['measurement'],
+                measurement['unit']))
+        return extractors
+
+    def convert(self, channel, conversion, measurement, unit, value, timestamp_utc):
+        """
+        Convert the value of a channel with its Conversion
+        :return: tuple of the converted unit and value
+        """
+        measurement_dict = {channel: {'measurement': measurement, 'unit': unit, 'value': value}}
+        meas = parse_measurement(
+            conversion,
+            self.channels_measurement[channel],
+            measurement_dict,
+            channel,
+            measurement_dict[channel],
+            timestamp=timestamp_utc)
+        return meas[channel]['unit'], meas[channel]['value']
+
+    def extract_points(self, payload, datetime_utc):
+        """
+        Return the points of the enabled channels in a payload
+        :param payload: dict of field name: value
+        :param datetime_utc: datetime (UTC) of the uplink
+        :return: list of (channel, measurement, unit, value, timestamp_utc) tuples
+        """
+        points = []
+        for channel, field, measurement, unit in self.extractors:
+            value = payload.get(field)
+            if value is None:
+                continue
+            # Looked up per uplink, so a changed conversion_id takes effect without a restart
+            conversion = self.get_conversion(channel)
+            if conversion:
+                with self.metrics.timer('conversion'):
+                    unit, value = self.convert(channel, conversion, measurement, unit, value, datetime_utc)
+            points.append((channel, measurement, unit, value, datetime_utc))
+        return points
+
+    def decode_payload(self, uplink):
+        """
+        Return the fields of an uplink's payload
+        :param uplink: dict, TTN ApplicationUp message
+        :return: dict of field name: value, or None if the payload can't be decoded
+        """
+        uplink_message = uplink.get('uplink_message', {})
+        if self.payload_decoding == 'ttn':
+            payload = uplink_message.get('decoded_payload')
+            if payload is None:
+                self.logger.error("Uplink from {} has no decoded payload. Is the payload formatter set up in the TTN console?".format(
+                    uplink.get('received_at')))
+            return payload
+
+        with self.metrics.timer('payload decode'):
+            payload = decode_frm_payload(
+                uplink_message.get('frm_payload'),
+                cpm_sflt16=self.payload_decoding == 'local_sflt16')
+        if payload is None:
+            self.logger.error("Could not decode payload of uplink from %s: %s",
+                              uplink.get('received_at'),
+                              LogExcerpt(uplink_message.get('frm_payload'), self.log_excerpt_length))
+        return payload
+
+    def add_aggregates(self, timestamps, cpm, usv_h):
+        """
+        Add the rolling statistics of a batch of uplinks to the InfluxDB batch
+        :param timestamps: list of datetimes (UTC) of the uplinks
+        :param cpm: list of CPM values of the uplinks
+        :param usv_h: list of uSv/hr values of the uplinks
+        """
+        with self.metrics.timer('aggregation'):
+            statistics = self.aggregator.update(cpm, usv_h)
+            for channel in AGGREGATE_CHANNELS:
+                if not self.is_enabled(channel):
+                    continue
+                measurement = measurements_dict[channel]
+                self.influxdb_writer.add(zip(
+                    itertools.repeat(channel),
+                    itertools.repeat(measurement['measurement']),
+                    itertools.repeat(measurement['unit']),
+                    statistics[measurement['name']].tolist(),
+                    timestamps))
+
+    def send_gmcmap_latest(self, cpm_value, usv_h_value):
+        """ Send to GMC Map (doesn't accept time, so can only send the latest measurement) """
         if (self.send_gmcmap and
                 cpm_value and
                 usv_h_value):
-            try:
-                gmcmap = 'http://www.GMCmap.com/log2.asp?AID=02376&GID=22044260632&CPM={cpm:.0f}&uSV={usv:.3f}'.format(
-                    aid=self.gmcmap_account_id,
-                    gcid=self.gmcmap_geiger_counter_id,
-                    cpm=cpm_value,
-                    usv=usv_h_value)
-                contents = urllib.request.urlopen(gmcmap).read()
-                self.logger.debug("GMCMap: {}".format(contents))
-            except Exception as e:
-                self.logger.error("Error adding data to GMC Map: {}".format(e))
-
-        # set datetime to latest timestamp
-        if self.running:
-            with session_scope(MYCODO_DB_PATH) as new_session:
-                mod_input = new_session.query(Input).filter(
-                    Input.unique_id == self.unique_id).first()
-                if not mod_input.datetime or mod_input.datetime < self.latest_datetime:
-                    mod_input.datetime = self.latest_datetime
-                    new_session.commit()
+            # Only the latest measurement matters to GMC Map, so it doesn't hold the checkpoint
+            self.uploader.submit('GMC Map', self.upload_gmcmap, cpm_value, usv_h_value)
+
+    def save_progress(self, force=False):
+        """
+        Write the queued measurements and checkpoint the timestamp of the
+        latest uplink processed
+
+        The checkpoint is kept in memory and saved to the database every
+        checkpoint_interval seconds, and when the Input stops. After a crash,
+        downloads resume from the last saved checkpoint.
+        :param force: bool, save the checkpoint regardless of the interval
+        """
+        # Write what is left of the batch before moving the checkpoint forward,
+        # so the checkpoint never gets ahead of what is in InfluxDB. The lock
+        # keeps MQTT uplinks from being processed in between.
+        with self.ingest_lock:
+            self.influxdb_writer.flush()
+            self.flushed_datetime = self.checkpoint_limit()
+
+        if force or time.time() - self.checkpoint_time >= self.checkpoint_interval:
+            self.write_checkpoint()
+
+    def checkpoint_limit(self):
+        """
+        The latest uplink processed, or the last one before the oldest uplink
+        with an upload queued or being retried, so a restart downloads and uploads it again
+        :return: datetime (UTC) or None
+        """
+        oldest_undelivered = self.uploader.oldest_undelivered() if self.uploader else None
+        if (oldest_undelivered and self.latest_datetime and
+                oldest_undelivered <= self.latest_datetime):
+            # Downloads resume after the checkpoint
+            return oldest_undelivered - datetime.timedelta(microseconds=1)
+        return self.latest_datetime
+
+    def write_checkpoint(self):
+        """ Save the in-memory checkpoint to the database, if it moved forward """
+        if (not self.flushed_datetime or
+                (self.checkpoint_datetime and self.checkpoint_datetime >= self.flushed_datetime)):
+            return
+
+        with self.metrics.timer('checkpoint'), session_scope(MYCODO_DB_PATH) as new_session:
+            mod_input = new_session.query(Input).filter(
+                Input.unique_id == self.unique_id).first()
+            if not mod_input.datetime or mod_input.datetime < self.flushed_datetime:
+                mod_input.datetime = self.flushed_datetime
+                new_session.commit()
+        self.checkpoint_datetime = self.flushed_datetime
+        self.checkpoint_time = time.time()
+
+    def show_metrics(self, args_dict):
+        """ Custom action: return the pipeline metrics """
+        summary = self.metrics.summary() or "No metrics recorded yet"
+        if self.cluster_selector:
+            summary += "\nTTN clusters:\n" + self.cluster_selector.summary()
+        self.logger.info("Pipeline metrics:\n{}".format(summary))
+        return summary
 
     def get_measurement(self):
         """ Gets the data """
-        if self.first_run:
+        start = time.monotonic()
+        self.deadline.begin(self.period * POLL_DEADLINE_FRACTION)
+        try:
+            with self.ingest_lock:
+                self.get_data()
+        except (PollAborted, requests.exceptions.RequestException) as err:
+            if self.deadline.reason == 'deadline':
+                self.metrics.count('polls cut short')
+                self.logger.info("Poll reached its deadline of {:.0f} seconds, continuing next period".format(
+                    self.period * POLL_DEADLINE_FRACTION))
+            elif not self.deadline.reason:
+                self.logger.error("Could not download uplinks: {}".format(err))
+            if self.poll_mode == 'mqtt':
+                self.mark_mqtt_gap()
+            # Store what was processed before the poll was interrupted
+            self.save_progress()
+        finally:
+            self.deadline.end()
+        self.count_overrun(time.monotonic() - start)
+
+        if self.poll_mode == 'mqtt' and not self.mqtt_client and not self.first_run:
+            # Subscribe once the first download has set where to continue from
+            self.start_mqtt()
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Pipeline metrics:\n%s", self.metrics.summary())
+
+        return {}
+
+    def count_overrun(self, elapsed):
+        """ Count a poll that took longer than the period, and the periods it skipped """
+        if elapsed > self.period:
+            self.metrics.count('polls overrun')
+            self.metrics.count('periods skipped', int(elapsed // self.period))
+            self.logger.warning("Poll took {:.1f} seconds, longer than the period of {} seconds".format(
+                elapsed, self.period))
+
+    def get_data(self):
+        """ Download and store uplinks from Data Storage, depending on the mode """
+        if self.first_run or self.backfill_start:
             # Get data for up to 7 days (longest Data Storage Integration
             # stores data) in the past or until last_datetime.
-            seconds_seven_days = 604800  # 604800 seconds = 7 days
-            seconds_download = seconds_seven_days
             start = time.time()
-            self.first_run = False
+            utc_now = datetime.datetime.utcnow()
 
-            if self.latest_datetime:
-                utc_now = datetime.datetime.utcnow()
-                seconds_since_last = (utc_now - self.latest_datetime).total_seconds()
-                if seconds_since_last < seconds_seven_days:
-                    seconds_download = seconds_since_last
-
-            if seconds_download == seconds_seven_days:
-                self.logger.info(
-                    "This appears to be the first data download. "
-                    "Downloading and parsing past 7 days of data...".format(
-                        seconds_download))
+            if self.backfill_start:
+                backfill_start = self.backfill_start
+                self.logger.info("Resuming backfill from {}...".format(backfill_start))
             else:
-                self.logger.info(
-                    "Downloading and parsing past {} seconds of data...".format(
-                        int(seconds_download)))
+                backfill_start = utc_now - datetime.timedelta(seconds=SECONDS_SEVEN_DAYS)
+                if self.latest_datetime and self.latest_datetime > backfill_start:
+                    backfill_start = self.latest_datetime
+                    self.logger.info(
+                        "Downloading and parsing past {} seconds of data...".format(
+                            int((utc_now - backfill_start).total_seconds())))
+                else:
+                    self.logger.info(
+                        "This appears to be the first data download. "
+                        "Downloading and parsing past 7 days of data...")
+            self.first_run = False
 
-            self.get_new_data(seconds_download)
+            self.backfill_start = self.backfill(backfill_start, utc_now)
 
-            if seconds_download == seconds_seven_days:
-                elapsed = time.time() - start
-                self.logger.info(
-                    "Download and parsing completed in {} seconds.".format(
-                        int(elapsed)))
+            self.logger.info(
+                "Download and parsing completed in {} seconds.".format(
+                    int(time.time() - start)))
+        elif self.poll_mode == 'application':
+            self.get_application_data()
+        elif self.poll_mode == 'mqtt':
+            if self.mqtt_gap_start:
+                # Fill the gap since the last uplink stored before a (re)connect
+                gap_start = self.mqtt_gap_start
+                self.mqtt_gap_start = None
+                try:
+                    self.get_new_data(after=gap_start)
+                except Exception:
+                    self.mqtt_gap_start = gap_start
+                    raise
+            else:
+                self.save_progress()
+        elif self.latest_datetime:
+            # Continue from the last processed uplink instead of a fixed window
+            # so scheduling delays don't leave gaps between polls
+            self.get_new_data(after=self.latest_datetime)
         else:
             self.get_new_data(self.period)
-
-        return {}
@@ -108,11 +108,11 @@ class InputModule(AbstractInput):
             except serial.SerialException:
                 self.logger.exception('Opening serial')
         else:
-            self.logger.error('Could not open "{dev}". Check the device location is correct.'.format(
-                dev=self.input_dev.uart_location))
+            self.logger.error('Could not open "%s". Check the device location is correct.',
+                              self.input_dev.uart_location)
 
-        self.logger.debug("Min time between transmissions: {} seconds".format(
-            min_seconds_between_transmissions))
+        self.logger.debug("Min time between transmissions: %s seconds",
+                          min_seconds_between_transmissions)
 
     def get_measurement(self):
         """ Gets the K30's CO2 concentration in ppmv """
@@ -151,7 +151,7 @@ class InputModule(AbstractInput):
         except Exception as e:
             if not self.ttn_serial_error:
                 # Only send this error once if it continually occurs
-                self.logger.error("TTN: Could not send serial: {}".format(e))
+                self.logger.error("TTN: Could not send serial: %s", e)
                 self.ttn_serial_error = True
 
         return self.return_dict
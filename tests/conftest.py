@@ -0,0 +1,6 @@
+# coding=utf-8
+import os
+import sys
+
+# The Mycodo stand-ins and simulated sensors are shared with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
@@ -0,0 +1,161 @@
+# coding=utf-8
+"""
+Run the BME680 (Temperature Error Fix) and BME280 Inputs against the
+simulated sensors of benchmarks/simulated_i2c.py, healthy and with faults
+injected, and check the values they store.
+"""
+import sys
+import types
+
+import pytest
+
+import mycodo_stubs
+import simulated_i2c
+
+import bme680
+
+BME680_INPUT = 'custom_inputs/bme680 temperature error fix/mycodo_cutom_input_bme680_temperature_error_fix.py'
+BME280_INPUT = 'custom_inputs/bme280 serial to ttn/mycodo_custom_input_bme280_ttn.py'
+
+PERIOD = 10
+
+
+@pytest.fixture(scope='module')
+def bme680_module():
+    return mycodo_stubs.load_input(BME680_INPUT)
+
+
+@pytest.fixture(scope='module')
+def bme280_module():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        if 'serial' not in sys.modules:
+            # No serial device is configured, so nothing is written to one
+            monkeypatch.setitem(sys.modules, 'serial', types.SimpleNamespace(Serial=None))
+        yield mycodo_stubs.load_input(BME280_INPUT)
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    clock = simulated_i2c.SimulatedClock()
+    bus = simulated_i2c.SimulatedSMBus(clock)
+    monkeypatch.setitem(sys.modules, 'smbus2', types.SimpleNamespace(SMBus=lambda i2c_bus: bus))
+    return bus
+
+
+def patch_clock(monkeypatch, clock, *modules):
+    """ Replace the time module of each module with the clock until the test ends """
+    for module in modules:
+        monkeypatch.setattr(module, 'time', clock)
+
+
+@pytest.fixture
+def inputs():
+    started = []
+    yield started
+    for each_input in started:
+        each_input.stop_input()
+
+
+def start_bme680(module, bus, inputs, monkeypatch, address=0x76, channels=tuple(range(7)), **options):
+    device = bus.add_device(simulated_i2c.SimulatedBME680(bus.clock, address=address))
+    patch_clock(monkeypatch, bus.clock, module, bme680)
+    custom_options = {
+        'temperature_oversample': 'OS_8X',
+        'pressure_oversample': 'OS_4X',
+        'humidity_oversample': 'OS_2X',
+    }
+    custom_options.update(options)
+    sensor = module.InputModule(
+        mycodo_stubs.InputDevice(
+            custom_options=custom_options, channels=channels, period=PERIOD, i2c_location=hex(address)),
+        testing=True)
+    sensor.initialize_input()
+    inputs.append(sensor)
+    return sensor, device
+
+
+def start_bme280(module, bus, inputs, monkeypatch, **options):
+    from Adafruit_BME280 import BME280
+
+    device = bus.add_device(simulated_i2c.SimulatedBME280(bus.clock))
+    patch_clock(monkeypatch, bus.clock, module, sys.modules[BME280.__module__])
+    custom_options = {'serial_device': ''}
+    custom_options.update(options)
+    sensor = module.InputModule(
+        mycodo_stubs.InputDevice(custom_options=custom_options, channels=tuple(range(6)), period=PERIOD),
+        testing=True)
+    sensor.initialize_input()
+    inputs.append(sensor)
+    return sensor, device
+
+
+def measure(sensor, bus):
+    """ Wait for the next period and read the Input, as Mycodo would """
+    bus.clock.sleep(PERIOD)
+    values = sensor.get_measurement()
+    return {channel: values[channel].get('value') for channel in values} if values else None
+
+
+def assert_environment(values, device, pressure_scale):
+    assert values[0] == pytest.approx(device.environment['temperature'], abs=0.5)
+    assert values[1] == pytest.approx(device.environment['humidity'], abs=1)
+    assert values[2] == pytest.approx(device.environment['pressure'] * pressure_scale, rel=0.01)
+
+
+def test_bme680_stores_environment(bme680_module, bus, inputs, monkeypatch):
+    sensor, device = start_bme680(bme680_module, bus, inputs, monkeypatch)
+    values = measure(sensor, bus)
+    assert_environment(values, device, 1)
+    assert values[3] == pytest.approx(device.environment['gas_resistance'], rel=0.01)
+
+
+def test_bme680_recovers_from_lockup(bme680_module, bus, inputs, monkeypatch):
+    sensor, device = start_bme680(bme680_module, bus, inputs, monkeypatch)
+    measure(sensor, bus)
+    resets = device.resets
+
+    device.lockup = True
+    values = measure(sensor, bus)
+
+    assert device.resets == resets + 1
+    assert values[0] != simulated_i2c.LOCKUP_TEMPERATURE
+    assert_environment(values, device, 1)
+
+
+def test_bme680_recovers_from_stale_data(bme680_module, bus, inputs, monkeypatch):
+    sensor, device = start_bme680(bme680_module, bus, inputs, monkeypatch, stuck_reads=5)
+    last = measure(sensor, bus)
+    resets = device.resets
+
+    device.stale = True
+    repeated = 0
+    for _ in range(5):
+        values = measure(sensor, bus)
+        if device.resets > resets:
+            break
+        assert values == last
+        repeated += 1
+
+    assert device.resets == resets + 1
+    assert repeated < 5
+    assert values[0] != last[0]
+    assert_environment(values, device, 1)
+
+
+def test_bme680_burst_read_waits_only_for_batching_inputs(bme680_module, bus, inputs, monkeypatch):
+    burst, _ = start_bme680(bme680_module, bus, inputs, monkeypatch, address=0x76)
+    start_bme680(bme680_module, bus, inputs, monkeypatch, address=0x77, channels=(0, 1, 2), read_mode='library')
+    assert burst.i2c_scheduler.users == 2
+
+    bus.clock.sleep(PERIOD)
+    start = bus.clock.now
+    burst.get_measurement()
+    # The Library read mode Input never batches, so no batch window is waited
+    assert bus.clock.now - start < burst.measurement_seconds + bme680_module.I2C_BATCH_WINDOW
+
+
+def test_bme280_stores_environment(bme280_module, bus, inputs, monkeypatch):
+    sensor, device = start_bme280(bme280_module, bus, inputs, monkeypatch)
+    values = measure(sensor, bus)
+    # The Adafruit library returns pressure in Pa
+    assert_environment(values, device, 100)